@@ -61,6 +61,7 @@ xrd_tab = children_xrd.make_tab_from_widgets()
 # Defining the main window layout
 app.layout = html.Div(
     [
+        html.Div(id=HDF5_BUSY_COMPONENT, className="busy_message"),
         dcc.Tabs(
             id="tabs",
             value="browser",
@@ -0,0 +1,86 @@
+"""
+Benchmark of the Dektak .asc2d reader on a synthetic full wafer of profiles.
+
+Compares read_dektak with the previous two-pass reader (header with readlines, then pd.read_csv skipping the
+header again, kept below as reference) and reports the per-file time and throughput of both. Run from the
+repository root:
+    python benchmarks/benchmark_dektak.py --side 21 --points 20000
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from modules.hdf5_compilers.hdf5compile_profil import parse_dektak_header, read_dektak
+
+
+def write_synthetic_asc2d(file_path, n_points, row, column):
+    rng = np.random.default_rng(row * 100 + column)
+    distance = np.linspace(0, 2000, n_points)
+    profile = 500 * (distance > 1000) + rng.normal(0, 5, n_points)
+
+    lines = ["Bruker DektakXT", "Export", "", "Header"]
+    lines += ["Parameter{},unit,{}".format(idx, idx * 0.1) for idx in range(39)]
+    lines += ["FullFilename,C:\\data\\wafer\\profile.asc2d", "TargetName,({},{})".format(row, column)]
+    lines += ["Data", "y(um), z(raw/unitless)"]
+    lines += ["{:.4f}, {:.4f}".format(y, z) for y, z in zip(distance, profile)]
+
+    with open(file_path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def read_dektak_previous(file_path, header_length=46):
+    # Previous reader: the whole file is read for the header, then read again by pandas
+    with open(file_path, "r") as file:
+        lines = file.readlines()
+    header_dict = parse_dektak_header(lines)
+
+    asc2d_dataframe = pd.read_csv(file_path, skiprows=header_length)
+    asc2d_dataframe.rename(columns={" z(raw/unitless)": "profile"}, inplace=True)
+    asc2d_dataframe.rename(columns={"y(um)": "distance"}, inplace=True)
+    return header_dict, asc2d_dataframe
+
+
+def time_reader(reader, file_list):
+    start = time.perf_counter()
+    for file_path in file_list:
+        reader(file_path)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--side", type=int, default=21, help="number of profiles along each wafer axis")
+    parser.add_argument("--points", type=int, default=20000, help="number of points per profile")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_list = []
+        for row in range(args.side):
+            for column in range(args.side):
+                file_path = Path(temp_dir) / "profile_{}_{}.asc2d".format(row, column)
+                write_synthetic_asc2d(file_path, args.points, row, column)
+                file_list.append(file_path)
+        total_mb = sum(file_path.stat().st_size for file_path in file_list) / 1024 ** 2
+
+        # Check that both readers agree before timing them
+        header, dataframe = read_dektak(file_list[0])
+        header_previous, dataframe_previous = read_dektak_previous(file_list[0])
+        assert header == header_previous and dataframe.equals(dataframe_previous)
+
+        print("{} files, {:.1f} MB".format(len(file_list), total_mb))
+        for name, reader in [("previous", read_dektak_previous), ("current", read_dektak)]:
+            elapsed = time_reader(reader, file_list)
+            print("{:>9}: {:7.3f} s  {:7.2f} ms/file  {:7.1f} MB/s".format(
+                name, elapsed, 1000 * elapsed / len(file_list), total_mb / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark of the HDF5 file creation profile on a synthetic sample file made of many small objects.
+
+Writes the same wafer (positions with instrument metadata, measurement arrays and scalar results) with the default
+h5py settings and with open_hdf5 and HDF5_FILE_PROFILE, then reports the file size and the time to open the file
+and walk it, reading every dataset. Run from the repository root:
+    python benchmarks/benchmark_hdf5_profile.py --side 21 --metadata 60 --repeat 5
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from modules.functions.functions_shared import open_hdf5
+
+
+def write_synthetic_sample(hdf5_file, side, n_metadata, n_points):
+    rng = np.random.default_rng(0)
+    for dataset_name in ["edx", "profil", "xrd"]:
+        dataset_group = hdf5_file.create_group(dataset_name)
+        dataset_group.attrs["HT_type"] = dataset_name
+        for row in range(side):
+            for column in range(side):
+                x_pos, y_pos = 5.0 * (column - side // 2), 5.0 * (row - side // 2)
+                position_group = dataset_group.create_group(f"({x_pos},{y_pos})")
+                position_group.attrs["ignored"] = False
+
+                instrument_group = position_group.create_group("instrument")
+                instrument_group["x_pos"] = x_pos
+                instrument_group["y_pos"] = y_pos
+                parameters_group = instrument_group.create_group("parameters")
+                for idx in range(n_metadata):
+                    parameters_group[f"parameter_{idx}"] = idx * 0.5
+                    parameters_group[f"parameter_{idx}"].attrs["units"] = "arb"
+
+                measurement_group = position_group.create_group("measurement")
+                measurement_group["angle"] = np.linspace(20, 80, n_points)
+                measurement_group["counts"] = rng.poisson(100, n_points).astype(float)
+
+                results_group = position_group.create_group("results")
+                for element in ["Fe", "Co", "Ni"]:
+                    results_group[element] = rng.random()
+
+
+def walk_file(hdf5_file):
+    n_items = [0]
+
+    def visit(name, item):
+        if isinstance(item, h5py.Dataset):
+            item[()]
+            n_items[0] += 1
+
+    hdf5_file.visititems(visit)
+    return n_items[0]
+
+
+def time_walk(open_file, hdf5_path, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open_file(hdf5_path) as hdf5_file:
+            n_items = walk_file(hdf5_file)
+        timings.append(time.perf_counter() - start)
+    return min(timings), n_items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--side", type=int, default=21, help="number of positions along each wafer axis")
+    parser.add_argument("--metadata", type=int, default=60, help="number of metadata datasets per position")
+    parser.add_argument("--points", type=int, default=1000, help="number of points per measurement array")
+    parser.add_argument("--repeat", type=int, default=5, help="number of walks, the fastest one is reported")
+    args = parser.parse_args()
+
+    layouts = [
+        ("default", lambda path, mode="r": h5py.File(path, mode)),
+        ("profile", lambda path, mode="r": open_hdf5(path, mode)),
+    ]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, open_file in layouts:
+            hdf5_path = Path(temp_dir) / f"{name}.hdf5"
+
+            start = time.perf_counter()
+            with open_file(hdf5_path, "x") as hdf5_file:
+                write_synthetic_sample(hdf5_file, args.side, args.metadata, args.points)
+            write_time = time.perf_counter() - start
+
+            walk_time, n_items = time_walk(open_file, hdf5_path, args.repeat)
+            print("{:>8}: {:8.1f} MB  write {:6.2f} s  open + walk {:6.3f} s  ({} datasets)".format(
+                name, hdf5_path.stat().st_size / 1024 ** 2, write_time, walk_time, n_items))
+
+
+if __name__ == "__main__":
+    main()
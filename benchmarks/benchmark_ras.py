@@ -0,0 +1,110 @@
+"""
+Benchmark of the Smartlab .ras reader on a synthetic wafer of a few hundred files.
+
+Compares read_data_from_ras with the previous line-by-line reader (kept below as reference) and reports the
+throughput of both. Run from the repository root:
+    python benchmarks/benchmark_ras.py --files 300 --points 3000
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from modules.hdf5_compilers.hdf5compile_xrd import convertFloat, read_data_from_ras
+
+
+def write_synthetic_ras(file_path, n_points, x_pos, y_pos):
+    rng = np.random.default_rng(abs(hash((x_pos, y_pos))) % 2 ** 32)
+    angles = np.linspace(20, 80, n_points)
+    counts = rng.poisson(100, n_points)
+
+    header = [
+        "*RAS_DATA_START",
+        "*RAS_HEADER_START",
+        '*FILE_COMMENT "synthetic wafer"',
+        '*FILE_OPERATOR "benchmark"',
+        '*HW_XG_WAVE_LENGTH_ALPHA1 "1.540593"',
+        '*HW_XG_WAVE_LENGTH_ALPHA2 "1.544414"',
+        '*MEAS_COND_AXIS_POSITION-6 "{}"'.format(x_pos),
+        '*MEAS_COND_AXIS_POSITION-7 "{}"'.format(y_pos),
+        '*MEAS_SCAN_SPEED "10.0"',
+        '*MEAS_INTERNAL_FLAG "1"',
+        '*DISP_LINE_COLOR "255"',
+    ] + ['*HW_PARAMETER_{} "{}"'.format(idx, idx * 0.5) for idx in range(150)] + [
+        "*RAS_HEADER_END",
+        "*RAS_INT_START",
+    ]
+    data = ["{:.4f} {} 1.0000".format(angle, count) for angle, count in zip(angles, counts)]
+    footer = ["*RAS_INT_END", "*RAS_DATA_END"]
+
+    with open(file_path, "w", encoding="iso-8859-1") as file:
+        file.write("\n".join(header + data + footer) + "\n")
+
+
+def read_data_from_ras_previous(file_path):
+    # Previous reader: header and data parsed line by line into nested lists
+    with open(file_path, "r", encoding="iso-8859-1") as file:
+        lines = file.readlines()
+
+    file_dict, hw_dict, meas_dict, data = {}, {}, {}, []
+    for line in lines:
+        if line.startswith("*"):
+            formatted_line = line.strip().split(" ", 1)
+            if formatted_line[0].startswith("*RAS") or formatted_line[0].startswith("*DISP"):
+                continue
+            elif formatted_line[0].startswith("*FILE"):
+                file_dict[formatted_line[0].replace("*FILE_", "")] = formatted_line[1]
+            elif formatted_line[0].startswith("*HW"):
+                hw_dict[formatted_line[0].replace("*HW_", "")] = formatted_line[1]
+            elif formatted_line[0].startswith("*MEAS") and "INTERNAL" not in formatted_line[0]:
+                meas_dict[formatted_line[0].replace("*MEAS_", "")] = formatted_line[1]
+        else:
+            data.append([[elm] for elm in line.strip().split(" ")])
+
+    tth = [convertFloat(elm[0][0]) for elm in data]
+    counts = [convertFloat(elm[1][0]) for elm in data]
+    return file_dict, hw_dict, meas_dict, tth, counts
+
+
+def time_reader(reader, file_list):
+    start = time.perf_counter()
+    for file_path in file_list:
+        reader(file_path)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=300, help="number of .ras files")
+    parser.add_argument("--points", type=int, default=3000, help="number of angles per file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        side = int(np.ceil(np.sqrt(args.files)))
+        file_list = []
+        for idx in range(args.files):
+            file_path = Path(temp_dir) / "wafer_{:03d}.ras".format(idx)
+            write_synthetic_ras(file_path, args.points, 5.0 * (idx % side), 5.0 * (idx // side))
+            file_list.append(file_path)
+        total_mb = sum(file_path.stat().st_size for file_path in file_list) / 1024 ** 2
+
+        # Check that both readers agree before timing them
+        _, _, _, data = read_data_from_ras(file_list[0])
+        _, _, _, tth, counts = read_data_from_ras_previous(file_list[0])
+        assert np.allclose(data[:, 0], tth) and np.allclose(data[:, 1], counts)
+
+        print("{} files, {:.1f} MB".format(args.files, total_mb))
+        for name, reader in [("previous", read_data_from_ras_previous), ("current", read_data_from_ras)]:
+            elapsed = time_reader(reader, file_list)
+            print("{:>9}: {:7.3f} s  {:8.1f} files/s  {:7.1f} MB/s".format(
+                name, elapsed, args.files / elapsed, total_mb / elapsed))
+
+
+if __name__ == "__main__":
+    main()
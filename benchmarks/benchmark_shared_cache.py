@@ -0,0 +1,89 @@
+"""
+Benchmark of the derived data cache shared by the worker processes of a multi-worker server (see wsgi.py).
+
+Every worker process opens the same synthetic wafer and asks for a table derived from all its positions, as the
+heatmap callbacks do. Without the shared cache each worker builds the table once, with it the first worker builds it
+and the others read it from SHARED_CACHE_FOLDER. A write to the file increments its generation, the next request
+rebuilds the table. Run from the repository root:
+    python benchmarks/benchmark_shared_cache.py --side 21 --points 5000 --workers 4
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from modules.functions import functions_shared
+from modules.functions.functions_shared import get_cached_derived, open_hdf5
+
+
+def write_synthetic_wafer(hdf5_path, side, n_points):
+    rng = np.random.default_rng(0)
+    with open_hdf5(hdf5_path, "x") as hdf5_file:
+        dataset_group = hdf5_file.create_group("xrd")
+        for row in range(side):
+            for column in range(side):
+                position_group = dataset_group.create_group(f"({5.0 * column},{5.0 * row})")
+                position_group["measurement/counts"] = rng.poisson(100, n_points).astype(float)
+
+
+def make_summary_table(dataset_group):
+    rows = []
+    for position, position_group in dataset_group.items():
+        counts = position_group["measurement/counts"][()]
+        rows.append({"position": position, "mean": counts.mean(), "max": counts.max(), "std": counts.std()})
+    return pd.DataFrame(rows)
+
+
+def request_table(hdf5_path, cache_folder):
+    functions_shared.SHARED_CACHE_FOLDER = cache_folder
+    start = time.perf_counter()
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        get_cached_derived(hdf5_file["xrd"], "summary_table", make_summary_table)
+    return time.perf_counter() - start
+
+
+def time_workers(hdf5_path, cache_folder, n_workers):
+    # One user opens the wafer, then the others do
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        first = executor.submit(request_table, hdf5_path, cache_folder).result()
+        others = list(executor.map(request_table, [hdf5_path] * (n_workers - 1), [cache_folder] * (n_workers - 1)))
+    return first, others
+
+
+def print_timings(name, timings):
+    first, others = timings
+    print("{:>13}: first request {:8.1f} ms, other workers {:8.1f} ms".format(
+        name, 1000 * first, 1000 * np.median(others)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--side", type=int, default=21, help="number of positions along each wafer axis")
+    parser.add_argument("--points", type=int, default=5000, help="number of points per pattern")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        hdf5_path = Path(temp_dir) / "wafer.hdf5"
+        cache_folder = str(Path(temp_dir) / "cache")
+        write_synthetic_wafer(hdf5_path, args.side, args.points)
+
+        for name, folder in [("per process", None), ("shared", cache_folder), ("shared, warm", cache_folder)]:
+            print_timings(name, time_workers(hdf5_path, folder, args.workers))
+
+        # Any write increments the generation of the file, cached tables are rebuilt
+        with open_hdf5(hdf5_path, "a"):
+            pass
+        print_timings("after a write", time_workers(hdf5_path, cache_folder, args.workers))
+
+
+if __name__ == "__main__":
+    main()
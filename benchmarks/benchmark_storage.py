@@ -0,0 +1,111 @@
+"""
+Benchmark of the storage policy on a synthetic XRD wafer (1D patterns and 2D detector images).
+
+Writes the wafer raw, with STORAGE_POLICY, and with gzip or lzf forced on every signal, then reports the file size
+and the read latency of the three access patterns of the app:
+    - single spot: pattern and image of one position (plots of a clicked position)
+    - whole wafer: pattern of every position (heatmaps, clustering)
+    - image slice: a band of rows of every image (reductions over the detector)
+Run from the repository root:
+    python benchmarks/benchmark_storage.py --side 11 --points 5000 --image 512
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from modules.functions.functions_shared import open_hdf5
+from modules.hdf5_compilers import hdf5compile_base
+from modules.hdf5_compilers.hdf5compile_base import get_storage_options
+
+
+def write_synthetic_wafer(hdf5_path, side, n_points, image_size):
+    rng = np.random.default_rng(0)
+    q = np.linspace(1, 5, n_points)
+    radius = np.hypot(*np.meshgrid(np.arange(image_size), np.arange(image_size))) / image_size
+
+    with open_hdf5(hdf5_path, "x") as hdf5_file:
+        xrd_group = hdf5_file.create_group("xrd")
+        for row in range(side):
+            for column in range(side):
+                position_group = xrd_group.create_group(f"({5.0 * column},{5.0 * row})")
+                measurement_group = position_group.create_group("measurement")
+
+                intensity = 100 + 500 * np.exp(-((q - 3 - 0.01 * row) ** 2) / 0.001) + rng.normal(0, 5, n_points)
+                measurement_group.create_dataset(
+                    "counts", data=intensity, **get_storage_options("xrd", "pattern", intensity.shape)
+                )
+                image = rng.poisson(5 + 200 * np.exp(-((radius - 0.5) ** 2) / 0.001)).astype("uint32")
+                measurement_group.create_dataset(
+                    "2Dimage", data=image, **get_storage_options("xrd", "image", image.shape, image.dtype)
+                )
+
+
+def time_access(hdf5_path, side, image_size, repeat):
+    positions = [f"({5.0 * column},{5.0 * row})" for row in range(side) for column in range(side)]
+    band = slice(image_size // 2 - 8, image_size // 2 + 8)
+
+    def single_spot(xrd_group):
+        position_group = xrd_group[positions[len(positions) // 2]]
+        return position_group["measurement/counts"][()], position_group["measurement/2Dimage"][()]
+
+    def whole_wafer(xrd_group):
+        return np.stack([xrd_group[position]["measurement/counts"][()] for position in positions])
+
+    def image_slice(xrd_group):
+        return np.stack([xrd_group[position]["measurement/2Dimage"][band, :] for position in positions])
+
+    timings = {}
+    for name, access in [("single spot", single_spot), ("whole wafer", whole_wafer), ("image slice", image_slice)]:
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with open_hdf5(hdf5_path, "r") as hdf5_file:
+                access(hdf5_file["xrd"])
+            elapsed.append(time.perf_counter() - start)
+        timings[name] = min(elapsed)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--side", type=int, default=11, help="number of positions along each wafer axis")
+    parser.add_argument("--points", type=int, default=5000, help="number of points per pattern")
+    parser.add_argument("--image", type=int, default=512, help="side of the detector images")
+    parser.add_argument("--repeat", type=int, default=3, help="number of reads, the fastest one is reported")
+    args = parser.parse_args()
+
+    gzip = {"compression": "gzip", "compression_opts": 4, "shuffle": True}
+    lzf = {"compression": "lzf", "shuffle": True}
+    policies = [
+        ("raw", {"default": None}),
+        ("policy", hdf5compile_base.STORAGE_POLICY),
+        ("gzip", {"default": gzip}),
+        ("lzf", {"default": lzf}),
+    ]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        print("{:>8} {:>9} {:>13} {:>13} {:>13}".format("policy", "size MB", "single spot", "whole wafer",
+                                                        "image slice"))
+        for name, policy in policies:
+            saved_policy = hdf5compile_base.STORAGE_POLICY
+            hdf5compile_base.STORAGE_POLICY = policy
+            try:
+                hdf5_path = Path(temp_dir) / f"{name}.hdf5"
+                write_synthetic_wafer(hdf5_path, args.side, args.points, args.image)
+            finally:
+                hdf5compile_base.STORAGE_POLICY = saved_policy
+
+            timings = time_access(hdf5_path, args.side, args.image, args.repeat)
+            print("{:>8} {:9.1f} {:>10.2f} ms {:>10.2f} ms {:>10.2f} ms".format(
+                name, hdf5_path.stat().st_size / 1024 ** 2, *(1000 * value for value in timings.values())))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,15 +21,19 @@ def callbacks_edx(app):
     # Callback to find all relevant datasets in HDF5 file
     @app.callback(
         [Output("edx_select_dataset", "options"),
-         Output("edx_select_dataset", "value")],
+         Output("edx_select_dataset", "value"),
+         Output("edx_loaded_path_store", "data")],
         Input("hdf5_path_store", "data"),
+        Input("tabs", "value"),
+        State("edx_loaded_path_store", "data"),
     )
+    @defer_to_tab("edx", active_tab_index=1, loaded_path_index=2)
     @check_conditions(edx_conditions, hdf5_path_index=0)
-    def edx_scan_hdf5_for_datasets(hdf5_path):
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+    def edx_scan_hdf5_for_datasets(hdf5_path, active_tab, loaded_path):
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             dataset_list = get_hdf5_datasets(hdf5_file, dataset_type='edx')
 
-        return dataset_list, dataset_list[0]
+        return dataset_list, dataset_list[0], str(hdf5_path)
     
     
     # Callback to check if HDF5 has results
@@ -44,7 +48,7 @@ def callbacks_edx(app):
         if selected_dataset is None:
             raise PreventUpdate
 
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             edx_group = hdf5_file[selected_dataset]
             if check_group_for_results(edx_group):
                 return 'Found results for all points'
@@ -61,7 +65,7 @@ def callbacks_edx(app):
     #
     # @check_conditions(edx_conditions, hdf5_path_index=1)
     # def edx_update_element_list(selected_dataset, hdf5_path):
-    #     with h5py.File(hdf5_path, 'r') as hdf5_file:
+    #     with open_hdf5(hdf5_path, 'r') as hdf5_file:
     #         edx_group = hdf5_file[selected_dataset]
     #         edx_element_list = get_quantified_elements(edx_group)
     #     return edx_element_list, edx_element_list[0]
@@ -80,7 +84,7 @@ def callbacks_edx(app):
         Input("edx_heatmap_max", "value"),
         Input("edx_heatmap_precision", "value"),
         Input("edx_heatmap_edit", "value"),
-        Input('hdf5_path_store', 'data'),
+        Input('edx_loaded_path_store', 'data'),
         Input("edx_select_dataset", "value"),
         prevent_initial_call=True,
     )
@@ -106,9 +110,9 @@ def callbacks_edx(app):
         if edit_toggle in ["edit", "unfiltered"]:
             masking = False
 
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             edx_group = hdf5_file[selected_dataset]
-            edx_df = edx_make_results_dataframe_from_hdf5(edx_group)
+            edx_df = get_cached_derived(edx_group, "results_dataframe", edx_make_results_dataframe_from_hdf5).copy()
 
         if heatmap_select is not None and selected_dataset is not None:
             plot_title = f"EDX composition map <br>{selected_dataset}"
@@ -148,7 +152,7 @@ def callbacks_edx(app):
         target_x = position[0]
         target_y = position[1]
 
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             edx_group = hdf5_file[selected_dataset]
             measurement_df = edx_get_measurement_from_hdf5(edx_group, target_x, target_y)
 
@@ -177,7 +181,7 @@ def callbacks_edx(app):
         target_x = heatmap_click['points'][0]['x']
         target_y = heatmap_click['points'][0]['y']
 
-        with h5py.File(hdf5_path, 'a') as hdf5_file:
+        with open_hdf5(hdf5_path, 'a') as hdf5_file:
             edx_group = hdf5_file[selected_dataset]
             position_group = get_target_position_group(edx_group, target_x, target_y)
             if not position_group.attrs["ignored"]:
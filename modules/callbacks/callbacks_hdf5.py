@@ -8,7 +8,8 @@ from ..functions.functions_shared import *
 from ..functions.functions_xrd import xrd_make_results_dataframe_from_hdf5
 from ..hdf5_compilers.hdf5compile_base import *
 from ..hdf5_compilers.hdf5compile_edx import *
-from ..hdf5_compilers.hdf5compile_esrf import write_esrf_to_hdf5, write_xrd_results_to_hdf5
+from ..hdf5_compilers.hdf5compile_esrf import esrf_materialize_dataset, write_esrf_to_hdf5, write_xrd_results_to_hdf5
+from ..hdf5_compilers.hdf5compile_migrations import migrate_hdf5_file
 from ..hdf5_compilers.hdf5compile_moke import *
 from ..hdf5_compilers.hdf5compile_profil import *
 from ..hdf5_compilers.hdf5compile_xrd import *
@@ -105,24 +106,36 @@ def callbacks_hdf5(app):
     def add_measurement_to_file(n_clicks, uploaded_folder_path, measurement_type, hdf5_path, dataset_name):
         if n_clicks > 0:
             print(uploaded_folder_path)
-            if measurement_type == 'EDX':
-                write_edx_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
-                return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
-            if measurement_type =='MOKE':
-                write_moke_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
-                return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
-            if measurement_type == 'PROFIL':
-                write_dektak_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
-                return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
-            if measurement_type =='XRD':
-                write_smartlab_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
-                return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
-            if measurement_type == "ESRF":
-                write_esrf_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
-                return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
-            if measurement_type == "XRD results":
-                write_xrd_results_to_hdf5(hdf5_path, uploaded_folder_path, target_dataset=dataset_name)
-                return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
+            try:
+                if measurement_type == 'EDX':
+                    write_edx_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
+                    return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
+                if measurement_type =='MOKE':
+                    write_moke_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
+                    return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
+                if measurement_type == 'PROFIL':
+                    write_dektak_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
+                    return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
+                if measurement_type =='XRD':
+                    write_smartlab_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
+                    return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
+                if measurement_type == "ESRF":
+                    copy_statistics = write_esrf_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
+                    if copy_statistics is None:
+                        return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
+                    return (f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name} '
+                            f'(detector copy: {copy_statistics["MB/s"]:.1f} MB/s).')
+                if measurement_type == "ESRF (linked)":
+                    write_esrf_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name, link_mode="link")
+                    return f'Linked {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
+                if measurement_type == "ESRF materialize":
+                    n_materialized = esrf_materialize_dataset(hdf5_path, dataset_name)
+                    return f'Copied {n_materialized} linked items of {dataset_name} into {hdf5_path}.'
+                if measurement_type == "XRD results":
+                    write_xrd_results_to_hdf5(hdf5_path, uploaded_folder_path, target_dataset=dataset_name)
+                    return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
+            except HDF5BusyError as error:
+                return str(error)
 
             return f'Failed to add measurement to {hdf5_path}.'
 
@@ -178,8 +191,8 @@ def callbacks_hdf5(app):
             )
         ]
 
-        if measurement_type == "XRD results":
-            with h5py.File(hdf5_path, "r") as hdf5_file:
+        if measurement_type in ["XRD results", "ESRF materialize"]:
+            with open_hdf5(hdf5_path, "r") as hdf5_file:
                 datasets = get_hdf5_datasets(hdf5_file, "xrd")
             if not datasets:
                 return new_children, "No ESRF or XRD datasets found in HDF5 file"
@@ -206,7 +219,7 @@ def callbacks_hdf5(app):
         if n_clicks > 0:
             hdf5_path = Path(hdf5_path)
             general_df = None
-            with h5py.File(hdf5_path, "r") as hdf5_file:
+            with open_hdf5(hdf5_path, "r") as hdf5_file:
                 for dataset_name, dataset_group in hdf5_file.items():
                     if dataset_name == "sample":
                         continue
@@ -242,24 +255,122 @@ def callbacks_hdf5(app):
     )
     def update_hdf5_file(n_clicks, hdf5_path):
         if n_clicks > 0:
-            hdf5_path = Path(hdf5_path)
-            checklist = []
-            with h5py.File(hdf5_path, "a") as hdf5_file:
-                for dataset_name, dataset_group in hdf5_file.items():
-                    if dataset_name == "sample":
-                        continue
-                    if dataset_group.attrs["HT_type"] == "edx":
-                        continue
-                    if dataset_group.attrs["HT_type"] == "moke":
-                        continue
-                    if dataset_group.attrs["HT_type"] in ["esrf", "xrd"]:
-                        continue
-                    if dataset_group.attrs["HT_type"] == "profil":
-                        update_dektak_hdf5(dataset_group)
-                        checklist.append(f"[PROFIL] {dataset_name}")
-            if not checklist:
+            report = migrate_hdf5_file(hdf5_path)
+            if report["error"] is not None:
+                return f"Update failed: {report['error']}"
+            if not report["datasets"]:
                 return "All datasets are already up to date"
-            return f"Successfully updated datasets {checklist}"
+            return f"Successfully updated datasets {list(report['datasets'].keys())}, repack the file to reclaim space"
+
+
+    # Serve the HDF5 file from memory while editing, written back periodically or with the save button
+    @app.callback(
+        Output("hdf5_text_box", "children", allow_duplicate=True),
+        Output("hdf5_session_mode", "value", allow_duplicate=True),
+        Output("hdf5_session_path_store", "data", allow_duplicate=True),
+        Input("hdf5_session_mode", "value"),
+        State("hdf5_path_store", "data"),
+        State("hdf5_session_path_store", "data"),
+        prevent_initial_call=True
+    )
+    def toggle_hdf5_session(session_mode, hdf5_path, session_path):
+        if hdf5_path is None:
+            return "No HDF5 file selected", [], None
+        if session_mode:
+            try:
+                open_hdf5_session(hdf5_path)
+            except (RuntimeError, HDF5BusyError) as error:
+                return str(error), [], None
+            return (f"Editing {Path(hdf5_path).name} in memory, changes are saved every {HDF5_SESSION_FLUSH_S} s "
+                    f"or with Save to disk"), session_mode, hdf5_path
+        try:
+            closed = close_hdf5_session(hdf5_path)
+        except (HDF5BusyError, HDF5SessionConflictError) as error:
+            # The working copy stays open, the user decides what to keep
+            return str(error), ["In-memory editing"], session_path
+        if closed:
+            return f"Saved {Path(hdf5_path).name}, editing on disk", [], None
+        raise PreventUpdate
+
+
+    # Selecting another file ends the in-memory editing of the previous one
+    @app.callback(
+        Output("hdf5_text_box", "children", allow_duplicate=True),
+        Output("hdf5_session_mode", "value", allow_duplicate=True),
+        Output("hdf5_session_path_store", "data", allow_duplicate=True),
+        Input("hdf5_path_store", "data"),
+        State("hdf5_session_path_store", "data"),
+        prevent_initial_call=True
+    )
+    def close_previous_hdf5_session(hdf5_path, session_path):
+        if session_path is None or session_path == hdf5_path:
+            raise PreventUpdate
+        try:
+            close_hdf5_session(session_path)
+        except (HDF5BusyError, HDF5SessionConflictError) as error:
+            return f"{error}, {Path(session_path).name} is still edited in memory", [], session_path
+        return f"Saved {Path(session_path).name}, editing on disk", [], None
+
+
+    @app.callback(
+        Output("hdf5_text_box", "children", allow_duplicate=True),
+        Input("hdf5_session_flush", "n_clicks"),
+        State("hdf5_path_store", "data"),
+        prevent_initial_call=True
+    )
+    def flush_hdf5_session_to_disk(n_clicks, hdf5_path):
+        if n_clicks > 0:
+            if hdf5_path is None or os.path.abspath(hdf5_path) not in HDF5_SESSIONS:
+                return "In-memory editing is not enabled"
+            try:
+                if flush_hdf5_session(hdf5_path):
+                    return f"Saved {Path(hdf5_path).name}"
+            except (HDF5BusyError, HDF5SessionConflictError) as error:
+                return str(error)
+            return "No changes to save"
+        raise PreventUpdate
+
+
+    # Repack the HDF5 file in a background thread, polled by the interval until it is done
+    @app.callback(
+        [Output("hdf5_text_box", "children", allow_duplicate=True),
+         Output("hdf5_repack_job", "data"),
+         Output("hdf5_repack_interval", "disabled")],
+        Input("hdf5_repack", "n_clicks"),
+        State("hdf5_path_store", "data"),
+        prevent_initial_call=True
+    )
+    def repack_hdf5_file(n_clicks, hdf5_path):
+        if n_clicks > 0:
+            if hdf5_path is None:
+                return "No HDF5 file selected", None, True
+            if start_repack_hdf5(hdf5_path) is None:
+                return f"{Path(hdf5_path).name} is already being repacked", hdf5_path, False
+            return f"Repacking {Path(hdf5_path).name}...", hdf5_path, False
+        raise PreventUpdate
+
+
+    @app.callback(
+        [Output("hdf5_text_box", "children", allow_duplicate=True),
+         Output("hdf5_repack_interval", "disabled", allow_duplicate=True)],
+        Input("hdf5_repack_interval", "n_intervals"),
+        State("hdf5_repack_job", "data"),
+        prevent_initial_call=True
+    )
+    def update_repack_status(n_intervals, hdf5_path):
+        job = REPACK_JOBS.get(hdf5_path)
+        if job is None:
+            # On multi-worker servers the repack may run in another worker, its progress is not known here
+            if get_repacked_path(hdf5_path).exists():
+                return f"Repacking {Path(hdf5_path).name}...", False
+            return "No repack running", True
+        if job["status"] == "running":
+            return f"Repacking {Path(hdf5_path).name}... {job['progress']:.0%}", False
+        if job["status"] == "failed":
+            return f"Repack failed: {job['error']}", True
+        result = job["result"]
+        return (f"Repacked {Path(hdf5_path).name}: {result['size_before']:.1f} MB -> {result['size_after']:.1f} MB "
+                f"in {result['seconds']:.1f} s"), True
 
 
 
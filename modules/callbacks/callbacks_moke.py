@@ -22,15 +22,19 @@ def callbacks_moke(app, children_moke):
 
     @app.callback(
         [Output("moke_select_dataset", "options"),
-        Output("moke_select_dataset", "value")],
+        Output("moke_select_dataset", "value"),
+        Output("moke_loaded_path_store", "data")],
         Input("hdf5_path_store", "data"),
+        Input("tabs", "value"),
+        State("moke_loaded_path_store", "data"),
     )
+    @defer_to_tab("moke", active_tab_index=1, loaded_path_index=2)
     @check_conditions(moke_conditions, hdf5_path_index=0)
-    def moke_scan_hdf5_for_datasets(hdf5_path):
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+    def moke_scan_hdf5_for_datasets(hdf5_path, active_tab, loaded_path):
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             dataset_list = get_hdf5_datasets(hdf5_file, dataset_type='moke')
 
-        return dataset_list, dataset_list[0]
+        return dataset_list, dataset_list[0], str(hdf5_path)
 
 
     # Callback for heatmap selection
@@ -46,13 +50,13 @@ def callbacks_moke(app, children_moke):
         Input("moke_heatmap_max", "value"),
         Input("moke_heatmap_precision", "value"),
         Input("moke_heatmap_edit", "value"),
-        Input('hdf5_path_store', 'data'),
+        Input('moke_loaded_path_store', 'data'),
         Input("moke_select_dataset", "value"),
         prevent_initial_call=True,
     )
     @check_conditions(moke_conditions, hdf5_path_index=5)
     def moke_update_heatmap(heatmap_select, z_min, z_max, precision, edit_toggle, hdf5_path, selected_dataset):
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             moke_group = hdf5_file[selected_dataset]
 
             if ctx.triggered_id in ["moke_heatmap_select", "moke_heatmap_edit", "moke_heatmap_precision"]:
@@ -63,7 +67,7 @@ def callbacks_moke(app, children_moke):
             if edit_toggle in ["edit", "unfiltered"]:
                 masking = False
 
-            moke_df = moke_make_results_dataframe_from_hdf5(moke_group)
+            moke_df = get_cached_derived(moke_group, "results_dataframe", moke_make_results_dataframe_from_hdf5).copy()
 
             if heatmap_select is not None and selected_dataset is not None:
                 name, unit = split_name_and_unit(heatmap_select)
@@ -107,7 +111,7 @@ def callbacks_moke(app, children_moke):
 
         fig = go.Figure()
 
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             moke_group = hdf5_file[selected_dataset]
             measurement_df = moke_get_measurement_from_hdf5(moke_group, target_x, target_y)
             results_dict = moke_get_results_from_hdf5(moke_group, target_x, target_y)
@@ -149,7 +153,7 @@ def callbacks_moke(app, children_moke):
     @check_conditions(moke_conditions, hdf5_path_index=1)
     def moke_make_database(n_clicks, hdf5_path, treatment_dict, selected_dataset):
         if n_clicks > 0:
-            with h5py.File(hdf5_path, 'a') as hdf5_file:
+            with open_hdf5(hdf5_path, 'a') as hdf5_file:
                 moke_group = hdf5_file[selected_dataset]
                 results_dict = moke_batch_fit(moke_group, treatment_dict)
                 moke_results_dict_to_hdf5(moke_group, results_dict, treatment_dict)
@@ -239,7 +243,7 @@ def callbacks_moke(app, children_moke):
             normalize = True
 
         if n_clicks>0:
-            with h5py.File(hdf5_path, 'a') as hdf5_file:
+            with open_hdf5(hdf5_path, 'a') as hdf5_file:
                 moke_group = hdf5_file[dataset_select]
                 fig = moke_plot_loop_map(moke_group, options_dict, normalize)
                 return fig
@@ -264,7 +268,7 @@ def callbacks_moke(app, children_moke):
         target_x = heatmap_click['points'][0]['x']
         target_y = heatmap_click['points'][0]['y']
 
-        with h5py.File(hdf5_path, 'a') as hdf5_file:
+        with open_hdf5(hdf5_path, 'a') as hdf5_file:
             moke_group = hdf5_file[selected_dataset]
             position_group = get_target_position_group(moke_group, target_x, target_y)
             if not position_group.attrs["ignored"]:
@@ -29,15 +29,19 @@ def callbacks_profil(app):
         [
             Output("profil_select_dataset", "options"),
             Output("profil_select_dataset", "value"),
+            Output("profil_loaded_path_store", "data"),
         ],
         Input("hdf5_path_store", "data"),
+        Input("tabs", "value"),
+        State("profil_loaded_path_store", "data"),
     )
+    @defer_to_tab("profil", active_tab_index=1, loaded_path_index=2)
     @check_conditions(profil_conditions, hdf5_path_index=0)
-    def profil_scan_hdf5_for_datasets(hdf5_path):
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+    def profil_scan_hdf5_for_datasets(hdf5_path, active_tab, loaded_path):
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="profil")
 
-        return dataset_list, dataset_list[0]
+        return dataset_list, dataset_list[0], str(hdf5_path)
 
 
     # Callback to check if HDF5 has results
@@ -52,7 +56,7 @@ def callbacks_profil(app):
         if selected_dataset is None:
             raise PreventUpdate
 
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             profil_group = hdf5_file[selected_dataset]
             if check_group_for_results(profil_group):
                 return "Found results for all points"
@@ -71,7 +75,7 @@ def callbacks_profil(app):
         Input("profil_heatmap_max", "value"),
         Input("profil_heatmap_precision", "value"),
         Input("profil_heatmap_edit", "value"),
-        Input("hdf5_path_store", "data"),
+        Input("profil_loaded_path_store", "data"),
         Input("profil_select_dataset", "value"),
         prevent_initial_call=True,
     )
@@ -97,9 +101,11 @@ def callbacks_profil(app):
         if edit_toggle in ["edit", "unfiltered"]:
             masking = False
 
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             profil_group = hdf5_file[selected_dataset]
-            profil_df = profil_make_results_dataframe_from_hdf5(profil_group)
+            profil_df = get_cached_derived(
+                profil_group, "results_dataframe", profil_make_results_dataframe_from_hdf5
+            ).copy()
 
         if heatmap_select is not None and selected_dataset is not None:
             plot_title = f"Profilometry thickness map <br>{selected_dataset}"
@@ -148,7 +154,7 @@ def callbacks_profil(app):
             vertical_spacing=0.1,
         )
 
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             profil_group = hdf5_file[selected_dataset]
             measurement_df = profil_get_measurement_from_hdf5(
                 profil_group, target_x, target_y
@@ -207,9 +213,9 @@ def callbacks_profil(app):
     ):
         if n_clicks > 0:
             if fit_mode == "Batch fitting":
-                with h5py.File(hdf5_path, "a") as hdf5_file:
+                with open_hdf5(hdf5_path, "a") as hdf5_file:
                     profil_group = hdf5_file[selected_dataset]
-                    for position, position_group in profil_group.items():
+                    for position, position_group in get_position_groups(profil_group):
                         results_dict = profil_spot_fit_steps(
                             position_group, nb_steps, x0
                         )
@@ -219,7 +225,7 @@ def callbacks_profil(app):
                 return "Successfully refitted data"
 
             if fit_mode == "Spot fitting":
-                with h5py.File(hdf5_path, "a") as hdf5_file:
+                with open_hdf5(hdf5_path, "a") as hdf5_file:
                     profil_group = hdf5_file[selected_dataset]
                     position_group = get_target_position_group(
                         profil_group, target_position[0], target_position[1]
@@ -231,7 +237,7 @@ def callbacks_profil(app):
                 return f"Successfully refitted position {target_position}"
 
             if fit_mode == "Manual":
-                with h5py.File(hdf5_path, "a") as hdf5_file:
+                with open_hdf5(hdf5_path, "a") as hdf5_file:
                     profil_group = hdf5_file[selected_dataset]
                     position_group = get_target_position_group(profil_group, target_position[0], target_position[1])
                     results_group = safe_create_new_subgroup(position_group, new_subgroup_name="results")
@@ -258,7 +264,7 @@ def callbacks_profil(app):
         target_x = heatmap_click["points"][0]["x"]
         target_y = heatmap_click["points"][0]["y"]
 
-        with h5py.File(hdf5_path, "a") as hdf5_file:
+        with open_hdf5(hdf5_path, "a") as hdf5_file:
             profil_group = hdf5_file[selected_dataset]
             position_group = get_target_position_group(profil_group, target_x, target_y)
             if not position_group.attrs["ignored"]:
@@ -7,6 +7,8 @@ from dash import Input, Output, callback
 from dash.exceptions import PreventUpdate
 from ..functions.functions_xrd import *
 from ..functions.functions_shared import *
+from ..hdf5_compilers.hdf5compile_xrd import (xrd_clustering_to_hdf5, xrd_peaks_dict_to_hdf5, xrd_reintegrate_dataset,
+                                               xrd_xrf_to_hdf5)
 
 
 def callbacks_xrd(app, children_xrd):
@@ -28,15 +30,19 @@ def callbacks_xrd(app, children_xrd):
 
     @app.callback(
         [Output("xrd_select_dataset", "options"),
-         Output("xrd_select_dataset", "value")],
+         Output("xrd_select_dataset", "value"),
+         Output("xrd_loaded_path_store", "data")],
         Input("hdf5_path_store", "data"),
+        Input("tabs", "value"),
+        State("xrd_loaded_path_store", "data"),
     )
+    @defer_to_tab("xrd", active_tab_index=1, loaded_path_index=2)
     @check_conditions(xrd_conditions, hdf5_path_index=0)
-    def xrd_scan_hdf5_for_datasets(hdf5_path):
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+    def xrd_scan_hdf5_for_datasets(hdf5_path, active_tab, loaded_path):
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             dataset_list = get_hdf5_datasets(hdf5_file, dataset_type='xrd')
 
-        return dataset_list, dataset_list[0]
+        return dataset_list, dataset_list[0], str(hdf5_path)
 
             
     # Callback for heatmap selection
@@ -52,13 +58,13 @@ def callbacks_xrd(app, children_xrd):
         Input("xrd_heatmap_max", "value"),
         Input("xrd_heatmap_precision", "value"),
         Input("xrd_heatmap_edit", "value"),
-        Input('hdf5_path_store', 'data'),
+        Input('xrd_loaded_path_store', 'data'),
         Input("xrd_select_dataset", "value"),
         prevent_initial_call=True,
     )
     @check_conditions(xrd_conditions, hdf5_path_index=5)
     def xrd_update_heatmap(heatmap_select, z_min, z_max, precision, edit_toggle, hdf5_path, selected_dataset):
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             xrd_group = hdf5_file[selected_dataset]
 
             if ctx.triggered_id in ["xrd_heatmap_select", "xrd_heatmap_edit", "xrd_heatmap_precision"]:
@@ -69,7 +75,8 @@ def callbacks_xrd(app, children_xrd):
             if edit_toggle in ["edit", "unfiltered"]:
                 masking = False
 
-            xrd_df = xrd_make_results_dataframe_from_hdf5(xrd_group)
+            # Rebuilt only when the file changed, replotting with other bounds or quantities is instant
+            xrd_df = get_cached_derived(xrd_group, "results_dataframe", xrd_make_results_dataframe_from_hdf5).copy()
             fig = make_heatmap_from_dataframe(xrd_df, values=heatmap_select, z_min=z_min, z_max=z_max,
                                               precision=precision, masking=masking)
 
@@ -98,10 +105,23 @@ def callbacks_xrd(app, children_xrd):
         Input("xrd_fits_select", "value"),
         Input("xrd_image_min", "value"),
         Input("xrd_image_max", "value"),
-        Input("hdf5_path_store", "data"),
+        Input("xrd_pattern_source", "value"),
+        Input("xrd_loaded_path_store", "data"),
     )
-    @check_conditions(xrd_conditions, hdf5_path_index=6)
-    def xrd_update_plot(position, plot_select, selected_dataset, fits_select, z_min, z_max, hdf5_path):
+    @check_conditions(xrd_conditions, hdf5_path_index=7)
+    def xrd_update_plot(position, plot_select, selected_dataset, fits_select, z_min, z_max, pattern_source, hdf5_path):
+        # Cluster components do not depend on the selected position
+        if plot_select == "components":
+            fig = go.Figure()
+            with open_hdf5(hdf5_path, "r") as hdf5_file:
+                try:
+                    components_df = xrd_get_clustering_components_from_hdf5(hdf5_file[selected_dataset])
+                except KeyError:
+                    raise PreventUpdate
+            fig = xrd_plot_components_from_dataframe(fig, components_df)
+            fig.update_layout(plot_layout(title="Clustering components"), showlegend=True)
+            return fig, [], [], None, None
+
         if position is None:
             raise PreventUpdate
 
@@ -112,17 +132,27 @@ def callbacks_xrd(app, children_xrd):
 
         fig = go.Figure()
 
-        if not plot_select == "image":
+        if plot_select not in ["image", "mean_image"]:
             z_min = None
             z_max = None
 
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             xrd_group = hdf5_file[selected_dataset]
+            if plot_select in ["integrated", "background"]:
+                try:
+                    measurement_df = xrd_get_integrated_from_hdf5(xrd_group, target_x, target_y, pattern_source)
+                except KeyError:
+                    raise PreventUpdate
+
             if plot_select == "integrated":
-                measurement_df = xrd_get_integrated_from_hdf5(xrd_group, target_x, target_y)
                 fig = xrd_plot_integrated_from_dataframe(fig, measurement_df)
                 fig.update_layout(plot_layout(title=f"Integrated spectrum <br>x = {target_x}, y = {target_y}"),)
 
+            if plot_select == "background":
+                measurement_df["background"] = xrd_estimate_background(measurement_df["intensity"].to_numpy())[0]
+                fig = xrd_plot_background_from_dataframe(fig, measurement_df)
+                fig.update_layout(plot_layout(title=f"Background <br>x = {target_x}, y = {target_y}"), showlegend=True)
+
             if plot_select == "fitted":
                 fits_df = xrd_get_fits_from_hdf5(xrd_group, target_x, target_y)
                 options = fits_df.columns[1:]
@@ -136,6 +166,13 @@ def callbacks_xrd(app, children_xrd):
                 z_max = np.round(fig.data[0].zmax, 0)
                 fig.update_layout(title=f"Image <br>x = {target_x}, y = {target_y}"),
 
+            if plot_select == "mean_image":
+                image_array = xrd_get_detector_summary_from_hdf5(xrd_group, target_x, target_y, reductions=("mean",))
+                fig = xrd_plot_image_from_array(image_array["mean"], z_min, z_max)
+                z_min = np.round(fig.data[0].zmin, 0)
+                z_max = np.round(fig.data[0].zmax, 0)
+                fig.update_layout(title=f"Mean image <br>x = {target_x}, y = {target_y}"),
+
 
         # Prevent resetting of xrd_fits_select
         if ctx.triggered_id in ["xrd_fits_select"]:
@@ -146,6 +183,146 @@ def callbacks_xrd(app, children_xrd):
         return fig, options, fits_select_value, z_min, z_max
         
 
+    # Callback for the quick-look peak analysis of the whole dataset
+    @app.callback(
+        Output('xrd_text_box', 'children', allow_duplicate=True),
+        Input('xrd_peaks_button', 'n_clicks'),
+        State('xrd_peaks_centers', 'value'),
+        State('xrd_peaks_width', 'value'),
+        State('xrd_pattern_source', 'value'),
+        State('hdf5_path_store', 'data'),
+        State('xrd_select_dataset', 'value'),
+        prevent_initial_call=True
+    )
+    @check_conditions(xrd_conditions, hdf5_path_index=4)
+    def xrd_fit_peaks(n_clicks, peaks_centers, peaks_width, pattern_source, hdf5_path, selected_dataset):
+        if n_clicks > 0:
+            peak_centers = None
+            if peaks_centers:
+                try:
+                    peak_centers = [float(center) for center in peaks_centers.replace(";", ",").split(",")]
+                except ValueError:
+                    return "Peak positions must be numbers separated by commas"
+            if peaks_width is None:
+                peaks_width = 0.1
+
+            # The fits run in worker processes, started while the file is closed
+            try:
+                with open_hdf5(hdf5_path, 'r') as hdf5_file:
+                    position_dataframe, q_array, intensity_matrix = xrd_get_background_subtracted_matrix(
+                        hdf5_file[selected_dataset], source=pattern_source
+                    )
+                results_dict = xrd_batch_peak_analysis(
+                    position_dataframe, q_array, intensity_matrix, peak_centers, window_width=peaks_width
+                )
+            except (KeyError, ValueError) as error:
+                return str(error)
+
+            with open_hdf5(hdf5_path, 'a') as hdf5_file:
+                xrd_peaks_dict_to_hdf5(hdf5_file[selected_dataset], results_dict)
+
+            n_peaks = len(next(iter(results_dict.values())))
+            return f"Fitted {n_peaks} peaks on {len(results_dict)} positions"
+
+
+    # Callback for the phase clustering of the whole dataset
+    @app.callback(
+        Output('xrd_text_box', 'children', allow_duplicate=True),
+        Input('xrd_cluster_button', 'n_clicks'),
+        State('xrd_cluster_method', 'value'),
+        State('xrd_cluster_components', 'value'),
+        State('xrd_pattern_source', 'value'),
+        State('hdf5_path_store', 'data'),
+        State('xrd_select_dataset', 'value'),
+        prevent_initial_call=True
+    )
+    @check_conditions(xrd_conditions, hdf5_path_index=4)
+    def xrd_cluster(n_clicks, cluster_method, n_components, pattern_source, hdf5_path, selected_dataset):
+        if n_clicks > 0:
+            if n_components is None or n_components < 1:
+                return "Number of components must be a positive integer"
+
+            # Other users keep reading the file during the fit, it is only locked for writing the results
+            try:
+                with open_hdf5(hdf5_path, 'r') as hdf5_file:
+                    position_dataframe, q_array, weights, components = xrd_cluster_patterns(
+                        hdf5_file[selected_dataset], method=cluster_method, n_components=int(n_components),
+                        source=pattern_source
+                    )
+            except (KeyError, ValueError) as error:
+                return str(error)
+
+            with open_hdf5(hdf5_path, 'a') as hdf5_file:
+                xrd_clustering_to_hdf5(
+                    hdf5_file[selected_dataset], position_dataframe, q_array, weights, components, cluster_method
+                )
+
+            return f"Clustered {len(position_dataframe)} positions in {int(n_components)} components ({cluster_method})"
+
+
+    # Callback for the in-house azimuthal integration of the detector images
+    @app.callback(
+        Output('xrd_text_box', 'children', allow_duplicate=True),
+        Input('xrd_reintegrate_button', 'n_clicks'),
+        State('xrd_poni_path', 'value'),
+        State('hdf5_path_store', 'data'),
+        State('xrd_select_dataset', 'value'),
+        prevent_initial_call=True
+    )
+    @check_conditions(xrd_conditions, hdf5_path_index=2)
+    def xrd_reintegrate(n_clicks, poni_path, hdf5_path, selected_dataset):
+        if n_clicks > 0:
+            if not poni_path:
+                return "Enter the path to the .poni calibration file"
+
+            try:
+                xrd_reintegrate_dataset(hdf5_path, selected_dataset, poni_path.strip())
+            except (OSError, KeyError, ValueError) as error:
+                return str(error)
+
+            return f"Integrated the images of {selected_dataset}, select the In-house pattern source to use them"
+
+
+    # Callback for the XRF element maps of ESRF datasets
+    @app.callback(
+        Output('xrd_text_box', 'children', allow_duplicate=True),
+        Input('xrd_xrf_button', 'n_clicks'),
+        State('xrd_xrf_elements', 'value'),
+        State('xrd_xrf_method', 'value'),
+        State('xrd_xrf_gain', 'value'),
+        State('xrd_xrf_offset', 'value'),
+        State('hdf5_path_store', 'data'),
+        State('xrd_select_dataset', 'value'),
+        prevent_initial_call=True
+    )
+    @check_conditions(xrd_conditions, hdf5_path_index=5)
+    def xrd_xrf_maps(n_clicks, xrf_elements, xrf_method, energy_gain, energy_offset, hdf5_path, selected_dataset):
+        if n_clicks > 0:
+            if not xrf_elements:
+                return "Enter the elements to map, separated by commas"
+            if energy_gain is None or energy_gain <= 0 or energy_offset is None:
+                return "Enter the energy calibration of the falconx channels (gain > 0 and offset, keV)"
+            elements = [element.strip() for element in xrf_elements.replace(";", ",").split(",") if element.strip()]
+
+            # Other users keep reading the file during the fit, it is only locked for writing the maps
+            try:
+                with open_hdf5(hdf5_path, 'r') as hdf5_file:
+                    position_dataframe, intensities = xrd_xrf_element_maps(
+                        hdf5_file[selected_dataset], elements, method=xrf_method, energy_offset=energy_offset,
+                        energy_gain=energy_gain
+                    )
+            except (KeyError, ValueError) as error:
+                return str(error)
+
+            with open_hdf5(hdf5_path, 'a') as hdf5_file:
+                xrd_xrf_to_hdf5(
+                    hdf5_file[selected_dataset], position_dataframe, elements, intensities, xrf_method, energy_offset,
+                    energy_gain
+                )
+
+            return f"Mapped {', '.join(elements)} on {len(position_dataframe)} positions ({xrf_method})"
+
+
     # Callback to deal with heatmap edit mode
     @app.callback(
         Output('xrd_text_box', 'children', allow_duplicate=True),
@@ -163,7 +340,7 @@ def callbacks_xrd(app, children_xrd):
         target_x = heatmap_click['points'][0]['x']
         target_y = heatmap_click['points'][0]['y']
 
-        with h5py.File(hdf5_path, 'a') as hdf5_file:
+        with open_hdf5(hdf5_path, 'a') as hdf5_file:
             xrd_group = hdf5_file[selected_dataset]
             position_group = get_target_position_group(xrd_group, target_x, target_y)
             if not position_group.attrs["ignored"]:
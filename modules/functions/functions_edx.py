@@ -8,7 +8,7 @@ def edx_conditions(hdf5_path, *args, **kwargs):
         return False
     if not h5py.is_hdf5(hdf5_path):
         return False
-    with h5py.File(hdf5_path, "r") as hdf5_file:
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
         dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="edx")
         if len(dataset_list) == 0:
             return False
@@ -18,7 +18,7 @@ def edx_conditions(hdf5_path, *args, **kwargs):
 def get_quantified_elements(edx_group):
     element_list = []
 
-    for position, position_group in edx_group.items():
+    for position, position_group in get_position_groups(edx_group):
         results_group = position_group.get('results')
 
         if results_group is None:
@@ -34,7 +34,7 @@ def get_quantified_elements(edx_group):
 def edx_make_results_dataframe_from_hdf5(edx_group):
     data_dict_list = []
 
-    for position, position_group in edx_group.items():
+    for position, position_group in get_position_groups(edx_group):
         instrument_group = position_group.get('instrument')
         # Exclude spots outside the wafer
         if np.abs(instrument_group["x_pos"][()]) + np.abs(instrument_group["y_pos"][()]) <= 60:
@@ -62,8 +62,8 @@ def edx_get_measurement_from_hdf5(edx_group, target_x, target_y):
     position_group = get_target_position_group(edx_group, target_x, target_y)
     measurement_group = position_group.get('measurement')
 
-    energy_array = measurement_group['energy'][()]
-    counts_array = measurement_group['counts'][()]
+    energy_array = read_hdf5_dataset(measurement_group['energy'])
+    counts_array = read_hdf5_dataset(measurement_group['counts'])
 
     spectrum_dataframe = pd.DataFrame({"Energy (keV)": energy_array, "Counts": counts_array})
 
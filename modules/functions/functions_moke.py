@@ -10,7 +10,7 @@ def moke_conditions(hdf5_path, *args, **kwargs):
         return False
     if not h5py.is_hdf5(hdf5_path):
         return False
-    with h5py.File(hdf5_path, "r") as hdf5_file:
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
         dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="moke")
         if len(dataset_list) == 0:
             return False
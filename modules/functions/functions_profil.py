@@ -13,7 +13,7 @@ def profil_conditions(hdf5_path, *args, **kwargs):
         return False
     if not h5py.is_hdf5(hdf5_path):
         return False
-    with h5py.File(hdf5_path, "r") as hdf5_file:
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
         dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="profil")
         if len(dataset_list) == 0:
             return False
@@ -21,13 +21,13 @@ def profil_conditions(hdf5_path, *args, **kwargs):
 
 
 def profil_get_measurement_from_hdf5(profil_group, target_x, target_y):
-    for position, position_group in profil_group.items():
+    for position, position_group in get_position_groups(profil_group):
         instrument_group = position_group.get("instrument")
         if instrument_group["x_pos"][()] == target_x and instrument_group["y_pos"][()] == target_y:
             measurement_group = position_group.get("measurement")
 
-            distance_array = measurement_group["distance"][()]
-            profile_array = measurement_group["profile"][()]
+            distance_array = read_hdf5_dataset(measurement_group["distance"])
+            profile_array = read_hdf5_dataset(measurement_group["profile"])
 
             measurement_dataframe = pd.DataFrame({"distance_(um)": distance_array, "total_profile_(nm)": profile_array})
 
@@ -37,7 +37,7 @@ def profil_get_measurement_from_hdf5(profil_group, target_x, target_y):
 def profil_get_results_from_hdf5(profil_group, target_x, target_y):
     data_dict = {}
 
-    for position, position_group in profil_group.items():
+    for position, position_group in get_position_groups(profil_group):
         instrument_group = position_group.get("instrument")
         if instrument_group["x_pos"][()] == target_x and instrument_group["y_pos"][()] == target_y:
             results_group = position_group.get("results")
@@ -157,8 +157,8 @@ def profil_measurement_dataframe_fit_steps(df, n_steps, x0_guess):
 def profil_spot_fit_steps(position_group, nb_steps, x0):
     measurement_group = position_group.get("measurement")
 
-    distance_array = measurement_group["distance"][()]
-    profile_array = measurement_group["profile"][()]
+    distance_array = read_hdf5_dataset(measurement_group["distance"])
+    profile_array = read_hdf5_dataset(measurement_group["profile"])
 
     measurement_dataframe = pd.DataFrame({"distance_(um)": distance_array, "total_profile_(nm)": profile_array})
 
@@ -170,7 +170,7 @@ def profil_spot_fit_steps(position_group, nb_steps, x0):
 def profil_make_results_dataframe_from_hdf5(profil_group):
     data_dict_list = []
 
-    for position, position_group in profil_group.items():
+    for position, position_group in get_position_groups(profil_group):
         instrument_group = position_group.get("instrument")
         # Exclude spots outside the wafer
         if np.abs(instrument_group["x_pos"][()]) + np.abs(instrument_group["y_pos"][()]) <= 60:
@@ -352,9 +352,9 @@ ARCHIVE FOR POLYNOMIAL FIT, MIGHT COME BACK TO IT SOMEDAY
 #     if not check_for_profil(hdf5_path):
 #         raise KeyError("Profilometry not found in file. Please check your file")
 #
-#     with h5py.File(hdf5_path, mode="a") as hdf5_file:
+#     with open_hdf5(hdf5_path, mode="a") as hdf5_file:
 #         profil_group = hdf5_file["/profil"]
-#         for position, position_group in profil_group.items():
+#         for position, position_group in get_position_groups(profil_group):
 #             measurement_group = position_group.get("measurement")
 #
 #             distance_array = measurement_group["distance"][()]
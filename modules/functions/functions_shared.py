@@ -6,10 +6,26 @@ import plotly.graph_objects as go
 from pathlib import Path
 import h5py
 import shutil
+import stat
+import uuid
 from dash.exceptions import PreventUpdate
+import atexit
 import functools
+import hashlib
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 from plotly.subplots import make_subplots
-from dash import Input, Output, State, ctx
+from dash import Input, Output, State, ctx, set_props
 from datetime import datetime
 import re
 import stringcase
@@ -23,8 +39,34 @@ def check_conditions(conditions_function, hdf5_path_index):
             args = list(args)
             args[hdf5_path_index] = Path(args[hdf5_path_index])
             hdf5_path = args[hdf5_path_index]
-            if not conditions_function(hdf5_path, *args, **kwargs):
+            try:
+                if not conditions_function(hdf5_path, *args, **kwargs):
+                    raise PreventUpdate
+                outputs = callback_function(*args, **kwargs)
+            except HDF5BusyError as error:
+                # The file is being written by another user, the outputs are kept and the wait is reported
+                set_props(HDF5_BUSY_COMPONENT, {"children": str(error)})
                 raise PreventUpdate
+            set_props(HDF5_BUSY_COMPONENT, {"children": None})
+            return outputs
+
+        return wrapper
+
+    return decorator
+
+
+# Decorator function deferring the loading of a file in a technique tab until the tab is opened. The callback runs when
+# a file is selected while the tab is open, or when the tab is opened after another file was selected.
+def defer_to_tab(tab_value, active_tab_index, loaded_path_index, hdf5_path_index=0):
+    def decorator(callback_function):
+        @functools.wraps(callback_function)
+        def wrapper(*args, **kwargs):
+            if args[active_tab_index] != tab_value:
+                raise PreventUpdate
+            hdf5_path, loaded_path = args[hdf5_path_index], args[loaded_path_index]
+            if ctx.triggered_id == "tabs" and hdf5_path is not None and loaded_path is not None:
+                if Path(loaded_path) == Path(hdf5_path):
+                    raise PreventUpdate
             return callback_function(*args, **kwargs)
 
         return wrapper
@@ -140,10 +182,375 @@ def detect_measurement(filename_list: list):
     return None
 
 
+# File creation and access profile of the sample files, made of tens of thousands of small groups and datasets:
+# - libver: the v108 lower bound stores the links of small groups compactly in their object header and switches
+#   large groups (hundreds of positions) to indexed storage (fractal heap and B-tree name index)
+# - fs_strategy "page": metadata and raw data are aggregated in fs_page_size pages, read through the page buffer
+# - meta_block_size: small metadata objects are allocated together instead of scattered between datasets
+# - mdc_*: metadata cache of every opened file, sized for full walks of the file tree
+# - swmr: files opened read-only are opened as SWMR readers, which see a consistent file while it is extended
+HDF5_FILE_PROFILE = {
+    "libver": ("v108", "latest"),
+    "fs_strategy": "page",
+    "fs_persist": True,
+    "fs_page_size": 64 * 1024,
+    "page_buf_size": 16 * 1024 ** 2,
+    "meta_block_size": 64 * 1024,
+    "rdcc_nbytes": 16 * 1024 ** 2,
+    "mdc_initial_size_mb": 16,
+    "mdc_max_size_mb": 64,
+    "swmr": True,
+}
+
+HDF5_CREATION_KEYS = ["fs_strategy", "fs_persist", "fs_page_size"]
+
+
+# Root attribute counting the writes to a sample file (see open_hdf5), derived data are cached against it
+HDF5_GENERATION_ATTR = "HT_generation"
+# Root attribute identifying a sample file, set at its first write so that a file replaced by another with the same
+# generation, size and modification time is not mistaken for it
+HDF5_FILE_ID_ATTR = "HT_file_id"
+# Time a callback waits for a file locked by another user before giving up (s)
+HDF5_LOCK_TIMEOUT_S = 10
+# Component of the main layout where the callbacks report the files they could not access
+HDF5_BUSY_COMPONENT = "hdf5_busy_message"
+# Locks held by the current thread, by absolute path, so that nested open_hdf5 calls do not wait for themselves
+_HDF5_HELD_LOCKS = threading.local()
+
+
+class HDF5BusyError(TimeoutError):
+    """The sample file stayed locked by another user longer than the lock timeout."""
+
+
+def get_hdf5_lock_path(hdf5_path):
+    folder, name = os.path.split(os.path.abspath(hdf5_path))
+    return os.path.join(folder, f".{name}.lock")
+
+
+def _try_lock(lock_file, exclusive):
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        else:
+            # msvcrt only has exclusive locks, readers also wait for each other
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def hdf5_file_lock(hdf5_path, exclusive=False, timeout_s=None):
+    """
+    Reader/writer lock of a sample file, shared by the threads and processes of every DaHU server using the file: any
+    number of readers, or one writer. The lock is taken on a hidden .lock file next to the sample file, files in
+    read-only folders are not locked. A thread that already holds the lock of a file enters it again without waiting.
+
+    Parameters:
+        hdf5_path (str or pathlib.Path): path to the HDF5 file
+        exclusive (bool): writer lock
+        timeout_s (float): time to wait for the lock (s), defaults to HDF5_LOCK_TIMEOUT_S
+
+    Raises:
+        HDF5BusyError: the lock could not be taken within timeout_s
+    """
+    if timeout_s is None:
+        timeout_s = HDF5_LOCK_TIMEOUT_S
+    key = os.path.abspath(hdf5_path)
+    held_locks = _HDF5_HELD_LOCKS.__dict__.setdefault("paths", {})
+    if key in held_locks:
+        held_locks[key] += 1
+        try:
+            yield
+        finally:
+            held_locks[key] -= 1
+        return
+
+    try:
+        lock_file = open(get_hdf5_lock_path(key), "a+b")
+    except OSError:
+        yield
+        return
+
+    try:
+        deadline = time.monotonic() + timeout_s
+        while not _try_lock(lock_file, exclusive):
+            if time.monotonic() > deadline:
+                raise HDF5BusyError(f"{os.path.basename(key)} has been in use by another user for more than "
+                                    f"{timeout_s:g} s, try again in a moment")
+            time.sleep(0.05)
+
+        held_locks[key] = 1
+        try:
+            yield
+        finally:
+            del held_locks[key]
+            _unlock(lock_file)
+    finally:
+        lock_file.close()
+
+
+# In-memory working copies of sample files (see open_hdf5_session), by absolute path
+HDF5_SESSIONS = {}
+# Period of the automatic flush of modified working copies to disk (s)
+HDF5_SESSION_FLUSH_S = 60
+# Working copies are private to a process, multi-worker servers disable them (see wsgi.py)
+HDF5_SESSIONS_ENABLED = True
+# Largest file loaded in memory as a working copy (MB)
+HDF5_SESSION_MAX_SIZE_MB = 2048
+
+
+class HDF5SessionConflictError(RuntimeError):
+    """The sample file was written on disk since its working copy was loaded, saving the copy would erase it."""
+
+
+def get_hdf5_disk_signature(hdf5_path):
+    """
+    Modification time, size and write generation (see open_hdf5) of a file on disk, to detect writes made outside
+    of a working copy. Call it with the lock of the file held.
+
+    Parameters:
+        hdf5_path (str or pathlib.Path): path to the HDF5 file
+
+    Returns:
+        tuple: modification time (ns), size (bytes) and generation, None for files written before generations
+    """
+    file_stat = os.stat(hdf5_path)
+    # The HDF5 library lock would conflict with the working copy of the same file, hdf5_file_lock covers the read
+    with h5py.File(hdf5_path, "r", locking=False) as hdf5_file:
+        generation = hdf5_file.attrs.get(HDF5_GENERATION_ATTR, None)
+    return file_stat.st_mtime_ns, file_stat.st_size, None if generation is None else int(generation)
+
+
+def open_hdf5_session(hdf5_path, flush_period_s=HDF5_SESSION_FLUSH_S):
+    """
+    Load a sample file in memory (HDF5 core driver): until close_hdf5_session, open_hdf5 serves this working copy,
+    so that bursts of interactive edits (ignore flags, manual results, refits) do not touch the disk. Modified copies
+    are written back every flush_period_s seconds by a background thread, or with flush_hdf5_session.
+
+    Parameters:
+        hdf5_path (str or pathlib.Path): path to the HDF5 file
+        flush_period_s (float): period of the automatic flush (s), None to flush only explicitly
+
+    Returns:
+        dict: the session (file, lock, dirty flag, generation counter of the edits, signature of the file on disk)
+
+    Raises:
+        RuntimeError: working copies are disabled (HDF5_SESSIONS_ENABLED) or the file is larger than
+            HDF5_SESSION_MAX_SIZE_MB
+    """
+    if not HDF5_SESSIONS_ENABLED:
+        raise RuntimeError("In-memory editing is not available when the app is served by several workers")
+    key = os.path.abspath(hdf5_path)
+    if key in HDF5_SESSIONS:
+        return HDF5_SESSIONS[key]
+
+    file_size_mb = os.path.getsize(key) / 1024 ** 2
+    if file_size_mb > HDF5_SESSION_MAX_SIZE_MB:
+        raise RuntimeError(f"{os.path.basename(key)} ({file_size_mb:.0f} MB) is too large to be edited in memory, "
+                           f"the limit is {HDF5_SESSION_MAX_SIZE_MB} MB")
+
+    with hdf5_file_lock(key):
+        disk_signature = get_hdf5_disk_signature(key)
+        hdf5_file = h5py.File(key, "r+", driver="core", backing_store=False, libver=HDF5_FILE_PROFILE["libver"])
+    session = {"file": hdf5_file, "lock": threading.RLock(), "dirty": False, "generation": 0,
+               "stop": threading.Event(), "disk_signature": disk_signature}
+    HDF5_SESSIONS[key] = session
+
+    if flush_period_s is not None:
+        def periodic_flush():
+            while not session["stop"].wait(flush_period_s):
+                try:
+                    flush_hdf5_session(key)
+                except (HDF5BusyError, HDF5SessionConflictError):
+                    # Retried at the next period, conflicts are reported by the save and close callbacks
+                    continue
+
+        threading.Thread(target=periodic_flush, name=f"flush {os.path.basename(key)}", daemon=True).start()
+
+    return session
+
+
+def flush_hdf5_session(hdf5_path):
+    """
+    Write the working copy of a file back to disk if it was modified. The image is written to a temporary file next
+    to the target, then renamed over it under the writer lock, so the file on disk is never left half written.
+    The copy is not written if the file on disk changed since it was loaded or last written back.
+
+    Parameters:
+        hdf5_path (str or pathlib.Path): path to the HDF5 file
+
+    Returns:
+        bool: True if the file has been written
+
+    Raises:
+        HDF5BusyError: the file is used by another user for longer than HDF5_LOCK_TIMEOUT_S
+        HDF5SessionConflictError: the file was written on disk since the working copy was loaded
+    """
+    session = HDF5_SESSIONS.get(os.path.abspath(hdf5_path))
+    if session is None:
+        return False
+
+    with session["lock"]:
+        if not session["dirty"]:
+            return False
+        hdf5_file = session["file"]
+        hdf5_file.flush()
+        file_image = hdf5_file.id.get_file_image()
+
+        with hdf5_file_lock(hdf5_file.filename, exclusive=True):
+            if get_hdf5_disk_signature(hdf5_file.filename) != session["disk_signature"]:
+                raise HDF5SessionConflictError(
+                    f"{os.path.basename(hdf5_file.filename)} was modified on disk since it was loaded in memory, "
+                    f"the in-memory changes were not saved"
+                )
+
+            folder, name = os.path.split(hdf5_file.filename)
+            temp_fd, temp_path = tempfile.mkstemp(dir=folder, prefix=f".{name}.", suffix=".tmp")
+            try:
+                with os.fdopen(temp_fd, "wb") as temp_file:
+                    temp_file.write(file_image)
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                os.replace(temp_path, hdf5_file.filename)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            session["disk_signature"] = get_hdf5_disk_signature(hdf5_file.filename)
+        session["dirty"] = False
+
+    return True
+
+
+def close_hdf5_session(hdf5_path, flush=True):
+    """
+    Stop serving a file from memory, writing the working copy back to disk first unless flush is False. If the copy
+    cannot be written, the session stays open.
+
+    Parameters:
+        hdf5_path (str or pathlib.Path): path to the HDF5 file
+        flush (bool): write the pending edits to disk
+
+    Returns:
+        bool: True if a session was open
+
+    Raises:
+        HDF5BusyError, HDF5SessionConflictError: see flush_hdf5_session
+    """
+    key = os.path.abspath(hdf5_path)
+    session = HDF5_SESSIONS.get(key)
+    if session is None:
+        return False
+
+    with session["lock"]:
+        if flush:
+            flush_hdf5_session(key)
+        session["stop"].set()
+        session["file"].close()
+        del HDF5_SESSIONS[key]
+
+    return True
+
+
+@atexit.register
+def close_all_hdf5_sessions():
+    for key in list(HDF5_SESSIONS.keys()):
+        try:
+            close_hdf5_session(key)
+        except (HDF5BusyError, HDF5SessionConflictError) as error:
+            print(f"Discarding the in-memory changes of {key}: {error}")
+            close_hdf5_session(key, flush=False)
+
+
+@contextmanager
+def open_hdf5(hdf5_path, mode="r", profile=None):
+    """
+    Open an HDF5 sample file with the creation and access settings of a profile. File creation settings only apply
+    when the file is created, files written with other settings are opened as they are. Files with an open session
+    (see open_hdf5_session) are served from memory, one caller at a time. Other files are locked for the time they are
+    open (see hdf5_file_lock): shared in "r" mode, exclusive in the write modes. Every write mode opening increments
+    the HDF5_GENERATION_ATTR attribute of the file, and sets its HDF5_FILE_ID_ATTR identifier if it has none.
+
+    Parameters:
+        hdf5_path (str or pathlib.Path): path to the HDF5 file
+        mode (str): h5py file mode ("r", "r+", "a", "w", "x")
+        profile (dict): settings, defaults to HDF5_FILE_PROFILE
+
+    Yields:
+        h5py.File: the opened file, closed when leaving the context
+
+    Raises:
+        HDF5BusyError: the file is used by another user for longer than HDF5_LOCK_TIMEOUT_S
+    """
+    session = HDF5_SESSIONS.get(os.path.abspath(hdf5_path))
+    if session is not None and mode in ["r", "r+", "a"]:
+        # Same lock order as flush_hdf5_session: session, then file
+        with session["lock"], hdf5_file_lock(hdf5_path, exclusive=mode != "r"):
+            if mode != "r":
+                session["dirty"] = True
+                session["generation"] += 1
+                # Flushed copies invalidate the data cached by the other processes
+                session["file"].attrs[HDF5_GENERATION_ATTR] = session["file"].attrs.get(HDF5_GENERATION_ATTR, 0) + 1
+                if HDF5_FILE_ID_ATTR not in session["file"].attrs:
+                    session["file"].attrs[HDF5_FILE_ID_ATTR] = uuid.uuid4().hex
+            yield session["file"]
+        return
+
+    if profile is None:
+        profile = HDF5_FILE_PROFILE
+
+    file_kwargs = {key: value for key, value in profile.items() if not key.startswith("mdc_")}
+    if mode == "a" and not os.path.exists(hdf5_path):
+        mode = "x"
+    if mode not in ["w", "w-", "x"]:
+        for key in HDF5_CREATION_KEYS:
+            file_kwargs.pop(key, None)
+    if mode == "r":
+        file_kwargs.pop("libver", None)
+    else:
+        file_kwargs.pop("swmr", None)
+
+    with hdf5_file_lock(hdf5_path, exclusive=mode != "r"):
+        try:
+            hdf5_file = h5py.File(hdf5_path, mode, **file_kwargs)
+        except OSError:
+            # Files that cannot be read as SWMR are read as usual
+            if not file_kwargs.pop("swmr", False):
+                raise
+            hdf5_file = h5py.File(hdf5_path, mode, **file_kwargs)
+
+        with hdf5_file:
+            if "mdc_initial_size_mb" in profile:
+                mdc_config = hdf5_file.id.get_mdc_config()
+                mdc_config.set_initial_size = True
+                mdc_config.initial_size = int(profile["mdc_initial_size_mb"] * 1024 ** 2)
+                mdc_max_size = int(profile.get("mdc_max_size_mb", 0) * 1024 ** 2)
+                mdc_config.max_size = max(mdc_config.initial_size, mdc_max_size)
+                mdc_config.min_size = min(mdc_config.min_size, mdc_config.initial_size)
+                hdf5_file.id.set_mdc_config(mdc_config)
+            try:
+                yield hdf5_file
+            finally:
+                if mode != "r":
+                    hdf5_file.attrs[HDF5_GENERATION_ATTR] = hdf5_file.attrs.get(HDF5_GENERATION_ATTR, 0) + 1
+                    if HDF5_FILE_ID_ATTR not in hdf5_file.attrs:
+                        hdf5_file.attrs[HDF5_FILE_ID_ATTR] = uuid.uuid4().hex
+
+
 def get_sample_info_from_hdf5(hdf5_path):
     info_dict = {}
 
-    with h5py.File(hdf5_path, "r") as f:
+    with open_hdf5(hdf5_path, "r") as f:
         sample_group = f["/sample"]
 
         info_dict["sample_name"] = sample_group["sample_name"][()]
@@ -460,8 +867,397 @@ def make_heatmap_from_dataframe(
     return fig
 
 
+def get_position_groups(dataset_group):
+    """
+    Iterate over the position groups of a dataset, skipping dataset-level groups (alignment scans, scan parameters...)
+
+    Parameters:
+        dataset_group (h5py.Group): dataset group (edx, moke, xrd, profil...)
+
+    Yields:
+        tuple: position name and position group (h5py.Group)
+    """
+    for position, position_group in dataset_group.items():
+        if isinstance(position_group, h5py.Group) and "instrument" in position_group:
+            yield position, position_group
+
+
+COMMON_METADATA_GROUP = "common_metadata"
+
+
+def get_position_metadata_item(position_group, path):
+    """
+    Instrument metadata item of a position, looked up in the instrument group of the position, then in the
+    common_metadata group of the dataset
+
+    Parameters:
+        position_group (h5py.Group): position group
+        path (str): path relative to the instrument group, e.g. "hardware/XG_WAVE_LENGTH_ALPHA1"
+
+    Returns:
+        h5py.Dataset or h5py.Group: the item, None if not found
+    """
+    item = position_group.get(f"instrument/{path}")
+    if item is None:
+        item = position_group.parent.get(f"{COMMON_METADATA_GROUP}/{path}")
+    return item
+
+
+def get_source_signature(hdf5_group):
+    """
+    Signature of the file holding an HDF5 group, changes whenever the file is written to or replaced by another one.
+
+    Parameters:
+        hdf5_group (h5py.Group): group from an opened HDF5 file
+
+    Returns:
+        tuple: identifier and write generation of the file (see open_hdf5), None for files never written by DaHU,
+        its modification time (ns) and size
+    """
+    session = HDF5_SESSIONS.get(os.path.abspath(hdf5_group.file.filename))
+    if session is not None and session["file"] == hdf5_group.file:
+        # Working copies change in memory only, their edits are counted instead
+        return "session", session["generation"]
+
+    file_id = hdf5_group.file.attrs.get(HDF5_FILE_ID_ATTR, None)
+    generation = hdf5_group.file.attrs.get(HDF5_GENERATION_ATTR, None)
+    file_stat = os.stat(hdf5_group.file.filename)
+    return (None if file_id is None else str(file_id), None if generation is None else int(generation),
+            file_stat.st_mtime_ns, file_stat.st_size)
+
+
+DERIVED_CACHE = {}
+DERIVED_CACHE_SIZE = 16
+
+# Folder of the derived data cache shared by the processes of a multi-worker server (see wsgi.py), None to keep the
+# cache in each process only. Entries are pickled, the folder must be private to the server user (see
+# check_shared_cache_folder).
+SHARED_CACHE_FOLDER = os.environ.get("DAHU_CACHE_DIR")
+# Size of the shared cache, the least recently used entries are removed beyond it (MB)
+SHARED_CACHE_SIZE_MB = 1024
+# Folders that passed check_shared_cache_folder in this process
+_SHARED_CACHE_CHECKED = set()
+
+
+def check_shared_cache_folder(folder=None):
+    """
+    Create the shared cache folder if needed and check that only the server user can use it: loading a pickle runs
+    code, a cache entry planted by another user would run as the server. The folder must be a directory, not a link,
+    owned by the user running the server and with mode 0700. Windows folders are not checked, the default temporary
+    directory is already private to each user there.
+
+    Parameters:
+        folder (str): folder to check, defaults to SHARED_CACHE_FOLDER
+
+    Raises:
+        PermissionError: the folder is not private to the server user
+    """
+    if folder is None:
+        folder = SHARED_CACHE_FOLDER
+    if folder in _SHARED_CACHE_CHECKED:
+        return
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid"):
+        folder_stat = os.lstat(folder)
+        if (not stat.S_ISDIR(folder_stat.st_mode) or folder_stat.st_uid != os.getuid()
+                or stat.S_IMODE(folder_stat.st_mode) != 0o700):
+            raise PermissionError(f"The shared cache folder {folder} must be a directory owned by the server user "
+                                  f"with mode 0700, fix it (chmod 700) or set DAHU_CACHE_DIR to another folder")
+    _SHARED_CACHE_CHECKED.add(folder)
+
+
+def get_shared_cache_path(key, signature):
+    """
+    File of the shared cache holding a derived quantity. The signature of the source is part of the name, entries
+    of previous versions of a file are never read again and are removed by prune_shared_cache.
+
+    Parameters:
+        key (tuple): file, group, tag and arguments of the derived quantity (see get_cached_derived)
+        signature (tuple): signature of the source file (see get_source_signature)
+
+    Returns:
+        str: path to the cache file
+    """
+    digest = hashlib.sha1(repr((key, signature)).encode()).hexdigest()
+    return os.path.join(SHARED_CACHE_FOLDER, f"{digest}.pkl")
+
+
+def read_shared_cache(cache_path):
+    try:
+        with open(cache_path, "rb") as cache_file:
+            result = pickle.load(cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None, False
+    # Modification time orders the entries for prune_shared_cache
+    os.utime(cache_path)
+    return result, True
+
+
+def write_shared_cache(cache_path, result):
+    """
+    Store a derived quantity in the shared cache. The entry is written to a temporary file then renamed, so that
+    other processes never read it half written. Quantities that cannot be pickled are not stored.
+
+    Parameters:
+        cache_path (str): path to the cache file (see get_shared_cache_path)
+        result: the derived quantity
+    """
+    temp_fd, temp_path = tempfile.mkstemp(dir=SHARED_CACHE_FOLDER, suffix=".tmp")
+    try:
+        with os.fdopen(temp_fd, "wb") as temp_file:
+            pickle.dump(result, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        cleanup_file(temp_path)
+        return
+    prune_shared_cache()
+
+
+def prune_shared_cache(size_mb=None):
+    """
+    Remove the least recently used entries of the shared cache until it fits in size_mb.
+
+    Parameters:
+        size_mb (float): size of the cache (MB), defaults to SHARED_CACHE_SIZE_MB
+    """
+    if size_mb is None:
+        size_mb = SHARED_CACHE_SIZE_MB
+    entries = []
+    with os.scandir(SHARED_CACHE_FOLDER) as scan:
+        for entry in scan:
+            if entry.name.endswith(".pkl"):
+                try:
+                    entry_stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+    total_size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, entry_path in sorted(entries):
+        if total_size <= size_mb * 1024 ** 2:
+            break
+        cleanup_file(entry_path)
+        total_size -= entry_size
+
+
+def get_cached_derived(hdf5_group, tag, builder, *args, **kwargs):
+    """
+    Return data derived from an HDF5 group, computing it with builder(hdf5_group, *args, **kwargs) only if the
+    source file changed since the last call. Results are kept in memory for the DERIVED_CACHE_SIZE latest calls and,
+    if SHARED_CACHE_FOLDER is set, on disk for the other server processes.
+
+    Parameters:
+        hdf5_group (h5py.Group): source group passed to the builder
+        tag (str): name of the derived quantity, used in the cache key
+        builder (callable): function computing the derived data from the group
+
+    Returns:
+        the (possibly cached) output of builder
+
+    Raises:
+        PermissionError: SHARED_CACHE_FOLDER is not private to the server user (see check_shared_cache_folder)
+    """
+    key = (os.path.abspath(hdf5_group.file.filename), hdf5_group.name, tag, repr(args), repr(sorted(kwargs.items())))
+    signature = get_source_signature(hdf5_group)
+
+    if key in DERIVED_CACHE and DERIVED_CACHE[key][0] == signature:
+        return DERIVED_CACHE[key][1]
+
+    # In-memory working copies are private to this process, their derived data are not shared
+    cache_path = None
+    if SHARED_CACHE_FOLDER is not None and signature[0] != "session":
+        check_shared_cache_folder()
+        cache_path = get_shared_cache_path(key, signature)
+
+    found = False
+    if cache_path is not None:
+        result, found = read_shared_cache(cache_path)
+    if not found:
+        result = builder(hdf5_group, *args, **kwargs)
+        if cache_path is not None:
+            write_shared_cache(cache_path, result)
+
+    DERIVED_CACHE.pop(key, None)
+    DERIVED_CACHE[key] = (signature, result)
+    # Drop the oldest entries, dictionaries keep insertion order
+    while len(DERIVED_CACHE) > DERIVED_CACHE_SIZE:
+        DERIVED_CACHE.pop(next(iter(DERIVED_CACHE)))
+
+    return result
+
+
+# Size from which contiguous datasets are memory mapped instead of read (see read_hdf5_dataset)
+MEMMAP_MIN_KB = 64
+
+
+def get_hdf5_memmap(dataset):
+    """
+    Map a dataset stored contiguous and unfiltered in its file as a read-only NumPy memmap, so that repeated reads
+    are served from the page cache without allocating and copying the array.
+
+    Parameters:
+        dataset (h5py.Dataset): dataset of a file opened with the default (sec2) driver
+
+    Returns:
+        np.memmap: the mapped dataset, None if it is chunked, compressed, virtual, external, not numeric, smaller
+        than MEMMAP_MIN_KB or not yet allocated in the file
+    """
+    if dataset.chunks is not None or dataset.is_virtual or dataset.external is not None:
+        return None
+    if dataset.dtype.kind not in "biufc" or dataset.nbytes < MEMMAP_MIN_KB * 1024:
+        return None
+    if dataset.file.driver != "sec2":
+        return None
+
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+
+    return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode="r", offset=offset, shape=dataset.shape)
+
+
+def read_hdf5_dataset(dataset, selection=()):
+    """
+    Read dataset[selection], through a memory map of the file when the dataset allows it (see get_hdf5_memmap),
+    with a regular h5py read otherwise. Mapped arrays are read-only.
+
+    Parameters:
+        dataset (h5py.Dataset): dataset to read
+        selection: index or slices, () for the whole dataset
+
+    Returns:
+        np.ndarray: the selected data
+    """
+    mapped_array = get_hdf5_memmap(dataset)
+    if mapped_array is None:
+        return dataset[selection]
+    return mapped_array[selection]
+
+
+def start_process_pool(n_workers):
+    """
+    Start a pool of worker processes, all the workers are running when it returns. Call it while no HDF5 file is open
+    in the current process: forked workers would inherit the open files of the HDF5 library.
+
+    Parameters:
+        n_workers (int): number of worker processes
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: the pool, to shut down after use
+    """
+    executor = ProcessPoolExecutor(max_workers=n_workers)
+    # The first job starts all the workers of a fork pool, other start methods start them from a clean interpreter
+    executor.submit(int).result()
+    return executor
+
+
+HDF5_MEMORY_BUDGET_MB = 256
+
+
+def iterate_dataset_chunks(dataset, memory_budget_mb=HDF5_MEMORY_BUDGET_MB, work_itemsize=0, n_copies=0):
+    """
+    Read a dataset block by block along its first axis (frames for detector stacks), every block fitting in the
+    memory budget. Blocks are aligned on the dataset chunks so that no chunk is decompressed twice. Works the same
+    on regular datasets, external links and virtual datasets.
+
+    Parameters:
+        dataset (h5py.Dataset): dataset with at least one dimension
+        memory_budget_mb (float): maximum memory used by a block and the arrays computed from it (MB)
+        work_itemsize (int): item size of the arrays the caller computes from every block (8 for float64)
+        n_copies (int): number of such arrays alive at the same time
+
+    Yields:
+        tuple: first and last (excluded) index of the block along the first axis, block array
+    """
+    n_frames = dataset.shape[0]
+    frame_bytes = max(1, int(np.prod(dataset.shape[1:])) * (dataset.dtype.itemsize + n_copies * work_itemsize))
+    block_frames = max(1, int(memory_budget_mb * 1024 ** 2 // frame_bytes))
+
+    if dataset.chunks is not None and block_frames >= dataset.chunks[0]:
+        block_frames -= block_frames % dataset.chunks[0]
+
+    for start in range(0, n_frames, block_frames):
+        stop = min(start + block_frames, n_frames)
+        yield start, stop, dataset[start:stop]
+
+
+def reduce_dataset_frames(dataset, reductions=("sum", "mean", "max", "variance"), roi=None,
+                          memory_budget_mb=HDF5_MEMORY_BUDGET_MB):
+    """
+    Running reductions over the frames (first axis) of a dataset, reading at most memory_budget_mb at a time.
+    Variance is accumulated with the parallel update of Chan et al., stable for long stacks.
+
+    Parameters:
+        dataset (h5py.Dataset): (n_frames, ...) dataset, a 2D image is treated as a single frame
+        reductions (tuple): among "sum", "mean", "min", "max", "variance" and "roi"
+        roi (np.array or tuple): boolean mask or tuple of slices selecting the pixels summed in every frame,
+            required for "roi"
+        memory_budget_mb (float): maximum memory used by a block and its float64 copies (MB)
+
+    Returns:
+        dict: reduction name -> frame-shaped array, "roi" gives the (n_frames,) ROI sums
+    """
+    if "roi" in reductions and roi is None:
+        raise ValueError("A ROI is needed for per-frame ROI sums.")
+
+    if dataset.ndim == 2:
+        image = dataset[()].astype(float)
+        blocks = [(0, 1, image[None, :, :])]
+        n_frames = 1
+    else:
+        # A block is converted to float64, then at most two float64 blocks are alive: the block and its deviations
+        blocks = iterate_dataset_chunks(dataset, memory_budget_mb, work_itemsize=np.dtype(float).itemsize, n_copies=2)
+        n_frames = dataset.shape[0]
+
+    count = 0
+    mean, m2 = None, None
+    results = {}
+    roi_sums = np.empty(n_frames)
+
+    for start, stop, block in blocks:
+        block = block.astype(float)
+        block_count = stop - start
+
+        if "min" in reductions:
+            block_min = block.min(axis=0)
+            results["min"] = block_min if "min" not in results else np.minimum(results["min"], block_min)
+        if "max" in reductions:
+            block_max = block.max(axis=0)
+            results["max"] = block_max if "max" not in results else np.maximum(results["max"], block_max)
+        if "roi" in reductions:
+            if isinstance(roi, tuple):
+                roi_sums[start:stop] = block[(slice(None),) + roi].reshape(block_count, -1).sum(axis=1)
+            else:
+                roi_sums[start:stop] = block[:, roi].sum(axis=1)
+
+        block_mean = block.mean(axis=0)
+        deviation = block - block_mean
+        np.square(deviation, out=deviation)
+        block_m2 = deviation.sum(axis=0)
+        del deviation
+        if mean is None:
+            mean, m2 = block_mean, block_m2
+        else:
+            delta = block_mean - mean
+            total = count + block_count
+            mean = mean + delta * block_count / total
+            m2 = m2 + block_m2 + delta ** 2 * count * block_count / total
+        count += block_count
+
+    if "sum" in reductions:
+        results["sum"] = mean * count
+    if "mean" in reductions:
+        results["mean"] = mean
+    if "variance" in reductions:
+        results["variance"] = m2 / count
+    if "roi" in reductions:
+        results["roi"] = roi_sums
+
+    return results
+
+
 def check_group_for_results(hdf5_group):
-    for position, position_group in hdf5_group.items():
+    for position, position_group in get_position_groups(hdf5_group):
         if "results" not in position_group:
             return False
     return True
@@ -497,7 +1293,7 @@ def save_dict_to_hdf5(hdf5_group, results_dict):
 
 
 def get_target_position_group(measurement_group, target_x, target_y):
-    for position, position_group in measurement_group.items():
+    for position, position_group in get_position_groups(measurement_group):
         instrument_group = position_group.get("instrument")
         if (
             instrument_group["x_pos"][()] == target_x
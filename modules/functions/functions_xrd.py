@@ -7,6 +7,14 @@ Internal use for Institut Néel and within the MaMMoS project, to export and rea
 
 import plotly.express as px
 from itertools import cycle
+import json
+from scipy.linalg import cho_solve_banded, cholesky_banded, solveh_banded
+from scipy.ndimage import minimum_filter1d, uniform_filter1d
+from scipy.optimize import curve_fit
+from scipy.sparse import csr_matrix
+from scipy.signal import find_peaks
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import MiniBatchNMF
 
 from ..functions.functions_shared import *
 
@@ -16,25 +24,28 @@ def xrd_conditions(hdf5_path, *args, **kwargs):
         return False
     if not h5py.is_hdf5(hdf5_path):
         return False
-    with h5py.File(hdf5_path, "r") as hdf5_file:
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
         dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="xrd")
         if len(dataset_list) == 0:
             return False
     return True
 
 
-def xrd_get_integrated_from_hdf5(xrd_group, target_x, target_y):
+def xrd_get_integrated_from_hdf5(xrd_group, target_x, target_y, source="integrated"):
     position_group = get_target_position_group(xrd_group, target_x, target_y)
     measurement_group = position_group.get("measurement")
 
-    if xrd_group.attrs["instrument"] == "bm02 - esrf":
+    if source == "reintegrated":
+        q_array, intensity_array = xrd_get_pattern_from_position(xrd_group, position_group, source=source)
+
+    elif xrd_group.attrs["instrument"] == "bm02 - esrf":
         integrated_group = measurement_group.get("CdTe_integrate")
-        q_array = integrated_group["q"][()]
-        intensity_array = integrated_group["intensity"][0]
+        q_array = read_hdf5_dataset(integrated_group["q"])
+        intensity_array = read_hdf5_dataset(integrated_group["intensity"], 0)
 
     elif xrd_group.attrs["instrument"] == "Rigaku Smartlab":
-        q_array = measurement_group["angle"][()]
-        intensity_array = measurement_group["counts"]
+        q_array = read_hdf5_dataset(measurement_group["angle"])
+        intensity_array = read_hdf5_dataset(measurement_group["counts"])
 
     else:
         raise KeyError(
@@ -51,10 +62,10 @@ def xrd_get_image_from_hdf5(xrd_group, target_x, target_y):
     measurement_group = position_group.get("measurement")
 
     if xrd_group.attrs["instrument"] == "bm02 - esrf":
-        image_array = measurement_group["CdTe"][0]
+        image_array = read_hdf5_dataset(measurement_group["CdTe"], 0)
 
     elif xrd_group.attrs["instrument"] == "Rigaku Smartlab":
-        image_array = measurement_group["2Dimage"]
+        image_array = read_hdf5_dataset(measurement_group["2Dimage"])
 
     else:
         raise KeyError(
@@ -84,14 +95,87 @@ def xrd_get_results_from_hdf5(xrd_group, target_x, target_y):
     return data_dict
 
 
+def xrd_parse_refinement_value(value):
+    """
+    Parse a refined value of a BGMN result file, such as "0.28705+-0.00012", "7.21%" or "UNDEF"
+
+    Parameters:
+        value (str or bytes): value as written in the .lst file
+
+    Returns:
+        tuple: value and uncertainty as floats (NaN if undefined or not given), None if the value is not numeric
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    value = str(value).strip().strip('"').rstrip("%")
+    if value.startswith("UNDEF"):
+        return np.nan, np.nan
+
+    value_str, _, uncertainty_str = value.partition("+-")
+    try:
+        parsed_value = float(value_str)
+    except ValueError:
+        return None
+    try:
+        uncertainty = float(uncertainty_str)
+    except ValueError:
+        uncertainty = np.nan
+
+    return parsed_value, uncertainty
+
+
+def xrd_read_refinement_value(value_dataset):
+    """
+    Read a refined value as float, typed files are read directly, string values of files written before
+    typed refinement results are parsed with xrd_parse_refinement_value
+    """
+    value = value_dataset[()]
+    if value_dataset.dtype.kind in "fiu":
+        return float(value)
+    parsed = xrd_parse_refinement_value(value)
+    return np.nan if parsed is None else parsed[0]
+
+
+def xrd_get_counters_from_position(position_group):
+    """
+    Read the beamline counters of an ESRF position (CdTe ROI and falconx scalar counters) without touching the
+    detector images or spectra. Counters recorded for every frame of the scan are averaged over the frames.
+
+    Parameters:
+        position_group (h5py.Group): ESRF position group
+
+    Returns:
+        dict: heatmap column name -> counter value
+    """
+    counters_dict = {}
+    measurement_group = position_group.get("measurement")
+    if measurement_group is None:
+        return counters_dict
+
+    for subname, subgroup in measurement_group.items():
+        if subname.startswith("CdTe_roi_"):
+            counter_type = "roi"
+        elif subname == "falconx":
+            counter_type = "falconx"
+        else:
+            continue
+
+        for counter, counter_dataset in subgroup.items():
+            # Only scalar or per-frame counters, spectra are left on disk
+            if not isinstance(counter_dataset, h5py.Dataset) or counter_dataset.ndim > 1:
+                continue
+            units = counter_dataset.attrs.get("units", "counts")
+            counters_dict[f"[{counter_type}]_{counter}_({units})"] = np.nanmean(counter_dataset[()])
+
+    return counters_dict
+
+
 def xrd_make_results_dataframe_from_hdf5(xrd_group):
     OPTIONS_LIST = ["A", "C", "phase_fraction", "Rwp"]
 
     data_dict_list = []
 
-    for position, position_group in xrd_group.items():
-        if position == "alignment_scans":
-            continue
+    for position, position_group in get_position_groups(xrd_group):
         instrument_group = position_group.get("instrument")
         # Exclude spots outside the wafer
         if (
@@ -112,20 +196,41 @@ def xrd_make_results_dataframe_from_hdf5(xrd_group):
                 for phase, phase_group in phases_group.items():
                     for value, value_group in phase_group.items():
                         if value in OPTIONS_LIST:
-                            dataset = str(value_group[()].decode())
                             if "units" in value_group.attrs:
                                 units = value_group.attrs["units"]
                             else:
                                 units = "arb"
 
-                            # Check if refined parameter is not UNDEF
-                            value_str = dataset.split("+")[0]
-                            if value_str == "UNDEF":
-                                dataset = np.nan
-                            else:
-                                dataset = float(value_str)
+                            data_dict[f"[{phase}]_{value}_({units})"] = xrd_read_refinement_value(value_group)
+                            if f"{value}_uncertainty" in phase_group:
+                                data_dict[f"[{phase}]_{value}_uncertainty_({units})"] = xrd_read_refinement_value(
+                                    phase_group[f"{value}_uncertainty"]
+                                )
 
-                            data_dict[f"[{phase}]_{value}_({units})"] = dataset
+            # Check in clustering for the phase clustering labels and weights
+            clustering_group = position_group.get("results/clustering")
+            if clustering_group is not None:
+                for value, value_group in clustering_group.items():
+                    units = value_group.attrs.get("units", "arb")
+                    data_dict[f"[clustering]_{value}_({units})"] = value_group[()]
+
+            # Check in xrf for the falconx element maps (ESRF only)
+            xrf_group = position_group.get("results/xrf")
+            if xrf_group is not None:
+                for value, value_group in xrf_group.items():
+                    units = value_group.attrs.get("units", "cps")
+                    data_dict[f"[xrf]_{value}_({units})"] = value_group[()]
+
+            # Check in measurement for the beamline ROI counters (ESRF only)
+            data_dict.update(xrd_get_counters_from_position(position_group))
+
+            # Check in peaks for the quick-look peak analysis
+            peaks_group = position_group.get("results/peaks")
+            if peaks_group is not None:
+                for peak, peak_group in peaks_group.items():
+                    for value, value_group in peak_group.items():
+                        units = value_group.attrs.get("units", "arb")
+                        data_dict[f"[{peak}]_{value}_({units})"] = value_group[()]
 
             data_dict_list.append(data_dict)
 
@@ -134,8 +239,7 @@ def xrd_make_results_dataframe_from_hdf5(xrd_group):
             if phases_group is not None:
                 for value, r_group in phases_group.items():
                     if value == "Rwp":
-                        rwp = float(str(r_group[()]).split("%")[0].replace("b'", ""))
-                        dataset = rwp
+                        dataset = xrd_read_refinement_value(r_group)
                         if "units" in r_group.attrs:
                             units = r_group.attrs["units"]
                         else:
@@ -147,6 +251,1139 @@ def xrd_make_results_dataframe_from_hdf5(xrd_group):
     return result_dataframe
 
 
+XRD_DEFAULT_WAVELENGTH = 1.540593  # Cu K-alpha1 in A, used if the Smartlab header has no wavelength
+
+
+def xrd_two_theta_to_q(two_theta_array, wavelength):
+    """
+    Convert scattering angles to scattering vector norms, q = 4pi sin(theta) / lambda
+
+    Parameters:
+        two_theta_array (np.array): 2theta angles in degrees
+        wavelength (float): X-ray wavelength in A
+
+    Returns:
+        np.array: q values in A-1
+    """
+    return 4 * np.pi * np.sin(np.radians(two_theta_array) / 2) / wavelength
+
+
+def xrd_get_wavelength_from_hdf5(position_group):
+    """
+    Read the K-alpha1 wavelength stored in the Smartlab hardware metadata of a position
+
+    Parameters:
+        position_group (h5py.Group): Smartlab position group
+
+    Returns:
+        float: wavelength in A, XRD_DEFAULT_WAVELENGTH if not found in the metadata
+    """
+    wavelength_dataset = get_position_metadata_item(position_group, "hardware/XG_WAVE_LENGTH_ALPHA1")
+    if wavelength_dataset is None:
+        return XRD_DEFAULT_WAVELENGTH
+
+    wavelength = wavelength_dataset[()]
+    if isinstance(wavelength, bytes):
+        wavelength = wavelength.decode()
+    return float(str(wavelength).strip('"'))
+
+
+def xrd_get_pattern_from_position(xrd_group, position_group, source="integrated"):
+    """
+    Read the integrated pattern of a position as q (A-1) and intensity arrays, whatever the instrument
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        position_group (h5py.Group): position group within xrd_group
+        source (str): "integrated" for the instrument patterns, "reintegrated" for the in-house integration
+            (see xrd_reintegrate_from_hdf5), averaged over the azimuthal bins
+
+    Returns:
+        tuple: q array (A-1) and intensity array
+    """
+    measurement_group = position_group.get("measurement")
+
+    if source == "reintegrated":
+        reintegrated_group = measurement_group.get("reintegrated")
+        if reintegrated_group is None:
+            raise KeyError("No reintegrated pattern found, run the azimuthal integration first.")
+        intensity_array = reintegrated_group["intensity"][()]
+        # Mean over the azimuthal bins, bins without any pixel are left out as the instrument patterns do
+        n_filled = np.sum(np.isfinite(intensity_array), axis=0)
+        filled = n_filled > 0
+        q_array = reintegrated_group["q"][()][filled]
+        intensity_array = np.nansum(intensity_array, axis=0)[filled] / n_filled[filled]
+
+    elif xrd_group.attrs["instrument"] == "bm02 - esrf":
+        integrated_group = measurement_group.get("CdTe_integrate")
+        q_array = read_hdf5_dataset(integrated_group["q"])
+        intensity_array = read_hdf5_dataset(integrated_group["intensity"], 0)
+        # pyFAI can integrate in nm-1, patterns are compared in A-1
+        q_units = str(integrated_group["q"].attrs.get("units", ""))
+        if q_units.startswith("nm") or q_units.startswith("1/nm"):
+            q_array = q_array / 10
+
+    elif xrd_group.attrs["instrument"] == "Rigaku Smartlab":
+        wavelength = xrd_get_wavelength_from_hdf5(position_group)
+        q_array = xrd_two_theta_to_q(read_hdf5_dataset(measurement_group["angle"]), wavelength)
+        intensity_array = read_hdf5_dataset(measurement_group["counts"])
+
+    else:
+        raise KeyError(
+            "XRD instrument is neither bm02 - esrf nor Rigaku Smartlab, can not retrieve integrated data."
+        )
+
+    return np.asarray(q_array, dtype=float), np.asarray(intensity_array, dtype=float)
+
+
+def xrd_make_common_q_grid(q_array_list, n_q=None):
+    """
+    Make a q grid covering the range shared by all patterns
+
+    Parameters:
+        q_array_list (list): list of q arrays, one for each pattern
+        n_q (int): number of points in the grid, defaults to the length of the longest pattern
+
+    Returns:
+        np.array: common q grid
+    """
+    q_min = max(np.nanmin(q_array) for q_array in q_array_list)
+    q_max = min(np.nanmax(q_array) for q_array in q_array_list)
+    if q_min >= q_max:
+        raise ValueError("XRD patterns do not share a common q range.")
+    if n_q is None:
+        n_q = max(len(q_array) for q_array in q_array_list)
+
+    return np.linspace(q_min, q_max, n_q)
+
+
+def xrd_interpolate_patterns(q_matrix, intensity_matrix, q_grid):
+    """
+    Linear interpolation of all patterns onto the same q grid at once. Every row is searched within its own q
+    values by shifting rows on a single increasing axis, so that one searchsorted call covers the whole matrix.
+
+    Parameters:
+        q_matrix (np.array): (n_patterns, n_points) q values, or a single (n_points,) q array shared by all patterns
+        intensity_matrix (np.array): (n_patterns, n_points) intensities
+        q_grid (np.array): (n_q,) target grid, within the q range of every pattern
+
+    Returns:
+        np.array: (n_patterns, n_q) interpolated intensities
+    """
+    intensity_matrix = np.atleast_2d(intensity_matrix)
+    n_patterns, n_points = intensity_matrix.shape
+    q_matrix = np.broadcast_to(q_matrix, intensity_matrix.shape)
+
+    # Make sure every row is sorted by increasing q
+    order = np.argsort(q_matrix, axis=1)
+    q_matrix = np.take_along_axis(q_matrix, order, axis=1)
+    intensity_matrix = np.take_along_axis(intensity_matrix, order, axis=1)
+
+    span = np.nanmax(q_matrix) - np.nanmin(q_matrix) + 1
+    offsets = np.arange(n_patterns)[:, np.newaxis] * span
+    q_flat = (q_matrix + offsets).ravel()
+    target_flat = (q_grid[np.newaxis, :] + offsets).ravel()
+
+    row_start = np.repeat(np.arange(n_patterns) * n_points, len(q_grid))
+    index = np.searchsorted(q_flat, target_flat) - row_start
+    index = np.clip(index, 1, n_points - 1) + row_start
+
+    q_low, q_high = q_flat[index - 1], q_flat[index]
+    weight = np.divide(target_flat - q_low, q_high - q_low, out=np.zeros_like(q_low), where=q_high != q_low)
+    intensity_flat = intensity_matrix.ravel()
+    interpolated = intensity_flat[index - 1] * (1 - weight) + intensity_flat[index] * weight
+
+    return interpolated.reshape(n_patterns, len(q_grid))
+
+
+def xrd_iterate_wafer_positions(xrd_group):
+    """
+    Iterate over the positions of an XRD dataset that lie on the wafer, with the row describing each of them in the
+    position dataframes of the dataset-wide analyses
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+
+    Yields:
+        tuple: position name, position group and position row (position, x_pos (mm), y_pos (mm), ignored)
+    """
+    for position, position_group in get_position_groups(xrd_group):
+        instrument_group = position_group.get("instrument")
+        x_pos, y_pos = instrument_group["x_pos"][()], instrument_group["y_pos"][()]
+        # Exclude spots outside the wafer
+        if np.abs(x_pos) + np.abs(y_pos) > 60:
+            continue
+        position_row = {
+            "position": position,
+            "x_pos (mm)": x_pos,
+            "y_pos (mm)": y_pos,
+            "ignored": position_group.attrs["ignored"],
+        }
+        yield position, position_group, position_row
+
+
+def xrd_make_pattern_matrix_from_hdf5(xrd_group, n_q=None, source="integrated"):
+    """
+    Read the integrated patterns of every position of an XRD dataset and resample them on a common q grid
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group (Smartlab or ESRF)
+        n_q (int): number of points of the common q grid, defaults to the length of the longest pattern
+        source (str): "integrated" or "reintegrated", see xrd_get_pattern_from_position
+
+    Returns:
+        tuple: position dataframe (one row per pattern), q grid (A-1) and (n_positions, n_q) intensity matrix
+    """
+    position_list, q_array_list, intensity_array_list = [], [], []
+
+    for position, position_group, position_row in xrd_iterate_wafer_positions(xrd_group):
+        q_array, intensity_array = xrd_get_pattern_from_position(xrd_group, position_group, source)
+        position_list.append(position_row)
+        q_array_list.append(q_array)
+        intensity_array_list.append(intensity_array)
+
+    if not position_list:
+        raise KeyError("No integrated patterns found in XRD dataset.")
+
+    position_dataframe = pd.DataFrame(position_list)
+    q_grid = xrd_make_common_q_grid(q_array_list, n_q)
+
+    # Patterns of a dataset usually share their sampling, interpolate them all in one go
+    lengths = {len(q_array) for q_array in q_array_list}
+    if len(lengths) == 1:
+        intensity_matrix = xrd_interpolate_patterns(
+            np.stack(q_array_list), np.stack(intensity_array_list), q_grid
+        )
+    else:
+        intensity_matrix = np.empty((len(q_array_list), len(q_grid)))
+        for idx, (q_array, intensity_array) in enumerate(zip(q_array_list, intensity_array_list)):
+            order = np.argsort(q_array)
+            intensity_matrix[idx] = np.interp(q_grid, q_array[order], intensity_array[order])
+
+    return position_dataframe, q_grid, intensity_matrix
+
+
+def xrd_get_pattern_matrix(xrd_group, n_q=None, source="integrated"):
+    """
+    Cached version of xrd_make_pattern_matrix_from_hdf5, rebuilt only when the HDF5 file changes
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group (Smartlab or ESRF)
+        n_q (int): number of points of the common q grid
+        source (str): "integrated" or "reintegrated", see xrd_get_pattern_from_position
+
+    Returns:
+        tuple: position dataframe, q grid (A-1) and (n_positions, n_q) intensity matrix
+    """
+    return get_cached_derived(
+        xrd_group, "pattern_matrix", xrd_make_pattern_matrix_from_hdf5, n_q=n_q, source=source
+    )
+
+
+def xrd_make_common_q_grid_from_hdf5(xrd_group, n_q=None, source="integrated"):
+    """
+    Make the common q grid of an XRD dataset while keeping a single pattern in memory at a time
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        n_q (int): number of points of the grid, defaults to the length of the longest pattern
+        source (str): "integrated" or "reintegrated", see xrd_get_pattern_from_position
+
+    Returns:
+        np.array: common q grid
+    """
+    q_ranges = []
+    max_length = 0
+    for position, position_group, _ in xrd_iterate_wafer_positions(xrd_group):
+        q_array, _ = xrd_get_pattern_from_position(xrd_group, position_group, source)
+        q_ranges.append(np.array([np.nanmin(q_array), np.nanmax(q_array)]))
+        max_length = max(max_length, len(q_array))
+
+    if not q_ranges:
+        raise KeyError("No integrated patterns found in XRD dataset.")
+
+    if n_q is None:
+        n_q = max_length
+
+    return xrd_make_common_q_grid(q_ranges, n_q)
+
+
+def xrd_iterate_pattern_chunks(xrd_group, q_grid, chunk_size=256, source="integrated"):
+    """
+    Read the patterns of an XRD dataset chunk by chunk, resampled on q_grid, so that at most chunk_size patterns
+    are in memory at once
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        q_grid (np.array): common q grid, see xrd_make_common_q_grid_from_hdf5
+        chunk_size (int): number of patterns per chunk
+        source (str): "integrated" or "reintegrated", see xrd_get_pattern_from_position
+
+    Yields:
+        tuple: position dataframe of the chunk and (n_chunk, n_q) intensity matrix
+    """
+    position_list, intensity_list = [], []
+
+    for position, position_group, position_row in xrd_iterate_wafer_positions(xrd_group):
+        q_array, intensity_array = xrd_get_pattern_from_position(xrd_group, position_group, source)
+        order = np.argsort(q_array)
+        position_list.append(position_row)
+        intensity_list.append(np.interp(q_grid, q_array[order], intensity_array[order]))
+
+        if len(position_list) == chunk_size:
+            yield pd.DataFrame(position_list), np.stack(intensity_list)
+            position_list, intensity_list = [], []
+
+    if position_list:
+        yield pd.DataFrame(position_list), np.stack(intensity_list)
+
+
+def xrd_prepare_patterns_for_clustering(intensity_matrix, background_method="als"):
+    """
+    Background subtraction, clipping of negative values and normalization of every pattern to its maximum,
+    so that patterns are compared by shape rather than by intensity
+
+    Parameters:
+        intensity_matrix (np.array): (n_patterns, n_q) intensities
+        background_method (str): background engine (see xrd_estimate_background), None to keep the background
+
+    Returns:
+        np.array: (n_patterns, n_q) prepared patterns
+    """
+    if background_method is not None:
+        intensity_matrix = intensity_matrix - xrd_estimate_background(intensity_matrix, method=background_method)
+    intensity_matrix = np.clip(np.nan_to_num(intensity_matrix), 0, None)
+
+    maximum = intensity_matrix.max(axis=1, keepdims=True)
+    return np.divide(intensity_matrix, maximum, out=np.zeros_like(intensity_matrix), where=maximum > 0)
+
+
+def xrd_cluster_patterns(xrd_group, method="kmeans", n_components=4, chunk_size=256, background_method="als",
+                         source="integrated", random_state=0):
+    """
+    Unsupervised phase clustering of the patterns of an XRD dataset. Patterns are streamed in chunks: a first pass
+    fits the model incrementally (partial_fit), a second one assigns every position, so memory stays bounded by
+    the chunk size whatever the number of positions.
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        method (str): "kmeans" (mini-batch k-means, one label per position)
+            or "nmf" (mini-batch non-negative matrix factorization, one weight per component and position)
+        n_components (int): number of clusters or components
+        chunk_size (int): number of patterns in memory at once, at least n_components (the last chunk can hold up to
+            n_components - 1 more)
+        background_method (str): background engine applied to every chunk, None to keep the background
+        source (str): "integrated" or "reintegrated", see xrd_get_pattern_from_position
+        random_state (int): seed for reproducible clustering
+
+    Returns:
+        tuple: position dataframe, q grid (A-1), (n_positions, n_components) weights (one-hot for kmeans)
+            and (n_components, n_q) component patterns
+    """
+    n_positions = sum(1 for _ in xrd_iterate_wafer_positions(xrd_group))
+    if n_positions < n_components:
+        raise ValueError(f"Cannot find {n_components} components in {n_positions} positions, "
+                         f"lower the number of components.")
+    chunk_size = max(chunk_size, n_components)
+    q_grid = xrd_make_common_q_grid_from_hdf5(xrd_group, source=source)
+
+    def iterate_chunks():
+        # k-means needs at least one sample per cluster in every partial fit, a short last chunk joins the previous one
+        previous_chunk = None
+        for position_dataframe, intensity_chunk in xrd_iterate_pattern_chunks(xrd_group, q_grid, chunk_size, source):
+            if previous_chunk is None:
+                previous_chunk = position_dataframe, intensity_chunk
+            elif len(intensity_chunk) < n_components:
+                previous_chunk = (pd.concat([previous_chunk[0], position_dataframe], ignore_index=True),
+                                  np.concatenate([previous_chunk[1], intensity_chunk]))
+            else:
+                yield previous_chunk
+                previous_chunk = position_dataframe, intensity_chunk
+        if previous_chunk is not None:
+            yield previous_chunk
+
+    if method == "kmeans":
+        model = MiniBatchKMeans(n_clusters=n_components, random_state=random_state, n_init=3)
+    elif method == "nmf":
+        model = MiniBatchNMF(n_components=n_components, random_state=random_state, init="nndsvda")
+    else:
+        raise KeyError(f"Unknown clustering method {method}, use kmeans or nmf.")
+
+    for _, intensity_chunk in iterate_chunks():
+        model.partial_fit(xrd_prepare_patterns_for_clustering(intensity_chunk, background_method))
+
+    position_dataframe_list, weights_list = [], []
+    for position_dataframe, intensity_chunk in iterate_chunks():
+        patterns = xrd_prepare_patterns_for_clustering(intensity_chunk, background_method)
+        if method == "kmeans":
+            weights_list.append(np.eye(n_components)[model.predict(patterns)])
+        else:
+            weights_list.append(model.transform(patterns))
+        position_dataframe_list.append(position_dataframe)
+
+    if method == "kmeans":
+        components = model.cluster_centers_
+    else:
+        components = model.components_
+
+    return (
+        pd.concat(position_dataframe_list, ignore_index=True),
+        q_grid,
+        np.concatenate(weights_list),
+        components,
+    )
+
+
+def xrd_get_clustering_components_from_hdf5(xrd_group):
+    """
+    Read the component patterns of the last phase clustering of an XRD dataset
+
+    Returns:
+        pandas.DataFrame: q column and one column per component
+    """
+    clustering_group = xrd_group.get("analysis/clustering")
+    if clustering_group is None:
+        raise KeyError("No clustering found for this dataset")
+
+    components_dict = {"q": clustering_group["q"][()]}
+    for idx, component in enumerate(clustering_group["components"][()]):
+        components_dict[f"component_{idx}"] = component
+
+    return pd.DataFrame(components_dict)
+
+
+# Main fluorescence line of each element (keV), K-alpha1 up to Mo and L-alpha1 above
+XRF_LINES = {
+    "Ti": 4.511, "V": 4.952, "Cr": 5.415, "Mn": 5.899, "Fe": 6.404, "Co": 6.930, "Ni": 7.478, "Cu": 8.048,
+    "Zn": 8.639, "Ga": 9.252, "Ge": 9.886, "Zr": 15.775, "Nb": 16.615, "Mo": 17.479, "Pd": 2.838, "Ag": 2.984,
+    "Pr": 5.034, "Nd": 5.230, "Sm": 5.636, "Gd": 6.057, "Tb": 6.273, "Dy": 6.495, "Hf": 7.899, "Ta": 8.146,
+    "W": 8.398, "Ir": 9.175, "Pt": 9.442, "Au": 9.713,
+}
+XRF_ENERGY_OFFSET = 0.0  # keV, energy of the first falconx channel
+XRF_ENERGY_GAIN = 0.01  # keV per falconx channel
+XRF_DEAD_TIME_UNITS = "%"  # units of the falconx dead time counters recorded without a units attribute
+
+
+def xrd_get_xrf_live_time(falconx_group, detector, n_frames):
+    """
+    Live time of every frame of a falconx detector, from the livetime counter if recorded, else from the real time
+    and the dead time. Falls back to 1 s per frame (no normalization) if no timing counter is found.
+    The dead time is read as a percentage or a fraction from its units attribute, XRF_DEAD_TIME_UNITS if missing.
+
+    Parameters:
+        falconx_group (h5py.Group): measurement/falconx group of an ESRF position
+        detector (str): name of the spectrum dataset, e.g. falconx_det0
+        n_frames (int): number of frames of the spectrum
+
+    Returns:
+        np.array: (n_frames,) live times in s
+    """
+    for counter in [f"{detector}_trigger_livetime", f"{detector}_livetime"]:
+        if counter in falconx_group:
+            return np.asarray(falconx_group[counter][()], dtype=float).reshape(-1)
+
+    if f"{detector}_realtime" in falconx_group and f"{detector}_deadtime" in falconx_group:
+        real_time = np.asarray(falconx_group[f"{detector}_realtime"][()], dtype=float).reshape(-1)
+        dead_time_dataset = falconx_group[f"{detector}_deadtime"]
+        dead_time = np.asarray(dead_time_dataset[()], dtype=float).reshape(-1)
+        units = dead_time_dataset.attrs.get("units", XRF_DEAD_TIME_UNITS)
+        if isinstance(units, bytes):
+            units = units.decode()
+        if units in ["%", "percent"]:
+            dead_time = dead_time / 100
+        elif units not in ["", "1", "fraction"]:
+            raise ValueError(f"Unknown units {units} for the dead time of {detector}, expected % or fraction.")
+        return real_time * (1 - dead_time)
+
+    return np.ones(n_frames)
+
+
+def xrd_get_xrf_spectrum_from_position(position_group):
+    """
+    Live-time normalized fluorescence spectrum of an ESRF position: every frame of every falconx detector is
+    divided by its live time, frames are averaged and detectors summed
+
+    Parameters:
+        position_group (h5py.Group): ESRF position group
+
+    Returns:
+        np.array: (n_channels,) spectrum in counts per second, None if the position has no falconx spectrum
+    """
+    falconx_group = position_group.get("measurement/falconx")
+    if falconx_group is None:
+        return None
+
+    spectrum = None
+    for detector, detector_dataset in falconx_group.items():
+        if not isinstance(detector_dataset, h5py.Dataset) or detector_dataset.ndim != 2:
+            continue
+        frames = detector_dataset[()].astype(float)
+        live_time = xrd_get_xrf_live_time(falconx_group, detector, len(frames))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            detector_spectrum = np.nanmean(frames / live_time[:, None], axis=0)
+
+        if spectrum is None:
+            spectrum = detector_spectrum
+        else:
+            n_channels = min(len(spectrum), len(detector_spectrum))
+            spectrum = spectrum[:n_channels] + detector_spectrum[:n_channels]
+
+    return spectrum
+
+
+def xrd_make_xrf_matrix_from_hdf5(xrd_group, energy_offset=XRF_ENERGY_OFFSET, energy_gain=XRF_ENERGY_GAIN):
+    """
+    Assemble the normalized falconx spectra of an ESRF dataset in a single matrix
+
+    Parameters:
+        xrd_group (h5py.Group): ESRF dataset group
+        energy_offset (float): energy of the first channel (keV)
+        energy_gain (float): energy width of a channel (keV)
+
+    Returns:
+        tuple: position dataframe, (n_channels,) energy array (keV) and (n_positions, n_channels) spectra (cps)
+    """
+    position_list, spectrum_list = [], []
+    for position, position_group, position_row in xrd_iterate_wafer_positions(xrd_group):
+        spectrum = xrd_get_xrf_spectrum_from_position(position_group)
+        if spectrum is None:
+            continue
+        position_list.append(position_row)
+        spectrum_list.append(spectrum)
+
+    if not spectrum_list:
+        raise KeyError("No falconx spectra found in dataset.")
+
+    n_channels = min(len(spectrum) for spectrum in spectrum_list)
+    spectra_matrix = np.stack([spectrum[:n_channels] for spectrum in spectrum_list])
+    energy_array = energy_offset + energy_gain * np.arange(n_channels)
+
+    return pd.DataFrame(position_list), energy_array, spectra_matrix
+
+
+def xrd_xrf_roi_intensities(energy_array, spectra_matrix, elements, roi_width=0.3):
+    """
+    Element intensities as the sum of the channels within a window around each element line, for all positions
+    with a single matrix product
+
+    Parameters:
+        energy_array (np.array): (n_channels,) energies (keV)
+        spectra_matrix (np.array): (n_positions, n_channels) spectra
+        elements (list): element symbols, see XRF_LINES
+        roi_width (float): full width of the window (keV)
+
+    Returns:
+        np.array: (n_positions, n_elements) intensities
+    """
+    line_energies = np.array([XRF_LINES[element] for element in elements])
+    roi_matrix = np.abs(energy_array[:, None] - line_energies[None, :]) <= roi_width / 2
+
+    return np.nan_to_num(spectra_matrix) @ roi_matrix
+
+
+def xrd_xrf_basis_fit(energy_array, spectra_matrix, elements, fwhm=0.15, margin=1.0):
+    """
+    Element intensities from a linear least-squares fit of every spectrum with one gaussian per element line on
+    a linear background. The basis is shared, so all positions are solved at once.
+
+    Parameters:
+        energy_array (np.array): (n_channels,) energies (keV)
+        spectra_matrix (np.array): (n_positions, n_channels) spectra
+        elements (list): element symbols, see XRF_LINES
+        fwhm (float): detector resolution (keV)
+        margin (float): energy range fitted around the lines (keV)
+
+    Returns:
+        np.array: (n_positions, n_elements) integrated line intensities, negative values set to 0
+    """
+    line_energies = np.array([XRF_LINES[element] for element in elements])
+    fit_mask = (energy_array >= line_energies.min() - margin) & (energy_array <= line_energies.max() + margin)
+    energy_fit = energy_array[fit_mask]
+
+    sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+    gaussian_basis = np.exp(-0.5 * ((energy_fit[:, None] - line_energies[None, :]) / sigma) ** 2)
+    background_basis = np.stack([np.ones_like(energy_fit), energy_fit - energy_fit.mean()], axis=1)
+    basis = np.concatenate([gaussian_basis, background_basis], axis=1)
+
+    coefficients, _, _, _ = np.linalg.lstsq(basis, np.nan_to_num(spectra_matrix[:, fit_mask]).T, rcond=None)
+    intensities = coefficients[:len(elements)].T * gaussian_basis.sum(axis=0)
+
+    return np.clip(intensities, 0, None)
+
+
+def xrd_xrf_element_maps(xrd_group, elements, method="roi", energy_offset=XRF_ENERGY_OFFSET,
+                         energy_gain=XRF_ENERGY_GAIN, **kwargs):
+    """
+    Element intensities of all positions of an ESRF dataset from the falconx spectra
+
+    Parameters:
+        xrd_group (h5py.Group): ESRF dataset group
+        elements (list): element symbols, see XRF_LINES
+        method (str): "roi" (window sum, see xrd_xrf_roi_intensities) or "fit" (see xrd_xrf_basis_fit)
+        energy_offset (float): energy of the first channel (keV)
+        energy_gain (float): energy width of a channel (keV)
+        **kwargs: passed to the intensity method
+
+    Returns:
+        tuple: position dataframe and (n_positions, n_elements) intensities (cps)
+    """
+    unknown_elements = [element for element in elements if element not in XRF_LINES]
+    if unknown_elements:
+        raise KeyError(f"No fluorescence line for {', '.join(unknown_elements)}")
+
+    position_dataframe, energy_array, spectra_matrix = xrd_make_xrf_matrix_from_hdf5(
+        xrd_group, energy_offset, energy_gain
+    )
+    if method == "roi":
+        intensities = xrd_xrf_roi_intensities(energy_array, spectra_matrix, elements, **kwargs)
+    elif method == "fit":
+        intensities = xrd_xrf_basis_fit(energy_array, spectra_matrix, elements, **kwargs)
+    else:
+        raise KeyError(f"Unknown XRF method {method}, use roi or fit.")
+
+    return position_dataframe, intensities
+
+
+def xrd_read_poni(poni_path):
+    """
+    Read the detector geometry from a pyFAI calibration file (.poni), without depending on pyFAI
+
+    Parameters:
+        poni_path (str or Path): path to the .poni file
+
+    Returns:
+        dict: geometry with distance, poni1, poni2, pixel1, pixel2, wavelength (m) and rot1, rot2, rot3 (rad)
+    """
+    geometry = {"rot1": 0.0, "rot2": 0.0, "rot3": 0.0}
+    keys_dict = {
+        "distance": "distance",
+        "poni1": "poni1",
+        "poni2": "poni2",
+        "rot1": "rot1",
+        "rot2": "rot2",
+        "rot3": "rot3",
+        "wavelength": "wavelength",
+        "pixelsize1": "pixel1",
+        "pixelsize2": "pixel2",
+    }
+
+    with open(poni_path, "r") as file:
+        for line in file:
+            if line.startswith("#") or ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            key = key.strip().lower()
+            if key in keys_dict:
+                geometry[keys_dict[key]] = float(value)
+            # Recent poni versions store the pixel sizes in a json detector configuration
+            elif key == "detector_config":
+                detector_config = json.loads(value)
+                geometry["pixel1"] = float(detector_config["pixel1"])
+                geometry["pixel2"] = float(detector_config["pixel2"])
+
+    return geometry
+
+
+def xrd_make_pixel_q_chi(image_shape, geometry):
+    """
+    Compute q and chi at the center of every detector pixel, following the pyFAI geometry convention
+    (dimension 1 along the rows, dimension 2 along the columns, rotations rot1, rot2, rot3 around the axes)
+
+    Parameters:
+        image_shape (tuple): (n_rows, n_columns) of the detector images
+        geometry (dict): detector geometry, see xrd_read_poni
+
+    Returns:
+        tuple: (n_rows, n_columns) arrays of q (A-1) and chi (deg)
+    """
+    distance = geometry["distance"]
+    rot1, rot2, rot3 = geometry.get("rot1", 0), geometry.get("rot2", 0), geometry.get("rot3", 0)
+
+    p1 = (np.arange(image_shape[0]) + 0.5) * geometry["pixel1"] - geometry["poni1"]
+    p2 = (np.arange(image_shape[1]) + 0.5) * geometry["pixel2"] - geometry["poni2"]
+    p1, p2 = np.meshgrid(p1, p2, indexing="ij")
+
+    c1, c2, c3 = np.cos(rot1), np.cos(rot2), np.cos(rot3)
+    s1, s2, s3 = np.sin(rot1), np.sin(rot2), np.sin(rot3)
+
+    # pyFAI calc_pos_zyx: position of the pixel in the laboratory frame, t3 along the beam
+    t1 = p1 * c2 * c3 + p2 * (c3 * s1 * s2 - c1 * s3) - distance * (c1 * c3 * s2 + s1 * s3)
+    t2 = p1 * c2 * s3 + p2 * (c1 * c3 + s1 * s2 * s3) - distance * (-c3 * s1 + c1 * s2 * s3)
+    t3 = p1 * s2 - p2 * c2 * s1 + distance * c1 * c2
+
+    two_theta = np.degrees(np.arctan2(np.sqrt(t1**2 + t2**2), t3))
+    chi = np.degrees(np.arctan2(t1, t2))
+
+    return xrd_two_theta_to_q(two_theta, geometry["wavelength"] * 1e10), chi
+
+
+def xrd_make_integration_matrix(image_shape, geometry, n_q=1000, n_chi=1, mask=None, q_range=None):
+    """
+    Precompute the pixel -> (chi, q) bin lookup as a sparse matrix. Each row is a bin holding 1/n for the n
+    unmasked pixels falling in it, so that the product with a flattened image gives the mean intensity per bin.
+
+    Parameters:
+        image_shape (tuple): (n_rows, n_columns) of the detector images
+        geometry (dict): detector geometry, see xrd_read_poni
+        n_q (int): number of radial bins
+        n_chi (int): number of azimuthal bins, 1 for a 1D integration
+        mask (np.array): boolean array of image_shape, True for the pixels to exclude
+        q_range (tuple): (q_min, q_max) in A-1, defaults to the range covered by the detector
+
+    Returns:
+        tuple: (n_chi * n_q, n_pixels) sparse matrix, q bin centers (A-1), chi bin centers (deg)
+            and (n_chi * n_q) number of pixels per bin
+    """
+    q_pixels, chi_pixels = xrd_make_pixel_q_chi(image_shape, geometry)
+    q_pixels, chi_pixels = q_pixels.ravel(), chi_pixels.ravel()
+
+    valid = np.isfinite(q_pixels)
+    if mask is not None:
+        valid &= ~np.asarray(mask, dtype=bool).ravel()
+
+    if q_range is None:
+        q_range = (q_pixels[valid].min(), q_pixels[valid].max())
+    q_edges = np.linspace(q_range[0], q_range[1], n_q + 1)
+    chi_edges = np.linspace(-180, 180, n_chi + 1)
+
+    q_bins = np.digitize(q_pixels, q_edges) - 1
+    chi_bins = np.clip(np.digitize(chi_pixels, chi_edges) - 1, 0, n_chi - 1)
+    valid &= (q_bins >= 0) & (q_bins < n_q)
+
+    pixel_indices = np.flatnonzero(valid)
+    bin_indices = chi_bins[valid] * n_q + q_bins[valid]
+    bin_counts = np.bincount(bin_indices, minlength=n_chi * n_q)
+
+    integration_matrix = csr_matrix(
+        (1 / bin_counts[bin_indices], (bin_indices, pixel_indices)),
+        shape=(n_chi * n_q, len(q_pixels)),
+    )
+
+    q_centers = (q_edges[1:] + q_edges[:-1]) / 2
+    chi_centers = (chi_edges[1:] + chi_edges[:-1]) / 2
+
+    return integration_matrix, q_centers, chi_centers, bin_counts
+
+
+def xrd_get_detector_dataset(xrd_group, position_group):
+    """
+    Return the detector images dataset of a position, (n_rows, n_columns) for Smartlab,
+    (n_frames, n_rows, n_columns) for ESRF
+    """
+    measurement_group = position_group.get("measurement")
+
+    if xrd_group.attrs["instrument"] == "bm02 - esrf":
+        return measurement_group["CdTe"]
+    elif xrd_group.attrs["instrument"] == "Rigaku Smartlab":
+        return measurement_group["2Dimage"]
+    raise KeyError(
+        "XRD instrument is neither bm02 - esrf nor Rigaku Smartlab, can not retrieve 2D images."
+    )
+
+
+def xrd_get_detector_summary_from_hdf5(xrd_group, target_x, target_y, reductions=("sum", "mean", "max", "variance"),
+                                       roi=None, memory_budget_mb=HDF5_MEMORY_BUDGET_MB):
+    """
+    Out-of-core reductions of the detector images of a position (all frames of an ESRF scan), the stack is read
+    in blocks of at most memory_budget_mb, see reduce_dataset_frames
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group (Smartlab or ESRF, copied or linked)
+        target_x (float): x position (mm)
+        target_y (float): y position (mm)
+        reductions (tuple): among "sum", "mean", "min", "max", "variance" and "roi"
+        roi (np.array or tuple): pixels summed in every frame for "roi"
+        memory_budget_mb (float): maximum memory used by a block and its float64 copies (MB)
+
+    Returns:
+        dict: reduction name -> image, or (n_frames,) ROI sums
+    """
+    position_group = get_target_position_group(xrd_group, target_x, target_y)
+    detector_dataset = xrd_get_detector_dataset(xrd_group, position_group)
+
+    return reduce_dataset_frames(detector_dataset, reductions, roi, memory_budget_mb)
+
+
+def xrd_reintegrate_from_hdf5(xrd_group, geometry, n_q=1000, n_chi=1, mask=None, q_range=None, batch_size=64):
+    """
+    Integrate every detector image of an XRD dataset with the in-house sparse integrator. Frames of all
+    positions are buffered in batches of batch_size and each batch is integrated with one sparse-dense product.
+    Positions holding several frames get the mean of their integrated frames.
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group (Smartlab or ESRF)
+        geometry (dict): detector geometry, see xrd_read_poni
+        n_q (int): number of radial bins
+        n_chi (int): number of azimuthal bins
+        mask (np.array): boolean array, True for the pixels to exclude
+        q_range (tuple): (q_min, q_max) in A-1
+        batch_size (int): number of frames integrated at once, bounds the memory used by the frame buffer
+
+    Returns:
+        tuple: position dataframe, q bin centers (A-1), chi bin centers (deg)
+            and (n_positions, n_chi, n_q) intensity array, NaN for empty bins
+    """
+    position_list = []
+    dataset_list = []
+    for position, position_group, position_row in xrd_iterate_wafer_positions(xrd_group):
+        position_list.append(position_row)
+        dataset_list.append(xrd_get_detector_dataset(xrd_group, position_group))
+
+    if not dataset_list:
+        raise KeyError("No detector images found in XRD dataset.")
+
+    image_shape = dataset_list[0].shape[-2:]
+    integration_matrix, q_centers, chi_centers, bin_counts = xrd_make_integration_matrix(
+        image_shape, geometry, n_q, n_chi, mask, q_range
+    )
+
+    sums = np.zeros((len(dataset_list), n_chi * n_q))
+    frame_counts = np.zeros(len(dataset_list))
+    frame_buffer = np.empty((batch_size, image_shape[0] * image_shape[1]))
+    owner_buffer = np.empty(batch_size, dtype=int)
+    n_buffered = 0
+
+    def flush(n_frames):
+        integrated = integration_matrix @ frame_buffer[:n_frames].T
+        np.add.at(sums, owner_buffer[:n_frames], integrated.T)
+
+    for idx, dataset in enumerate(dataset_list):
+        n_frames = 1 if dataset.ndim == 2 else dataset.shape[0]
+        frame_counts[idx] = n_frames
+        start = 0
+        while start < n_frames:
+            # Read only what fits in the buffer
+            stop = min(n_frames, start + batch_size - n_buffered)
+            frames = dataset[()][np.newaxis] if dataset.ndim == 2 else dataset[start:stop]
+            frame_buffer[n_buffered:n_buffered + len(frames)] = frames.reshape(len(frames), -1)
+            owner_buffer[n_buffered:n_buffered + len(frames)] = idx
+            n_buffered += len(frames)
+            start += len(frames)
+            if n_buffered == batch_size:
+                flush(n_buffered)
+                n_buffered = 0
+    if n_buffered:
+        flush(n_buffered)
+
+    intensity = sums / frame_counts[:, np.newaxis]
+    intensity[:, bin_counts == 0] = np.nan
+
+    return pd.DataFrame(position_list), q_centers, chi_centers, intensity.reshape(len(dataset_list), n_chi, n_q)
+
+
+def xrd_smoothness_band(n_q, lam):
+    """
+    Upper banded form (see scipy.linalg.solveh_banded) of the Whittaker smoothness penalty lam * D.T @ D,
+    D being the second order difference matrix
+
+    Parameters:
+        n_q (int): number of points of the patterns
+        lam (float): smoothness parameter
+
+    Returns:
+        np.array: (3, n_q) upper banded penalty matrix
+    """
+    band = np.zeros((3, n_q))
+    band[2] = 6
+    band[2, [0, -1]] = 1
+    band[2, [1, -2]] = 5
+    band[1, 1:] = -4
+    band[1, [1, -1]] = -2
+    band[0, 2:] = 1
+    return lam * band
+
+
+def xrd_rolling_background(intensity_matrix, window=None):
+    """
+    Estimate the background of all patterns at once with a rolling minimum followed by a rolling mean
+
+    Parameters:
+        intensity_matrix (np.array): (n_patterns, n_q) intensities
+        window (int): width of the rolling windows in points, defaults to 1/20 of the pattern length
+
+    Returns:
+        np.array: (n_patterns, n_q) background
+    """
+    intensity_matrix = np.atleast_2d(intensity_matrix)
+    if window is None:
+        window = max(3, intensity_matrix.shape[1] // 20)
+
+    background = minimum_filter1d(intensity_matrix, size=window, axis=1, mode="nearest")
+    background = uniform_filter1d(background, size=window, axis=1, mode="nearest")
+
+    return np.minimum(background, intensity_matrix)
+
+
+def xrd_whittaker_background(intensity_matrix, lam=1e6, n_iter=10):
+    """
+    Estimate the background of all patterns by iterative clipping: the patterns are smoothed with a Whittaker
+    smoother then clipped to the smoothed curve, n_iter times. The smoother (I + lam D.T D) is the same for every
+    pattern and every iteration, so it is factorized once and all patterns are solved together.
+
+    Parameters:
+        intensity_matrix (np.array): (n_patterns, n_q) intensities
+        lam (float): smoothness parameter, larger values give a stiffer background
+        n_iter (int): number of clipping iterations
+
+    Returns:
+        np.array: (n_patterns, n_q) background
+    """
+    intensity_matrix = np.atleast_2d(intensity_matrix).astype(float)
+    n_q = intensity_matrix.shape[1]
+
+    band = xrd_smoothness_band(n_q, lam)
+    band[2] += 1
+    factor = cholesky_banded(band)
+
+    # Solve with the patterns as columns of the right-hand side
+    background = intensity_matrix.T
+    for _ in range(n_iter):
+        background = np.minimum(background, cho_solve_banded((factor, False), background))
+
+    return background.T
+
+
+def xrd_als_background(intensity_matrix, lam=1e6, p=0.01, n_iter=10):
+    """
+    Asymmetric least squares background of all patterns (Eilers & Boelens): points above the background get a
+    weight p, points below get 1 - p, and the weighted Whittaker smoothing is repeated n_iter times.
+    The first iteration has uniform weights and shares a single factorization for all patterns. The following
+    iterations have different weights for each pattern, the patterns are then chained into one block banded
+    system solved in a single call.
+
+    Parameters:
+        intensity_matrix (np.array): (n_patterns, n_q) intensities
+        lam (float): smoothness parameter, larger values give a stiffer background
+        p (float): asymmetry parameter, weight of the points above the background
+        n_iter (int): number of reweighting iterations
+
+    Returns:
+        np.array: (n_patterns, n_q) background
+    """
+    intensity_matrix = np.atleast_2d(intensity_matrix).astype(float)
+    n_patterns, n_q = intensity_matrix.shape
+
+    band = xrd_smoothness_band(n_q, lam)
+
+    # Uniform weights, one factorization shared by all patterns
+    shared_band = band.copy()
+    shared_band[2] += 1
+    background = cho_solve_banded((cholesky_banded(shared_band), False), intensity_matrix.T).T
+
+    # The penalty band of each pattern does not couple to its neighbours, chaining them keeps a banded matrix
+    chained_band = np.tile(band, n_patterns)
+    intensity_flat = intensity_matrix.ravel()
+    for _ in range(n_iter - 1):
+        weights = np.where(intensity_matrix > background, p, 1 - p).ravel()
+        weighted_band = chained_band.copy()
+        weighted_band[2] += weights
+        background = solveh_banded(weighted_band, weights * intensity_flat).reshape(n_patterns, n_q)
+
+    return background
+
+
+def xrd_estimate_background(intensity_matrix, method="als", **kwargs):
+    """
+    Estimate the background of a matrix of patterns with the selected engine
+
+    Parameters:
+        intensity_matrix (np.array): (n_patterns, n_q) intensities, or a single pattern
+        method (str): "als" (asymmetric least squares), "whittaker" (iterative clipping) or "rolling"
+        **kwargs: parameters passed to the engine (lam, p, n_iter or window)
+
+    Returns:
+        np.array: (n_patterns, n_q) background
+    """
+    if method == "als":
+        return xrd_als_background(intensity_matrix, **kwargs)
+    if method == "whittaker":
+        return xrd_whittaker_background(intensity_matrix, **kwargs)
+    if method == "rolling":
+        return xrd_rolling_background(intensity_matrix, **kwargs)
+    raise KeyError(f"Unknown background method {method}, use als, whittaker or rolling.")
+
+
+def xrd_get_background_subtracted_matrix(xrd_group, method="als", n_q=None, source="integrated", **kwargs):
+    """
+    Cached background subtracted pattern matrix of an XRD dataset, for peak or clustering analyses
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        method (str): background engine, see xrd_estimate_background
+        n_q (int): number of points of the common q grid
+        source (str): "integrated" or "reintegrated", see xrd_get_pattern_from_position
+
+    Returns:
+        tuple: position dataframe, q grid (A-1) and (n_positions, n_q) background subtracted intensity matrix
+    """
+    def builder(group):
+        position_dataframe, q_array, intensity_matrix = xrd_get_pattern_matrix(group, n_q=n_q, source=source)
+        background = xrd_estimate_background(intensity_matrix, method=method, **kwargs)
+        return position_dataframe, q_array, intensity_matrix - background
+
+    return get_cached_derived(xrd_group, f"background_{method}_{n_q}_{source}_{sorted(kwargs.items())}", builder)
+
+
+def xrd_find_peaks(q_array, intensity_matrix, prominence=None, max_peaks=10):
+    """
+    Detect peaks present anywhere on the wafer, using the maximum over all background subtracted patterns
+
+    Parameters:
+        q_array (np.array): (n_q,) common q grid
+        intensity_matrix (np.array): (n_patterns, n_q) background subtracted intensities
+        prominence (float): minimum peak prominence, defaults to 5% of the highest intensity
+        max_peaks (int): maximum number of peaks returned, the most prominent are kept
+
+    Returns:
+        np.array: q positions of the detected peaks, sorted by increasing q
+    """
+    max_pattern = np.nanmax(np.atleast_2d(intensity_matrix), axis=0)
+    if prominence is None:
+        prominence = 0.05 * np.nanmax(max_pattern)
+
+    peak_indices, properties = find_peaks(max_pattern, prominence=prominence)
+    if len(peak_indices) > max_peaks:
+        peak_indices = peak_indices[np.argsort(properties["prominences"])[-max_peaks:]]
+
+    return np.sort(q_array[peak_indices])
+
+
+def xrd_pseudo_voigt(q, amplitude, center, fwhm, eta, offset):
+    """Pseudo-Voigt profile: eta * Lorentzian + (1 - eta) * Gaussian, both of height amplitude, plus a constant"""
+    x = (q - center) / fwhm
+    lorentzian = 1 / (1 + 4 * x**2)
+    gaussian = np.exp(-4 * np.log(2) * x**2)
+    return amplitude * (eta * lorentzian + (1 - eta) * gaussian) + offset
+
+
+def xrd_integrate_pseudo_voigt(amplitude, fwhm, eta):
+    """Area under a pseudo-Voigt profile (without its constant offset)"""
+    return amplitude * fwhm * (eta * np.pi / 2 + (1 - eta) * np.sqrt(np.pi / (4 * np.log(2))))
+
+
+def xrd_fit_peak_rows(q_window, intensity_rows):
+    """
+    Fit one pseudo-Voigt on every row of a block of patterns restricted to a peak window
+
+    Parameters:
+        q_window (np.array): (n_window,) q values of the window
+        intensity_rows (np.array): (n_rows, n_window) intensities
+
+    Returns:
+        np.array: (n_rows, 5) fitted amplitude, center, fwhm, eta and offset, NaN where the fit failed
+    """
+    q_step = np.abs(np.diff(q_window)).min()
+    q_width = q_window[-1] - q_window[0]
+    lower_bounds = [0, q_window[0], q_step, 0, -np.inf]
+    upper_bounds = [np.inf, q_window[-1], q_width, 1, np.inf]
+
+    parameters = np.full((len(intensity_rows), 5), np.nan)
+    for idx, intensity in enumerate(intensity_rows):
+        if not np.all(np.isfinite(intensity)):
+            continue
+        guess = [
+            max(intensity.max() - intensity.min(), 1e-12),
+            q_window[np.argmax(intensity)],
+            q_width / 5,
+            0.5,
+            intensity.min(),
+        ]
+        try:
+            parameters[idx] = curve_fit(
+                xrd_pseudo_voigt, q_window, intensity, p0=guess, bounds=(lower_bounds, upper_bounds), maxfev=2000
+            )[0]
+        except (RuntimeError, ValueError):
+            continue
+
+    return parameters
+
+
+def xrd_batch_fit_peaks(q_array, intensity_matrix, peak_centers, window_width=0.1, n_workers=None):
+    """
+    Fit the selected peaks on all patterns, splitting the patterns in blocks fitted by parallel worker processes
+
+    Parameters:
+        q_array (np.array): (n_q,) common q grid
+        intensity_matrix (np.array): (n_patterns, n_q) background subtracted intensities
+        peak_centers (list): approximate q positions of the peaks to fit
+        window_width (float): width of the q window around each peak (A-1)
+        n_workers (int): number of worker processes, defaults to the number of CPUs. 1 fits in the current process
+
+    Returns:
+        dict: for each peak center, dictionary of (n_patterns,) arrays of position, fwhm and integrated_intensity
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    intensity_matrix = np.atleast_2d(intensity_matrix)
+    # Spawning processes is only worth it for large datasets
+    n_workers = max(1, min(n_workers, len(intensity_matrix) // 25))
+    row_blocks = np.array_split(np.arange(len(intensity_matrix)), n_workers)
+
+    peaks_dict = {}
+    executor = start_process_pool(n_workers) if n_workers > 1 else None
+    try:
+        for center in peak_centers:
+            window_mask = np.abs(q_array - center) <= window_width / 2
+            if np.count_nonzero(window_mask) < 6:
+                raise ValueError(f"Peak window around {center} A-1 contains too few points, increase its width.")
+            q_window = q_array[window_mask]
+            blocks = [intensity_matrix[rows][:, window_mask] for rows in row_blocks]
+
+            if executor is None:
+                parameters = np.concatenate([xrd_fit_peak_rows(q_window, block) for block in blocks])
+            else:
+                parameters = np.concatenate(list(executor.map(xrd_fit_peak_rows, [q_window] * len(blocks), blocks)))
+
+            amplitude, position, fwhm, eta, offset = parameters.T
+            peaks_dict[center] = {
+                "position": position,
+                "fwhm": fwhm,
+                "integrated_intensity": xrd_integrate_pseudo_voigt(amplitude, fwhm, eta),
+            }
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return peaks_dict
+
+
+def xrd_batch_peak_analysis(position_dataframe, q_array, intensity_matrix, peak_centers=None, window_width=0.1,
+                            n_workers=None):
+    """
+    Quick-look peak analysis of a whole XRD dataset: peak detection (if no peak is given) and pseudo-Voigt fitting
+    of every peak on every position. Takes the background subtracted patterns (see
+    xrd_get_background_subtracted_matrix) rather than the dataset group, the fits run in worker processes that must
+    be started while the sample file is closed.
+
+    Parameters:
+        position_dataframe (pd.DataFrame): positions of the patterns
+        q_array (np.array): (n_q,) common q grid
+        intensity_matrix (np.array): (n_positions, n_q) background subtracted intensities
+        peak_centers (list): approximate q positions of the peaks to fit (A-1), detected automatically if None
+        window_width (float): width of the q window around each peak (A-1)
+        n_workers (int): number of worker processes used for the fits
+
+    Returns:
+        dict: results_dict[position][peak_name] = {"position": float, "fwhm": float, "integrated_intensity": float}
+    """
+    if not peak_centers:
+        peak_centers = xrd_find_peaks(q_array, intensity_matrix)
+    if len(peak_centers) == 0:
+        raise ValueError("No peak found in XRD dataset.")
+
+    peaks_dict = xrd_batch_fit_peaks(q_array, intensity_matrix, peak_centers, window_width, n_workers)
+
+    results_dict = {}
+    for idx, position in enumerate(position_dataframe["position"]):
+        results_dict[position] = {}
+        for center, peak_dict in peaks_dict.items():
+            results_dict[position][f"peak_{center:.3f}"] = {
+                key: float(value[idx]) for key, value in peak_dict.items()
+            }
+
+    return results_dict
+
+
 def xrd_plot_integrated_from_dataframe(fig, df):
     fig.update_xaxes(title_text="q (A-1)")
     fig.update_yaxes(title_text="Counts")
@@ -163,6 +1400,60 @@ def xrd_plot_integrated_from_dataframe(fig, df):
     return fig
 
 
+def xrd_plot_background_from_dataframe(fig, df):
+    fig.update_xaxes(title_text="q (A-1)")
+    fig.update_yaxes(title_text="Counts")
+
+    fig.add_trace(
+        go.Scatter(
+            x=df["q"],
+            y=df["intensity"],
+            mode="lines",
+            line=dict(color="SlateBlue", width=2),
+            name="Measured",
+        )
+    )
+    fig.add_trace(
+        go.Scatter(
+            x=df["q"],
+            y=df["background"],
+            mode="lines",
+            line=dict(color="Crimson", width=2),
+            name="Background",
+        )
+    )
+    fig.add_trace(
+        go.Scatter(
+            x=df["q"],
+            y=df["intensity"] - df["background"],
+            mode="lines",
+            line=dict(color="Green", width=2),
+            name="Subtracted",
+        )
+    )
+
+    return fig
+
+
+def xrd_plot_components_from_dataframe(fig, df):
+    colors = cycle(px.colors.qualitative.Plotly)
+
+    fig.update_xaxes(title_text="q (A-1)")
+    fig.update_yaxes(title_text="Normalized intensity")
+
+    for component in df.columns[1:]:
+        fig.add_trace(
+            go.Scatter(
+                x=df["q"],
+                y=df[component],
+                mode="lines",
+                line=dict(color=next(colors), width=2),
+                name=component,
+            )
+        )
+    return fig
+
+
 def xrd_plot_fits_from_dataframe(fig, df, fits=None):
     colors = cycle(px.colors.qualitative.Plotly)
 
@@ -1,8 +1,51 @@
+import fnmatch
+import os
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
 from pathlib import Path
 
 import h5py
+import numpy as np
 
 from ..functions.functions_hdf5 import *
+from ..functions.functions_shared import (COMMON_METADATA_GROUP, HDF5_FILE_ID_ATTR, HDF5_GENERATION_ATTR,
+                                         cleanup_file, close_hdf5_session, get_hdf5_lock_path, get_position_groups,
+                                         hdf5_file_lock, iterate_dataset_chunks, open_hdf5)
+
+# Instrument items always kept in the position groups, read directly by all the maps
+POSITION_METADATA_KEYS = ["x_pos", "y_pos"]
+
+# Filters of the measurement datasets, selected by technique then signal, "default" for any other signal.
+# Set a signal to None to store it raw, {"compression": "lzf", "shuffle": True} trades size for decompression speed.
+STORAGE_POLICY = {
+    "default": {"compression": "gzip", "compression_opts": 4, "shuffle": True},
+    "edx": {"spectrum": {"compression": "gzip", "compression_opts": 6, "shuffle": True}},
+    "moke": {"loop": {"compression": "gzip", "compression_opts": 4, "shuffle": True}},
+    "profil": {"profile": {"compression": "gzip", "compression_opts": 4, "shuffle": True}},
+    "xrd": {
+        "pattern": {"compression": "gzip", "compression_opts": 4, "shuffle": True},
+        "image": {"compression": "gzip", "compression_opts": 4, "shuffle": True},
+    },
+    "esrf": {"stack": {"compression": "gzip", "compression_opts": 4, "shuffle": True}},
+}
+# Target size of a chunk, and size under which datasets are kept contiguous and unfiltered
+STORAGE_CHUNK_KB = 64
+STORAGE_MIN_KB = 4
+
+# Signal of the datasets of each technique by number of dimensions, used to apply STORAGE_POLICY when repacking
+REPACK_SIGNALS = {
+    "edx": {1: "spectrum"},
+    "moke": {1: "loop"},
+    "profil": {1: "profile"},
+    "xrd": {1: "pattern", 2: "image", 3: "stack"},
+    "esrf": {1: "pattern", 2: "pattern", 3: "stack"},
+}
+
+# Repack jobs running in background threads, by HDF5 path (see start_repack_hdf5)
+REPACK_JOBS = {}
 
 
 def convertFloat(item):
@@ -24,6 +67,80 @@ def convertFloat(item):
     return item
 
 
+# Scan number in the file names of a mapping, e.g. 12 in sample_12.ras or sample_12_1.img
+SCAN_NUMBER_PATTERN = re.compile(r"_(\d+)(?:_\d+)?\.")
+
+
+def make_file_catalog(source_path):
+    """
+    Walks a source tree once with os.scandir and indexes its files, so that writers can pair files with dictionary
+    lookups instead of walking the tree again. Hidden and macOS resource files (._*) are skipped, as in safe_rglob.
+    Names are compared with the case rules of the platform (os.path.normcase), as glob does: "*.ras" matches
+    sample.RAS on Windows only.
+
+    Args:
+        source_path (str or Path): Root of the source tree.
+
+    Returns:
+        dict: "files": sorted list of all file paths, "by_extension": extension (without dot, normalized case)
+            -> paths, "by_scan": scan number (see SCAN_NUMBER_PATTERN) -> paths.
+    """
+    files = []
+    directories = [str(source_path)]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                # DirEntry caches the file type from the directory listing, no stat call per file
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file() and not entry.name.startswith("."):
+                    files.append(Path(entry.path))
+    files.sort()
+
+    by_extension, by_scan = defaultdict(list), defaultdict(list)
+    for file in files:
+        by_extension[os.path.normcase(file.suffix[1:])].append(file)
+        scan_match = SCAN_NUMBER_PATTERN.search(file.name)
+        if scan_match is not None:
+            by_scan[scan_match.group(1)].append(file)
+
+    return {"files": files, "by_extension": dict(by_extension), "by_scan": dict(by_scan)}
+
+
+def catalog_glob(catalog, pattern):
+    """
+    Returns the files of a catalog (see make_file_catalog) whose name matches a glob pattern, anywhere in the tree,
+    like safe_rglob.
+
+    Args:
+        catalog (dict): File catalog.
+        pattern (str): Glob pattern on the file name, e.g. "*.ras".
+
+    Returns:
+        list of Path: Matching files.
+    """
+    extension = pattern[2:] if pattern.startswith("*.") else None
+    if extension is not None and not any(character in extension for character in "*?["):
+        return list(catalog["by_extension"].get(os.path.normcase(extension), []))
+
+    return [file for file in catalog["files"] if fnmatch.fnmatch(file.name, pattern)]
+
+
+def catalog_scan_files(catalog, scan_number, pattern="*"):
+    """
+    Returns the files of a catalog (see make_file_catalog) belonging to a scan and whose name matches a glob pattern.
+
+    Args:
+        catalog (dict): File catalog.
+        scan_number (str): Scan number, see SCAN_NUMBER_PATTERN.
+        pattern (str): Glob pattern on the file name, e.g. "*.img".
+
+    Returns:
+        list of Path: Matching files.
+    """
+    return [file for file in catalog["by_scan"].get(scan_number, []) if fnmatch.fnmatch(file.name, pattern)]
+
+
 def get_all_keys(d):
     """
     Recursively yields all keys and values in a nested dictionary.
@@ -127,7 +244,7 @@ def create_new_hdf5(hdf5_path, sample_metadata):
     Returns:
         None
     """
-    with h5py.File(hdf5_path, "x") as hdf5_file:
+    with open_hdf5(hdf5_path, "x") as hdf5_file:
         hdf5_file.attrs["HT_class"] = "HTroot"
 
         sample = hdf5_file.create_group("sample")
@@ -145,4 +262,402 @@ def create_new_hdf5(hdf5_path, sample_metadata):
                     current_group = sample
                     counts = 0
 
-        return True
\ No newline at end of file
+        return True
+
+def get_chunk_shape(shape, itemsize):
+    """
+    Returns a chunk shape of about STORAGE_CHUNK_KB for a dataset: stacks (3D and more) are chunked per frame,
+    images per block of full rows and 1D signals per block of points.
+
+    Args:
+        shape (tuple): Shape of the dataset.
+        itemsize (int): Size of an element in bytes.
+
+    Returns:
+        tuple: The chunk shape.
+    """
+    target_items = max(1, STORAGE_CHUNK_KB * 1024 // itemsize)
+
+    if len(shape) >= 3:
+        return (1,) + tuple(shape[1:])
+    if len(shape) == 2:
+        rows = max(1, target_items // max(1, shape[1]))
+        return min(rows, shape[0]), shape[1]
+    return (min(target_items, shape[0]),)
+
+
+def get_storage_options(technique, signal, shape, dtype="float"):
+    """
+    Returns the create_dataset keyword arguments (chunks and filters) of a measurement dataset, according to
+    STORAGE_POLICY. Small datasets are stored contiguous and unfiltered.
+
+    Args:
+        technique (str): The technique, key of STORAGE_POLICY (edx, moke, profil, xrd, esrf).
+        signal (str): The signal, e.g. "spectrum", "profile", "pattern", "image" or "stack".
+        shape (tuple): Shape of the dataset.
+        dtype (str or np.dtype, optional): Type of the dataset. Defaults to "float".
+
+    Returns:
+        dict: Keyword arguments for h5py.Group.create_dataset.
+    """
+    shape = tuple(int(dim) for dim in shape)
+    itemsize = np.dtype(dtype).itemsize
+    filters = STORAGE_POLICY.get(technique, {}).get(signal, STORAGE_POLICY["default"])
+
+    if filters is None or len(shape) == 0 or 0 in shape or np.prod(shape) * itemsize < STORAGE_MIN_KB * 1024:
+        return {}
+
+    return {"chunks": get_chunk_shape(shape, itemsize), **filters}
+
+
+def make_scratch_hdf5():
+    """
+    Opens an in-memory HDF5 file (core driver, never written to disk), used to stage data before writing it
+    to the sample file.
+
+    Returns:
+        h5py.File: The scratch file, to be used as a context manager.
+    """
+    return h5py.File(f"scratch_{uuid.uuid4().hex}.h5", "w", driver="core", backing_store=False)
+
+
+def get_dataset_signature(dataset):
+    """
+    Returns a hashable signature of the value and attributes of a dataset, used to find identical metadata.
+
+    Args:
+        dataset (h5py.Dataset): The dataset.
+
+    Returns:
+        tuple: dtype, shape, value and attributes of the dataset.
+    """
+    value = dataset[()]
+    if isinstance(value, np.ndarray):
+        value = repr(value.tolist()) if value.dtype.kind == "O" else value.tobytes()
+    else:
+        value = repr(value)
+    attributes = repr(sorted((key, repr(attribute)) for key, attribute in dataset.attrs.items()))
+
+    return dataset.dtype.str, dataset.shape, value, attributes
+
+
+def copy_metadata_item(source_root, relative_path, target_root):
+    """
+    Copies a dataset to the same relative path in another tree, creating the parent groups with their attributes.
+
+    Args:
+        source_root (h5py.Group): Root of the source tree.
+        relative_path (str): Path of the dataset relative to source_root.
+        target_root (h5py.Group): Root of the target tree.
+    Returns:
+        None
+    """
+    *parent_names, name = relative_path.split("/")
+    source_parent, target_parent = source_root, target_root
+    for parent_name in parent_names:
+        source_parent = source_parent[parent_name]
+        if parent_name not in target_parent:
+            target_parent.create_group(parent_name).attrs.update(source_parent.attrs)
+        target_parent = target_parent[parent_name]
+
+    source_root.file.copy(source_root[relative_path], target_parent, name)
+
+
+def write_deduplicated_metadata(scratch_group, dataset_group):
+    """
+    Writes the instrument metadata staged in scratch_group (one subgroup per position, see make_scratch_hdf5) to the
+    dataset: items identical in all positions are written once in the common_metadata group of the dataset, the
+    others in the instrument group of their position. Use functions_shared.get_position_metadata_item to read them back.
+
+    Args:
+        scratch_group (h5py.Group): Group holding one metadata group per position name.
+        dataset_group (h5py.Group): The dataset group, with its position groups already created.
+    Returns:
+        None
+    """
+    position_items = {}
+    for position, metadata_group in scratch_group.items():
+        items = []
+        metadata_group.visititems(
+            lambda name, item: items.append(name) if isinstance(item, h5py.Dataset) else None
+        )
+        position_items[position] = {name: get_dataset_signature(metadata_group[name]) for name in items}
+
+    common_items = set()
+    if len(position_items) > 1:
+        first_position, first_items = next(iter(position_items.items()))
+        common_items = set(first_items)
+        for items in position_items.values():
+            common_items = {name for name in common_items if items.get(name) == first_items[name]}
+
+    if common_items:
+        common_group = dataset_group.require_group(COMMON_METADATA_GROUP)
+        for name in sorted(common_items):
+            copy_metadata_item(scratch_group[first_position], name, common_group)
+
+    for position, items in position_items.items():
+        instrument_group = dataset_group[position].require_group("instrument")
+        for name in sorted(set(items) - common_items):
+            copy_metadata_item(scratch_group[position], name, instrument_group)
+
+    return None
+
+
+def deduplicate_metadata_hdf5(dataset_group):
+    """
+    Function to update a dataset written before shared metadata: the instrument metadata of every position is moved
+    to the scratch file and written back with write_deduplicated_metadata. ESRF datasets, whose instrument trees
+    are beamline dumps or external links, are left untouched. Run a repack afterwards to reclaim the file space.
+
+    @param dataset_group: dataset group
+    @return: True if group has been updated, False if group was already up to date
+    """
+    if COMMON_METADATA_GROUP in dataset_group or dataset_group.attrs.get("instrument") == "bm02 - esrf":
+        return False
+
+    with make_scratch_hdf5() as scratch_file:
+        for position, position_group in get_position_groups(dataset_group):
+            instrument_group = position_group["instrument"]
+            metadata_group = scratch_file.create_group(position)
+            for name in list(instrument_group.keys()):
+                if name in POSITION_METADATA_KEYS:
+                    continue
+                instrument_group.file.copy(instrument_group[name], metadata_group, name)
+                del instrument_group[name]
+
+        write_deduplicated_metadata(scratch_file, dataset_group)
+
+    return True
+
+
+def repack_dataset(dataset, target_group, name, technique=None):
+    """
+    Copies a dataset to target_group. Numeric datasets are rewritten block by block with the chunks and filters of
+    STORAGE_POLICY for the technique; other datasets (strings, virtual datasets) and all datasets when technique is
+    None are copied as they are.
+
+    Args:
+        dataset (h5py.Dataset): The source dataset.
+        target_group (h5py.Group): The group to copy the dataset to.
+        name (str): Name of the copy.
+        technique (str, optional): Key of STORAGE_POLICY, None to keep the source layout.
+    Returns:
+        None
+    """
+    if technique is None or dataset.is_virtual or dataset.dtype.kind not in "biuf":
+        dataset.file.copy(dataset, target_group, name)
+        return None
+
+    signal = REPACK_SIGNALS.get(technique, {}).get(min(dataset.ndim, 3), "default")
+    options = get_storage_options(technique, signal, dataset.shape, dataset.dtype)
+    if not options:
+        target_dataset = target_group.create_dataset(name, data=dataset[()], dtype=dataset.dtype)
+    else:
+        target_dataset = target_group.create_dataset(name, shape=dataset.shape, dtype=dataset.dtype, **options)
+        for start, stop, block in iterate_dataset_chunks(dataset):
+            target_dataset[start:stop] = block
+    target_dataset.attrs.update(dataset.attrs)
+
+    return None
+
+
+def repack_group(source_group, target_group, apply_policy=True, technique=None, progress=None):
+    """
+    Recursively copies the contents of source_group to target_group. Soft and external links are recreated as
+    links, the technique of each dataset group is read from its HT_type attribute.
+
+    Args:
+        source_group (h5py.Group): The group to copy.
+        target_group (h5py.Group): The group to copy to, in the repacked file.
+        apply_policy (bool, optional): Rewrites numeric datasets with STORAGE_POLICY. Defaults to True.
+        technique (str, optional): Technique of the parent dataset group.
+        progress (callable, optional): Called with the name of every copied dataset.
+    Returns:
+        None
+    """
+    target_group.attrs.update(source_group.attrs)
+
+    for name in source_group.keys():
+        link = source_group.get(name, getlink=True)
+        if isinstance(link, h5py.SoftLink):
+            target_group[name] = h5py.SoftLink(link.path)
+            continue
+        if isinstance(link, h5py.ExternalLink):
+            target_group[name] = h5py.ExternalLink(link.filename, link.path)
+            continue
+
+        item = source_group[name]
+        if isinstance(item, h5py.Group):
+            item_technique = technique
+            if "HT_type" in item.attrs:
+                item_technique = "esrf" if item.attrs.get("instrument") == "bm02 - esrf" else item.attrs["HT_type"]
+            repack_group(item, target_group.create_group(name), apply_policy, item_technique, progress)
+        else:
+            repack_dataset(item, target_group, name, technique if apply_policy else None)
+            if progress is not None:
+                progress(item.name)
+
+    return None
+
+
+def verify_repacked_hdf5(source_path, repacked_path):
+    """
+    Compares a repacked file with its source: same tree, links, attributes, shapes, types and values.
+
+    Args:
+        source_path (str or Path): The source HDF5 file.
+        repacked_path (str or Path): The repacked HDF5 file.
+    Returns:
+        list: Paths of the items that differ, empty if the files hold the same data.
+    """
+    mismatches = []
+
+    def same_attributes(source_item, repacked_item):
+        # The write generation is incremented by writing the repacked file, which gets an identifier if it had none
+        source_keys = set(source_item.attrs.keys()) - {HDF5_GENERATION_ATTR, HDF5_FILE_ID_ATTR}
+        if source_keys != set(repacked_item.attrs.keys()) - {HDF5_GENERATION_ATTR, HDF5_FILE_ID_ATTR}:
+            return False
+        return all(
+            np.array_equal(np.asarray(source_item.attrs[key]), np.asarray(repacked_item.attrs[key]))
+            for key in source_keys
+        )
+
+    def same_values(source_dataset, repacked_dataset):
+        if source_dataset.shape != repacked_dataset.shape or source_dataset.dtype != repacked_dataset.dtype:
+            return False
+        if source_dataset.dtype.kind not in "biufc" or source_dataset.ndim == 0:
+            return np.array_equal(np.asarray(source_dataset[()]), np.asarray(repacked_dataset[()]))
+        equal_nan = source_dataset.dtype.kind in "fc"
+        return all(
+            np.array_equal(block, repacked_dataset[start:stop], equal_nan=equal_nan)
+            for start, stop, block in iterate_dataset_chunks(source_dataset)
+        )
+
+    def compare_group(source_group, repacked_group):
+        if set(source_group.keys()) != set(repacked_group.keys()) or not same_attributes(source_group, repacked_group):
+            mismatches.append(source_group.name)
+            return
+        for name in source_group.keys():
+            source_link = source_group.get(name, getlink=True)
+            repacked_link = repacked_group.get(name, getlink=True)
+            if isinstance(source_link, (h5py.SoftLink, h5py.ExternalLink)):
+                if type(source_link) is not type(repacked_link) or vars(source_link) != vars(repacked_link):
+                    mismatches.append(f"{source_group.name}/{name}")
+                continue
+
+            source_item, repacked_item = source_group[name], repacked_group[name]
+            if isinstance(source_item, h5py.Group):
+                compare_group(source_item, repacked_item)
+            elif not same_attributes(source_item, repacked_item) or not same_values(source_item, repacked_item):
+                mismatches.append(source_item.name)
+
+    with open_hdf5(source_path, "r") as source_file, open_hdf5(repacked_path, "r") as repacked_file:
+        compare_group(source_file, repacked_file)
+
+    return mismatches
+
+
+def get_repacked_path(hdf5_path):
+    """
+    Temporary file written by repack_hdf5, it only exists while a repack is running.
+
+    Args:
+        hdf5_path (str or Path): The HDF5 file to repack.
+    Returns:
+        Path: The path of the repacked file.
+    """
+    hdf5_path = Path(hdf5_path)
+    return hdf5_path.with_name(f"{hdf5_path.stem}_repack{hdf5_path.suffix}")
+
+
+def repack_hdf5(hdf5_path, apply_policy=True, verify=True, progress=None):
+    """
+    Repacks a sample file: its contents are copied to a new file, which does not keep the space freed by deleted
+    groups (refits, migrations) and uses the current file profile and STORAGE_POLICY, then the new file replaces the
+    source. The source is left untouched if the verification fails. The source is locked for writing during the
+    repack, other users wait for it or get an HDF5BusyError.
+
+    Args:
+        hdf5_path (str or Path): The HDF5 file to repack.
+        apply_policy (bool, optional): Rewrites numeric datasets with STORAGE_POLICY. Defaults to True.
+        verify (bool, optional): Compares the repacked file with the source before replacing it. Defaults to True.
+        progress (callable, optional): Called with the fraction of copied datasets.
+    Returns:
+        dict: Size of the file before and after (MB) and elapsed time (s).
+    """
+    hdf5_path = Path(hdf5_path)
+    # The repacked file replaces the source, an in-memory working copy would overwrite it on its next flush
+    close_hdf5_session(hdf5_path)
+    repacked_path = get_repacked_path(hdf5_path)
+    if repacked_path.exists():
+        repacked_path.unlink()
+
+    # Other users wait until the repacked file has replaced the source
+    with hdf5_file_lock(hdf5_path, exclusive=True):
+        start_time = time.perf_counter()
+        size_before = hdf5_path.stat().st_size
+
+        with open_hdf5(hdf5_path, "r") as source_file, open_hdf5(repacked_path, "x") as repacked_file:
+            n_datasets = [0]
+            source_file.visititems(lambda name, item: n_datasets.__setitem__(0, n_datasets[0] + 1)
+                                   if isinstance(item, h5py.Dataset) else None)
+            n_copied = [0]
+
+            def dataset_copied(name):
+                n_copied[0] += 1
+                if progress is not None:
+                    progress(n_copied[0] / max(1, n_datasets[0]))
+
+            repack_group(source_file, repacked_file, apply_policy, progress=dataset_copied)
+
+        if verify:
+            mismatches = verify_repacked_hdf5(hdf5_path, repacked_path)
+            if mismatches:
+                repacked_path.unlink()
+                cleanup_file(get_hdf5_lock_path(repacked_path))
+                raise ValueError(f"Repacked file differs from {hdf5_path.name} at {mismatches[:5]}, "
+                                 f"source kept unchanged")
+
+        os.replace(repacked_path, hdf5_path)
+
+    cleanup_file(get_hdf5_lock_path(repacked_path))
+
+    return {
+        "size_before": size_before / 1024 ** 2,
+        "size_after": hdf5_path.stat().st_size / 1024 ** 2,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+def start_repack_hdf5(hdf5_path, apply_policy=True, verify=True):
+    """
+    Runs repack_hdf5 in a background thread. The state of the job is kept in REPACK_JOBS[str(hdf5_path)]:
+    status ("running", "done" or "failed"), progress (0 to 1), result (see repack_hdf5) and error message.
+
+    Args:
+        hdf5_path (str or Path): The HDF5 file to repack.
+        apply_policy (bool, optional): Rewrites numeric datasets with STORAGE_POLICY. Defaults to True.
+        verify (bool, optional): Compares the repacked file with the source before replacing it. Defaults to True.
+    Returns:
+        dict: The job state, None if a repack of this file is already running.
+    """
+    key = str(hdf5_path)
+    if REPACK_JOBS.get(key, {}).get("status") == "running":
+        return None
+
+    job = {"status": "running", "progress": 0.0, "result": None, "error": None}
+    REPACK_JOBS[key] = job
+
+    def run():
+        try:
+            job["result"] = repack_hdf5(
+                hdf5_path, apply_policy, verify, progress=lambda fraction: job.__setitem__("progress", fraction)
+            )
+            job["status"] = "done"
+        except Exception as error:
+            job["error"] = str(error)
+            job["status"] = "failed"
+
+    threading.Thread(target=run, name=f"repack {Path(hdf5_path).name}", daemon=True).start()
+
+    return job
@@ -4,7 +4,7 @@ Functions for EDX parsing
 from ..functions.functions_shared import *
 from ..hdf5_compilers.hdf5compile_base import *
 
-EDX_WRITER_VERSION = '0.1 beta'
+EDX_WRITER_VERSION = '0.2 beta'
 
 def visit_items(item, edx_dict=None):
     """
@@ -266,13 +266,14 @@ def write_edx_to_hdf5(hdf5_path, source_path, dataset_name = None):
     if dataset_name is None:
         dataset_name = source_path.stem
 
-    with h5py.File(hdf5_path, "a") as hdf5_file:
+    # Instrument metadata is staged in memory, then written once for the items shared by all positions
+    with open_hdf5(hdf5_path, "a") as hdf5_file, make_scratch_hdf5() as scratch_file:
         edx_group = hdf5_file.create_group(f"{dataset_name}")
         edx_group.attrs["HT_type"] = "edx"
         edx_group.attrs["instrument"] = "Bruker Quantax Xflash-7"
         edx_group.attrs["edx_writer"] = EDX_WRITER_VERSION
 
-        for file_name in safe_rglob(source_path, pattern='*.spx'):
+        for file_name in catalog_glob(make_file_catalog(source_path), '*.spx'):
             file_path = source_path / file_name
 
             scan_numbers = get_position_from_path(file_path)
@@ -296,19 +297,23 @@ def write_edx_to_hdf5(hdf5_path, source_path, dataset_name = None):
             # Result group
             results = scan.create_group("results")
             results.attrs["NX_class"] = "HTresult"
-            set_instrument_and_result_from_dict(edx_dict, instrument, results)
+            set_instrument_and_result_from_dict(edx_dict, scratch_file.create_group(scan.name.split("/")[-1]), results)
 
             # Measurement group
             data = scan.create_group("measurement")
             data.attrs["NX_class"] = "HTdata"
 
             counts = data.create_dataset(
-                "counts", (len(channels),), data=channels, dtype="int"
+                "counts", (len(channels),), data=channels, dtype="int",
+                **get_storage_options("edx", "spectrum", (len(channels),), "int"),
             )
             energy = data.create_dataset(
-                "energy", (len(energy),), data=energy, dtype="float"
+                "energy", (len(energy),), data=energy, dtype="float",
+                **get_storage_options("edx", "spectrum", (len(energy),)),
             )
             counts.attrs["units"] = "cps"
             energy.attrs["units"] = "keV"
 
+        write_deduplicated_metadata(scratch_file, edx_group)
+
         return None
\ No newline at end of file
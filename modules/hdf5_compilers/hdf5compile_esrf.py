@@ -2,10 +2,17 @@
 Functions for XRD parsing (Rigaku SmartLab and ESRF NeXuS)
 """
 
+import time
+from collections import deque
+
 from ..functions.functions_shared import *
+from ..functions.functions_xrd import xrd_parse_refinement_value
 from ..hdf5_compilers.hdf5compile_base import *
 
 ESRF_WRITER_VERSION = "0.1 beta"
+XRD_RESULTS_WRITER_VERSION = "0.2"
+REFINEMENT_UNITS = {"A": "nm", "B": "nm", "C": "nm"}
+ESRF_MEMORY_LIMIT_MB = 512
 
 
 def return_cdte_source_path(dataset_group):
@@ -129,7 +136,201 @@ def get_results_from_refinement(filepath):
     return r_coeffs, global_params, phases
 
 
-def write_esrf_to_hdf5(hdf5_path, source_path, dataset_name):
+def esrf_make_scan_index(esrf_group):
+    """
+    Map the scan names of an ESRF dataset (index attribute, e.g. "12.1") to their position groups, reading every
+    position once so that processed data and refinement results can be matched in linear time
+
+    Args:
+        esrf_group (h5py.Group): ESRF dataset group
+    Returns:
+        dict: scan name -> position group (h5py.Group), alignment scans excluded. If several positions share a
+            scan name, the first one is kept, as the former sequential search did
+    """
+    scan_index = {}
+    for position, position_group in get_position_groups(esrf_group):
+        if "index" in position_group.attrs:
+            scan_index.setdefault(position_group.attrs["index"], position_group)
+
+    return scan_index
+
+
+def esrf_link_or_copy(source_file, source_object, target_group, target_name, link_mode):
+    """
+    Reference an object of a beamline file from the sample file, either as a physical copy or as an external link
+
+    Args:
+        source_file (h5py.File): opened beamline file
+        source_object (h5py.Group or h5py.Dataset): object to reference
+        target_group (h5py.Group): group of the sample file receiving the object
+        target_name (str): name of the object in target_group
+        link_mode (str): "copy" or "link"
+    Returns:
+        None
+    """
+    if link_mode == "link":
+        target_group[target_name] = h5py.ExternalLink(
+            str(Path(source_file.filename).resolve()), source_object.name
+        )
+    else:
+        source_file.copy(source_object, target_group, target_name)
+
+
+def esrf_link_detector_stack(source_path, source_dataset_path, target_group, target_name):
+    """
+    Create a virtual dataset mapping a whole detector stack of a beamline file, no data is copied
+
+    Args:
+        source_path (Path): detector file
+        source_dataset_path (str): path of the image stack in the detector file
+        target_group (h5py.Group): group of the sample file receiving the stack
+        target_name (str): name of the virtual dataset
+    Returns:
+        None
+    """
+    with h5py.File(source_path, "r") as source_file:
+        source_dataset = source_file[source_dataset_path]
+        shape, dtype = source_dataset.shape, source_dataset.dtype
+
+    layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+    layout[...] = h5py.VirtualSource(str(Path(source_path).resolve()), source_dataset_path, shape=shape)
+    target_group.create_virtual_dataset(target_name, layout)
+
+
+def esrf_read_detector_frames(source_path, dataset_path, start, stop):
+    """
+    Read a block of frames from a detector file, run in the worker processes of esrf_copy_detector_stacks
+
+    Args:
+        source_path (str or Path): detector file
+        dataset_path (str): path of the image stack in the detector file
+        start (int): first frame
+        stop (int): last frame (excluded)
+    Returns:
+        np.array: (stop - start, ...) frames
+    """
+    with h5py.File(source_path, "r") as source_file:
+        return source_file[dataset_path][start:stop]
+
+
+def esrf_copy_detector_stacks(hdf5_path, copy_jobs, memory_limit_mb=ESRF_MEMORY_LIMIT_MB, n_workers=None):
+    """
+    Copy detector stacks into preallocated, frame-chunked and compressed datasets. Frames are read in blocks by
+    parallel worker processes and written by the calling process, the number of blocks in flight is bounded so that
+    the frames held in memory never exceed memory_limit_mb. The worker processes are started while the sample file
+    is closed, so that they do not inherit its open HDF5 handles. If a block cannot be read or written, the
+    preallocated stacks are removed before the error is raised again.
+
+    Args:
+        hdf5_path (str or Path): The sample file, must not be open in the calling process.
+        copy_jobs (list): (source_path, dataset_path, target_path) for every stack to copy, target_path being the
+            path of the copy in the sample file.
+        memory_limit_mb (float): Memory ceiling for the frames in flight (MB).
+        n_workers (int): Number of reading processes, defaults to the number of CPUs. 1 reads in the current process.
+    Returns:
+        dict: Copied bytes, elapsed time (s) and throughput (MB/s).
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(copy_jobs)))
+    memory_limit = memory_limit_mb * 1024 ** 2
+    # Two blocks per worker in flight: one being read, one waiting to be written
+    n_in_flight = 2 * n_workers
+
+    # Preallocate all targets and split every stack in blocks fitting the memory ceiling
+    block_list = []
+    target_list = []
+    try:
+        with open_hdf5(hdf5_path, "a") as hdf5_file:
+            for source_path, dataset_path, target_path in copy_jobs:
+                with h5py.File(source_path, "r") as source_file:
+                    source_dataset = source_file[dataset_path]
+                    shape, dtype = source_dataset.shape, source_dataset.dtype
+                    target_dataset = hdf5_file.create_dataset(
+                        target_path, shape=shape, dtype=dtype, **get_storage_options("esrf", "stack", shape, dtype)
+                    )
+                    target_list.append(target_path)
+                    target_dataset.attrs.update(source_dataset.attrs)
+
+                frame_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+                block_frames = int(max(1, min(shape[0], memory_limit // (n_in_flight * max(frame_bytes, 1)))))
+                for start in range(0, shape[0], block_frames):
+                    block_list.append((str(source_path), dataset_path, start, min(start + block_frames, shape[0]),
+                                       target_path))
+
+        start_time = time.perf_counter()
+        copied_bytes = 0
+        executor = start_process_pool(n_workers) if n_workers > 1 else None
+        try:
+            with open_hdf5(hdf5_path, "a") as hdf5_file:
+                pending = deque()
+                for source_path, dataset_path, start, stop, target_path in block_list:
+                    if executor is None:
+                        frames = esrf_read_detector_frames(source_path, dataset_path, start, stop)
+                        hdf5_file[target_path][start:stop] = frames
+                        copied_bytes += frames.nbytes
+                        continue
+
+                    pending.append(
+                        (executor.submit(esrf_read_detector_frames, source_path, dataset_path, start, stop),
+                         target_path, start, stop)
+                    )
+                    # Write the oldest block before reading more, keeps the memory bounded
+                    while len(pending) >= n_in_flight:
+                        future, pending_path, pending_start, pending_stop = pending.popleft()
+                        frames = future.result()
+                        hdf5_file[pending_path][pending_start:pending_stop] = frames
+                        copied_bytes += frames.nbytes
+
+                while pending:
+                    future, pending_path, pending_start, pending_stop = pending.popleft()
+                    frames = future.result()
+                    hdf5_file[pending_path][pending_start:pending_stop] = frames
+                    copied_bytes += frames.nbytes
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    except BaseException:
+        # Preallocated stacks read as frames of zeros, remove the stacks of a failed copy
+        with open_hdf5(hdf5_path, "a") as hdf5_file:
+            for target_path in target_list:
+                if target_path in hdf5_file:
+                    del hdf5_file[target_path]
+        raise
+
+    elapsed = time.perf_counter() - start_time
+    return {
+        "bytes": copied_bytes,
+        "seconds": elapsed,
+        "MB/s": copied_bytes / 1024 ** 2 / elapsed if elapsed > 0 else float("nan"),
+    }
+
+
+def write_esrf_to_hdf5(hdf5_path, source_path, dataset_name, link_mode="copy", n_workers=None,
+                       memory_limit_mb=ESRF_MEMORY_LIMIT_MB):
+    """
+    Writes an ESRF bm02 experiment (RAW_DATA and PROCESSED_DATA NeXuS files) to the HDF5 file.
+
+    With link_mode="link", the instrument trees, ROI counters, falconx spectra and CdTe detector stacks are
+    referenced through external links and virtual datasets instead of being copied: the sample file stays small
+    but needs the beamline files at their current location, see esrf_materialize_dataset to make it standalone.
+    Positions and integrated patterns are always stored in the sample file.
+    In copy mode, the CdTe detector stacks are copied after the scan metadata and the integrated patterns, see
+    esrf_copy_detector_stacks. The dataset is removed if the copy fails.
+
+    Args:
+        hdf5_path (str or Path): The path to the HDF5 file.
+        source_path (str or Path): Folder containing the RAW_DATA and PROCESSED_DATA files.
+        dataset_name (str): Name of the dataset, defaults to the source folder name.
+        link_mode (str): "copy" or "link".
+        n_workers (int): Number of processes reading the detector files.
+        memory_limit_mb (float): Memory ceiling for the detector frames in flight (MB).
+    Returns:
+        dict: Detector copy statistics (bytes, seconds, MB/s), None in link mode.
+    """
+    if link_mode not in ["copy", "link"]:
+        raise ValueError(f"Unknown link mode {link_mode}, use copy or link.")
+
     if isinstance(hdf5_path, str):
         hdf5_path = Path(hdf5_path)
     if isinstance(source_path, str):
@@ -140,7 +341,7 @@ def write_esrf_to_hdf5(hdf5_path, source_path, dataset_name):
     if dataset_name is None:
         dataset_name = source_path.stem
 
-    for file in safe_rglob(source_path, pattern="*.h5"):
+    for file in catalog_glob(make_file_catalog(source_path), "*.h5"):
         if "PROCESSED_DATA" in str(file):
             processed_h5_path = file
             raw_h5_path = Path(file.as_posix().replace("PROCESSED_DATA", "RAW_DATA"))
@@ -150,14 +351,17 @@ def write_esrf_to_hdf5(hdf5_path, source_path, dataset_name):
     if raw_h5_path is None:
         raise NameError("Couldn't locate RAW_DATA H5 file")
 
-    with h5py.File(hdf5_path, "a") as hdf5_file:
+    with open_hdf5(hdf5_path, "a") as hdf5_file:
         with h5py.File(raw_h5_path, "r") as raw_source:
             esrf_group = hdf5_file.create_group(dataset_name)
             esrf_group.attrs["HT_type"] = "xrd"
             esrf_group.attrs["instrument"] = "bm02 - esrf"
             esrf_group.attrs["esrf_writer"] = ESRF_WRITER_VERSION
+            esrf_group.attrs["esrf_link_mode"] = link_mode
 
             alignment_group = esrf_group.create_group("alignment_scans")
+            scan_index = {}
+            copy_jobs = []
             for name, group in raw_source.items():
                 alignment_test, alignment_type = esrf_check_if_alignment(group)
 
@@ -175,24 +379,37 @@ def write_esrf_to_hdf5(hdf5_path, source_path, dataset_name):
                     target_position_group = esrf_group.create_group(
                         f"({x_pos},{y_pos})"
                     )
+                    scan_index[name] = target_position_group
 
                 target_position_group.attrs["index"] = name
                 target_position_group.attrs["ignored"] = False
 
-                # Brutal copy of instrument group, it's a dump anyway
-                raw_source.copy(
-                    source_instrument_group, target_position_group, expand_soft=True
-                )
-                rename_group(
-                    target_position_group,
-                    "instrument/positioners/xsamp",
-                    "instrument/x_pos",
-                )
-                rename_group(
-                    target_position_group,
-                    "instrument/positioners/ysamp",
-                    "instrument/y_pos",
-                )
+                if link_mode == "link":
+                    # Positions are needed for every plot, keep them local and link the rest of the instrument
+                    target_instrument_group = target_position_group.create_group("instrument")
+                    for subname, subgroup in source_instrument_group.items():
+                        esrf_link_or_copy(raw_source, subgroup, target_instrument_group, subname, link_mode)
+                    target_instrument_group["x_pos"] = source_instrument_group["positioners/xsamp"][()]
+                    target_instrument_group["y_pos"] = source_instrument_group["positioners/ysamp"][()]
+                    for position_name in ["x_pos", "y_pos"]:
+                        target_instrument_group[position_name].attrs.update(
+                            source_instrument_group[f"positioners/{position_name[0]}samp"].attrs
+                        )
+                else:
+                    # Brutal copy of instrument group, it's a dump anyway
+                    raw_source.copy(
+                        source_instrument_group, target_position_group, expand_soft=True
+                    )
+                    rename_group(
+                        target_position_group,
+                        "instrument/positioners/xsamp",
+                        "instrument/x_pos",
+                    )
+                    rename_group(
+                        target_position_group,
+                        "instrument/positioners/ysamp",
+                        "instrument/y_pos",
+                    )
 
                 # Put some basic order in the measurement group
                 target_measurement_group = target_position_group.create_group(
@@ -202,12 +419,13 @@ def write_esrf_to_hdf5(hdf5_path, source_path, dataset_name):
                     if subname == "CdTe":
                         cdte_path = return_cdte_source_path(subgroup)
                         abs_cdte_path = raw_h5_path.parent / cdte_path
-                        with h5py.File(abs_cdte_path, "r") as cdte_source:
-                            cdte_measurement_group = cdte_source.get(
-                                "entry_0000/measurement"
+                        if link_mode == "link":
+                            esrf_link_detector_stack(
+                                abs_cdte_path, "entry_0000/measurement/data", target_measurement_group, "CdTe"
                             )
-                            cdte_measurement_group.copy(
-                                "data", target_measurement_group, "CdTe"
+                        else:
+                            copy_jobs.append(
+                                (abs_cdte_path, "entry_0000/measurement/data", f"{target_measurement_group.name}/CdTe")
                             )
 
                     if "CdTe_" in subname:
@@ -215,118 +433,334 @@ def write_esrf_to_hdf5(hdf5_path, source_path, dataset_name):
                         roi_group = safe_create_new_subgroup(
                             target_measurement_group, f"CdTe_roi_{roi_name}"
                         )
-                        raw_source.copy(subgroup, roi_group)
+                        esrf_link_or_copy(raw_source, subgroup, roi_group, subname, link_mode)
                     elif "falconx" in subname:
                         falconx_group = safe_create_new_subgroup(
                             target_measurement_group, "falconx"
                         )
-                        raw_source.copy(subgroup, falconx_group)
+                        esrf_link_or_copy(raw_source, subgroup, falconx_group, subname, link_mode)
                     elif subname in source_instrument_group:
                         continue
                     else:
-                        raw_source.copy(subgroup, target_measurement_group)
+                        esrf_link_or_copy(raw_source, subgroup, target_measurement_group, subname, link_mode)
 
         with h5py.File(processed_h5_path, "r") as processed_source:
             for name, group in processed_source.items():
                 integrate_group = group.get("CdTe_integrate")
-                for target_name, target_group in esrf_group.items():
-                    if "alignment" in target_name:
-                        continue
-                    if target_group.attrs["index"] == name:
-                        target_position_group = esrf_group.get(target_name)
-                        target_instrument_group = target_position_group.get(
-                            "instrument"
-                        )
-                        processed_source.copy(integrate_group, target_instrument_group)
+                target_position_group = scan_index.get(name)
+                if target_position_group is None:
+                    continue
+                target_instrument_group = target_position_group.get(
+                    "instrument"
+                )
+                processed_source.copy(integrate_group, target_instrument_group)
 
-                        target_measurement_group = target_position_group.get(
-                            "measurement"
-                        )
-                        target_integrated_group = target_instrument_group.get(
-                            "CdTe_integrate/integrated"
-                        )
-                        processed_source.copy(
-                            target_integrated_group,
-                            target_measurement_group,
-                            "CdTe_integrate",
-                        )
-                        del target_integrated_group
+                target_measurement_group = target_position_group.get(
+                    "measurement"
+                )
+                target_integrated_group = target_instrument_group.get(
+                    "CdTe_integrate/integrated"
+                )
+                processed_source.copy(
+                    target_integrated_group,
+                    target_measurement_group,
+                    "CdTe_integrate",
+                )
+                del target_integrated_group
+
+    # The sample file is closed while the reading processes start
+    copy_statistics = None
+    if copy_jobs:
+        try:
+            copy_statistics = esrf_copy_detector_stacks(hdf5_path, copy_jobs, memory_limit_mb, n_workers)
+        except BaseException:
+            # A dataset without its detector images would block the next ingestion of the same experiment
+            with open_hdf5(hdf5_path, "a") as hdf5_file:
+                if dataset_name in hdf5_file:
+                    del hdf5_file[dataset_name]
+            raise
+
+    return copy_statistics
+
+
+def esrf_open_virtual_dataset(hdf5_group, name, source_folder):
+    """
+    Open a virtual dataset with its relative source files resolved from source_folder. Virtual datasets copied
+    from a beamline file keep source paths relative to that file, which would otherwise be looked up next to the
+    sample file and read as fill values. The dataset must not be open elsewhere, the library would keep the
+    sources of the first opening.
+
+    Args:
+        hdf5_group (h5py.Group): Group holding the virtual dataset.
+        name (str): Name of the virtual dataset in hdf5_group.
+        source_folder (Path): Folder of the file in which the virtual dataset was defined.
+    Returns:
+        h5py.Dataset: The virtual dataset, reading from the right source files.
+    """
+    dataset_path = f"{hdf5_group.name}/{name}"
+    dcpl = hdf5_group[name].id.get_create_plist()
+    for i in range(dcpl.get_virtual_count()):
+        source_name = dcpl.get_virtual_filename(i)
+        if source_name == ".":
+            continue
+        source_path = Path(source_name)
+        if not source_path.is_absolute():
+            source_path = Path(source_folder) / source_path
+        if not source_path.is_file():
+            raise FileNotFoundError(f"Source file {source_path} of {dataset_path} not found, can not materialize it.")
+
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    dapl.set_virtual_prefix(str(Path(source_folder).resolve()).encode())
+    return h5py.Dataset(h5py.h5d.open(hdf5_group.file.id, dataset_path.encode(), dapl=dapl))
+
+
+def esrf_materialize_group(hdf5_group, chunk_frames=16, source_folder=None):
+    """
+    Replace, recursively, every external link and virtual dataset of a group by a physical copy of its data.
+    Detector stacks are copied a few frames at a time to keep memory bounded.
+
+    Args:
+        hdf5_group (h5py.Group): Group of the sample file, opened in append mode.
+        chunk_frames (int): Number of detector frames copied at once.
+        source_folder (Path): Folder resolving the relative sources of the virtual datasets, defaults to the
+            folder of the sample file. Set to the folder of the beamline file for the groups copied from it.
+    Returns:
+        int: Number of links and virtual datasets replaced.
+    """
+    if source_folder is None:
+        source_folder = Path(hdf5_group.file.filename).resolve().parent
+
+    n_materialized = 0
+
+    for name in list(hdf5_group.keys()):
+        link = hdf5_group.get(name, getlink=True)
+        item_source_folder = source_folder
+
+        if isinstance(link, h5py.ExternalLink):
+            external_path = Path(link.filename)
+            if not external_path.is_absolute():
+                external_path = source_folder / external_path
+            if not external_path.is_file():
+                raise FileNotFoundError(f"Linked file {external_path} not found, can not materialize it.")
+            temp_name = f"{name}_materialize"
+            hdf5_group.copy(hdf5_group[name], hdf5_group, temp_name, expand_soft=True, expand_external=True)
+            del hdf5_group[name]
+            hdf5_group.move(temp_name, name)
+            item_source_folder = external_path.resolve().parent
+            n_materialized += 1
+
+        item = hdf5_group.get(name)
+        if isinstance(item, h5py.Group):
+            n_materialized += esrf_materialize_group(item, chunk_frames, item_source_folder)
+        elif isinstance(item, h5py.Dataset) and item.is_virtual:
+            # Reopened with the source folder of the beamline file, no other handle may stay open
+            del item
+            item = esrf_open_virtual_dataset(hdf5_group, name, item_source_folder)
+            temp_name = f"{name}_materialize"
+            target_dataset = hdf5_group.create_dataset(
+                temp_name, shape=item.shape, dtype=item.dtype,
+                **get_storage_options("esrf", "stack" if item.ndim > 2 else "pattern", item.shape, item.dtype),
+            )
+            target_dataset.attrs.update(item.attrs)
+            if item.ndim > 1:
+                for start in range(0, item.shape[0], chunk_frames):
+                    target_dataset[start:start + chunk_frames] = item[start:start + chunk_frames]
+            else:
+                target_dataset[...] = item[()]
+            del hdf5_group[name]
+            hdf5_group.move(temp_name, name)
+            n_materialized += 1
+
+    return n_materialized
+
+
+def esrf_materialize_dataset(hdf5_path, dataset_name):
+    """
+    Copy all the beamline data referenced by an ESRF dataset written with link_mode="link" into the sample file,
+    so that the file can be moved without the RAW_DATA folder.
+
+    Args:
+        hdf5_path (str or Path): The path to the HDF5 file.
+        dataset_name (str): Name of the ESRF dataset.
+    Returns:
+        int: Number of links and virtual datasets replaced.
+    """
+    with open_hdf5(hdf5_path, "a") as hdf5_file:
+        esrf_group = hdf5_file[dataset_name]
+        n_materialized = esrf_materialize_group(esrf_group)
+        esrf_group.attrs["esrf_link_mode"] = "copy"
+
+    return n_materialized
+
+
+def write_refinement_value_to_hdf5(node, key, value, units=None):
+    """
+    Writes a refined value as a float dataset (NaN for UNDEF), with its uncertainty in key_uncertainty if the
+    value has one. Non numeric values (space group, Hermann-Mauguin symbol...) are kept as strings.
+
+    Args:
+        node (h5py.Group): The HDF5 group to write the value to.
+        key (str): Name of the value.
+        value (str): Value as written in the .lst file, e.g. "0.28705+-0.00012".
+        units (str): Units of the value, None to use REFINEMENT_UNITS.
+    Returns:
+        None
+    """
+    if units is None:
+        units = REFINEMENT_UNITS.get(key)
+    if isinstance(value, bytes):
+        value = value.decode()
+
+    parsed = xrd_parse_refinement_value(value)
+    if parsed is None:
+        node[key] = str(value).replace('"', "")
+        return None
+
+    node.create_dataset(key, data=parsed[0], dtype="float")
+    if "+-" in str(value) or str(value).strip().startswith("UNDEF"):
+        node.create_dataset(f"{key}_uncertainty", data=parsed[1], dtype="float")
+    for name in [key, f"{key}_uncertainty"]:
+        if units is not None and name in node:
+            node[name].attrs["units"] = units
+
+    return None
+
+
+def write_refinement_dict_to_hdf5(refinement_dict, node):
+    """
+    Writes the dictionaries of get_results_from_refinement to the HDF5 node with typed values, see
+    write_refinement_value_to_hdf5.
+
+    Args:
+        refinement_dict (dict): R-factors or phases dictionary.
+        node (h5py.Group): The HDF5 group to write the data to.
+    Returns:
+        None
+    """
+    for key, value in refinement_dict.items():
+        if isinstance(value, dict):
+            write_refinement_dict_to_hdf5(value, node.create_group(key))
+        elif isinstance(value, list):
+            node.create_dataset(key, data=value)
+        elif key == "UNIT":
+            continue
+        elif isinstance(value, str) and value.strip().endswith("%"):
+            write_refinement_value_to_hdf5(node, key, value, units="%")
+        else:
+            write_refinement_value_to_hdf5(node, key, value)
 
     return None
 
 
+def update_xrd_results_hdf5(xrd_group):
+    """
+    Function to update the refinement results of an XRD dataset written before typed results: string values are
+    converted to floats with their uncertainty.
+
+    @param xrd_group: XRD dataset group
+    @return: True if group has been updated, False if group was already up to date
+    """
+    if xrd_group.attrs.get("xrd_results_writer") == XRD_RESULTS_WRITER_VERSION:
+        return False
+
+    for position, position_group in get_position_groups(xrd_group):
+        value_groups = []
+        phases_group = position_group.get("results/phases")
+        if phases_group is not None:
+            value_groups += [phase_group for phase, phase_group in phases_group.items()]
+        r_coefficients_group = position_group.get("results/r_coefficients")
+        if r_coefficients_group is not None:
+            value_groups.append(r_coefficients_group)
+
+        for value_group in value_groups:
+            for key in list(value_group.keys()):
+                dataset = value_group[key]
+                if not isinstance(dataset, h5py.Dataset) or dataset.shape != () or dataset.dtype.kind in "fiu":
+                    continue
+                value = dataset[()]
+                value = value.decode() if isinstance(value, bytes) else str(value)
+                units = dataset.attrs.get("units")
+                if units is None and value.strip().endswith("%"):
+                    units = "%"
+                del value_group[key]
+                write_refinement_value_to_hdf5(value_group, key, value, units)
+
+    xrd_group.attrs["xrd_results_writer"] = XRD_RESULTS_WRITER_VERSION
+    return True
+
+
 def write_xrd_results_to_hdf5(hdf5_path, results_folderpath, target_dataset):
     if isinstance(hdf5_path, str):
         hdf5_path = Path(hdf5_path)
     if isinstance(results_folderpath, str):
         results_folderpath = Path(results_folderpath)
 
-    with h5py.File(hdf5_path, "a") as target:
+    with open_hdf5(hdf5_path, "a") as target:
 
         if target_dataset not in target:
             raise NameError("Couldn't locate target dataset")
 
         target_group = target.get(target_dataset)
-
-        for lst_filepath in safe_rglob(results_folderpath, pattern="*.lst"):
+        # Results from older versions are converted first, so the whole dataset shares the same layout
+        update_xrd_results_hdf5(target_group)
+        # Refinement files are named after the scan number, without the subscan. The first subscan of a scan
+        # number receives the results
+        scan_number_index = {}
+        for scan, group in esrf_make_scan_index(target_group).items():
+            scan_number_index.setdefault(scan.split(".")[0], group)
+
+        for lst_filepath in catalog_glob(make_file_catalog(results_folderpath), "*.lst"):
             dia_filepath = lst_filepath.with_suffix(".dia")
             file_index = str(lst_filepath.stem).split("_")[-1]
-            for name, group in target_group.items():
-                if name == "alignment_scans":
-                    continue
-                else:
-                    if group.attrs["index"].split(".")[0] == file_index:
-                        r_coeffs, global_params, phases = get_results_from_refinement(
-                            lst_filepath
-                        )
-
-                        column_names = [
-                            "Angle",
-                            "Total Counts",
-                            "Calculated",
-                            "Background",
-                        ] + list(phases)
-
-                        df = pd.read_csv(
-                            dia_filepath,
-                            sep=r"\s+",
-                            engine="python",
-                            skiprows=1,
-                            header=None,
-                            names=column_names,
-                        )
-                        df["Residual"] = df["Total Counts"] - df["Calculated"]
-
-                        target_results_group = safe_create_new_subgroup(
-                            group, "results"
-                        )
-
-                        r_coeffs_group = target_results_group.create_group(
-                            "r_coefficients"
-                        )
-                        write_dict_to_hdf5(r_coeffs, r_coeffs_group)
-
-                        phases_group = target_results_group.create_group("phases")
-                        write_dict_to_hdf5(phases, phases_group)
-                        for structure, value in global_params.items():
-                            check = False
-                            for phase, phase_group in phases_group.items():
-                                if phase == structure[1:]:
-                                    phase_group.create_dataset(
-                                        "phase_fraction", data=global_params[structure]
-                                    )
-                                    check = True
-                                    break
-                            if not check:
-                                phase_group = phases_group.create_group(structure[1:])
-                                phase_group.create_dataset(
-                                    "phase_fraction", data=global_params[structure]
-                                )
-
-                        fit_group = target_results_group.create_group("fits")
-                        for col in df.columns:
-                            node = fit_group.create_dataset(
-                                col, data=np.array(df[col]), dtype="float"
-                            )
-
+            group = scan_number_index.get(file_index)
+            if group is None:
+                continue
+
+            r_coeffs, global_params, phases = get_results_from_refinement(
+                lst_filepath
+            )
+
+            column_names = [
+                "Angle",
+                "Total Counts",
+                "Calculated",
+                "Background",
+            ] + list(phases)
+
+            df = pd.read_csv(
+                dia_filepath,
+                sep=r"\s+",
+                engine="python",
+                skiprows=1,
+                header=None,
+                names=column_names,
+            )
+            df["Residual"] = df["Total Counts"] - df["Calculated"]
+
+            target_results_group = safe_create_new_subgroup(
+                group, "results"
+            )
+
+            r_coeffs_group = target_results_group.create_group(
+                "r_coefficients"
+            )
+            write_refinement_dict_to_hdf5(r_coeffs, r_coeffs_group)
+
+            phases_group = target_results_group.create_group("phases")
+            write_refinement_dict_to_hdf5(phases, phases_group)
+            for structure, value in global_params.items():
+                check = False
+                for phase, phase_group in phases_group.items():
+                    if phase == structure[1:]:
+                        write_refinement_value_to_hdf5(phase_group, "phase_fraction", global_params[structure])
+                        check = True
                         break
+                if not check:
+                    phase_group = phases_group.create_group(structure[1:])
+                    write_refinement_value_to_hdf5(phase_group, "phase_fraction", global_params[structure])
+
+            fit_group = target_results_group.create_group("fits")
+            for col in df.columns:
+                node = fit_group.create_dataset(
+                    col, data=np.array(df[col]), dtype="float"
+                )
@@ -0,0 +1,245 @@
+"""
+Schema migrations of the datasets written by previous versions of the writers.
+
+Every dataset group carries the version of its writer as an attribute (profil_writer, edx_writer...). MIGRATIONS
+lists, for each writer attribute, the patches bringing a dataset to a given version. Files can be migrated in place
+or to a copy, one at a time or a whole directory in parallel:
+    python -m modules.hdf5_compilers.hdf5compile_migrations /path/to/archive --dry-run
+"""
+import argparse
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from ..functions.functions_shared import flush_hdf5_session
+from ..hdf5_compilers.hdf5compile_base import *
+from ..hdf5_compilers.hdf5compile_edx import EDX_WRITER_VERSION
+from ..hdf5_compilers.hdf5compile_esrf import ESRF_WRITER_VERSION, XRD_RESULTS_WRITER_VERSION, update_xrd_results_hdf5
+from ..hdf5_compilers.hdf5compile_moke import MOKE_WRITER_VERSION
+from ..hdf5_compilers.hdf5compile_profil import PROFIL_WRITER_VERSION, profil_tag_results_type
+from ..hdf5_compilers.hdf5compile_xrd import SMARTLAB_WRITER_VERSION, smartlab_type_header_values
+
+# MIGRATIONS[writer attribute] = current version, version of datasets missing the attribute (None: not applicable),
+# HT_type of those datasets, and the (target version, description, patch) list in increasing version order.
+# A patch takes the dataset group and updates it in place.
+MIGRATIONS = {
+    "profil_writer": {
+        "version": PROFIL_WRITER_VERSION,
+        "default": None,
+        "HT_type": "profil",
+        "patches": [
+            ("0.2", "Tag results as fitted or manual", profil_tag_results_type),
+            ("0.3", "Store shared metadata in common_metadata", deduplicate_metadata_hdf5),
+        ],
+    },
+    "edx_writer": {
+        "version": EDX_WRITER_VERSION,
+        "default": None,
+        "HT_type": "edx",
+        "patches": [
+            ("0.2 beta", "Store shared metadata in common_metadata", deduplicate_metadata_hdf5),
+        ],
+    },
+    "smartlab_writer": {
+        "version": SMARTLAB_WRITER_VERSION,
+        "default": None,
+        "HT_type": "xrd",
+        "patches": [
+            ("0.2 beta", "Type the .ras header values", smartlab_type_header_values),
+            ("0.3 beta", "Store shared metadata in common_metadata", deduplicate_metadata_hdf5),
+        ],
+    },
+    "xrd_results_writer": {
+        "version": XRD_RESULTS_WRITER_VERSION,
+        "default": "0.1",
+        "HT_type": "xrd",
+        "patches": [
+            ("0.2", "Store refinement results as floats with uncertainties", update_xrd_results_hdf5),
+        ],
+    },
+    "moke_writer": {"version": MOKE_WRITER_VERSION, "default": None, "HT_type": "moke", "patches": []},
+    "esrf_writer": {"version": ESRF_WRITER_VERSION, "default": None, "HT_type": "xrd", "patches": []},
+}
+
+
+def parse_writer_version(version):
+    """
+    Converts a writer version tag ("0.3", "0.1 beta", "0.10") to a tuple that can be compared: the version numbers,
+    then 0 for a beta and 1 for a release, so that "0.10" comes after "0.9" and "0.3" after "0.3 beta".
+
+    Args:
+        version (str or bytes): The version tag.
+    Returns:
+        tuple: (version numbers, release flag).
+    """
+    if isinstance(version, bytes):
+        version = version.decode()
+    version = str(version).strip()
+    is_beta = "beta" in version
+    numbers = tuple(int(number) for number in version.replace("beta", "").strip().split("."))
+    return numbers, 0 if is_beta else 1
+
+
+def get_pending_migrations(dataset_group):
+    """
+    Lists the patches to apply to a dataset group to bring it to the current version of its writers.
+
+    Args:
+        dataset_group (h5py.Group): The dataset group.
+    Returns:
+        list: (writer attribute, target version, description, patch) tuples, in the order to apply them.
+    """
+    pending = []
+    for writer, migration in MIGRATIONS.items():
+        version = dataset_group.attrs.get(writer, None)
+        if version is None:
+            if migration["default"] is None or dataset_group.attrs.get("HT_type") != migration["HT_type"]:
+                continue
+            version = migration["default"]
+
+        source_version = parse_writer_version(version)
+        for target_version, description, patch in migration["patches"]:
+            if source_version < parse_writer_version(target_version):
+                pending.append((writer, target_version, description, patch))
+                source_version = parse_writer_version(target_version)
+
+        # Versions without layout changes only need the version tag
+        if source_version < parse_writer_version(migration["version"]):
+            pending.append((writer, migration["version"], "Update the version tag", None))
+
+    return pending
+
+
+def migrate_dataset(dataset_group, dry_run=False):
+    """
+    Applies the pending migrations of a dataset group. The writer attribute is updated after every patch, so that an
+    interrupted migration resumes where it stopped.
+
+    Args:
+        dataset_group (h5py.Group): The dataset group, from a file opened in write mode unless dry_run.
+        dry_run (bool, optional): Only lists the pending migrations. Defaults to False.
+    Returns:
+        list: Descriptions of the applied (or pending, if dry_run) migrations.
+    """
+    applied = []
+    for writer, target_version, description, patch in get_pending_migrations(dataset_group):
+        applied.append(f"{writer} {target_version}: {description}")
+        if dry_run:
+            continue
+        if patch is not None:
+            patch(dataset_group)
+        dataset_group.attrs[writer] = target_version
+
+    return applied
+
+
+def migrate_hdf5_file(hdf5_path, dry_run=False, output_path=None):
+    """
+    Migrates every dataset of a sample file.
+
+    Args:
+        hdf5_path (str or Path): The HDF5 file.
+        dry_run (bool, optional): Only lists the pending migrations, the file is opened read-only. Defaults to False.
+        output_path (str or Path, optional): Migrates a copy of the file at this path instead of the file itself.
+    Returns:
+        dict: Path of the migrated file, migrations applied by dataset name, and error message if it failed.
+    """
+    hdf5_path = Path(hdf5_path)
+    report = {"path": str(hdf5_path), "datasets": {}, "error": None}
+
+    try:
+        if output_path is not None and not dry_run:
+            output_path = Path(output_path)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            flush_hdf5_session(hdf5_path)
+            shutil.copy2(hdf5_path, output_path)
+            hdf5_path = output_path
+            report["path"] = str(output_path)
+
+        with open_hdf5(hdf5_path, "r" if dry_run else "a") as hdf5_file:
+            for dataset_name, dataset_group in hdf5_file.items():
+                if dataset_name == "sample" or "HT_type" not in dataset_group.attrs:
+                    continue
+                applied = migrate_dataset(dataset_group, dry_run)
+                if applied:
+                    report["datasets"][dataset_name] = applied
+    except Exception as error:
+        report["error"] = f"{type(error).__name__}: {error}"
+
+    return report
+
+
+def _migrate_hdf5_file_job(job):
+    # Module-level so that it can be sent to the worker processes
+    return migrate_hdf5_file(*job)
+
+
+def migrate_hdf5_directory(folder_path, dry_run=False, output_folder=None, n_workers=None):
+    """
+    Migrates all the sample files (.h5, .hdf5) of a directory tree, one file per worker process.
+
+    Args:
+        folder_path (str or Path): The directory to walk.
+        dry_run (bool, optional): Only lists the pending migrations. Defaults to False.
+        output_folder (str or Path, optional): Writes migrated copies in this folder, with the same tree, instead of
+            migrating the files in place.
+        n_workers (int, optional): Number of worker processes, defaults to the number of CPUs.
+    Returns:
+        list: The report of every file (see migrate_hdf5_file).
+    """
+    folder_path = Path(folder_path)
+    catalog = make_file_catalog(folder_path)
+    file_list = sorted(set(catalog_glob(catalog, "*.h5") + catalog_glob(catalog, "*.hdf5")))
+
+    jobs = []
+    for file_path in file_list:
+        output_path = None if output_folder is None else Path(output_folder) / file_path.relative_to(folder_path)
+        jobs.append((file_path, dry_run, output_path))
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(jobs)))
+    if n_workers == 1:
+        return [_migrate_hdf5_file_job(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_migrate_hdf5_file_job, jobs))
+
+
+def format_migration_report(reports, dry_run=False):
+    """
+    Summary of a directory migration: one line per migrated or failed file, then the totals.
+
+    Args:
+        reports (list): Reports of migrate_hdf5_directory.
+        dry_run (bool, optional): The reports come from a dry run. Defaults to False.
+    Returns:
+        str: The summary.
+    """
+    lines = []
+    n_migrated, n_failed = 0, 0
+    for report in reports:
+        if report["error"] is not None:
+            n_failed += 1
+            lines.append(f"FAILED   {report['path']}: {report['error']}")
+        elif report["datasets"]:
+            n_migrated += 1
+            lines.append(f"{'PENDING' if dry_run else 'MIGRATED':<8} {report['path']}")
+            for dataset_name, applied in report["datasets"].items():
+                lines += [f"    [{dataset_name}] {description}" for description in applied]
+
+    n_current = len(reports) - n_migrated - n_failed
+    lines.append(f"{len(reports)} files: {n_migrated} {'to migrate' if dry_run else 'migrated'}, "
+                 f"{n_current} up to date, {n_failed} failed")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the sample files of a directory to the current writers.")
+    parser.add_argument("folder", help="directory of sample files (.h5, .hdf5), walked recursively")
+    parser.add_argument("--dry-run", action="store_true", help="list the pending migrations without writing")
+    parser.add_argument("--output", default=None, help="write migrated copies to this folder instead")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    reports = migrate_hdf5_directory(args.folder, args.dry_run, args.output, args.workers)
+    print(format_migration_report(reports, args.dry_run))
@@ -214,7 +214,8 @@ def write_moke_to_hdf5(hdf5_path, source_path, dataset_name = None, mode="a"):
 
     found_info = False
     header_dict =  {}
-    for file_name in safe_rglob(source_path, pattern='info.txt'):
+    catalog = make_file_catalog(source_path)
+    for file_name in catalog_glob(catalog, 'info.txt'):
         file_path = source_path / file_name
         header_dict = read_header_from_moke(file_path)
         found_info = True
@@ -229,14 +230,14 @@ def write_moke_to_hdf5(hdf5_path, source_path, dataset_name = None, mode="a"):
 
     grouped_dict = defaultdict(list)
 
-    for file_name in safe_rglob(source_path, pattern='p*.txt'):
+    for file_name in catalog_glob(catalog, 'p*.txt'):
         match = re.search(pattern, str(file_name))
         if match:
             p_number = match.group(1)  # Extract p_number from measurement name
             file_path = source_path / file_name
             grouped_dict[p_number].append(file_path)  # Dictionary with measurements grouped by p_numbers
 
-    with h5py.File(hdf5_path, mode) as hdf5_file:
+    with open_hdf5(hdf5_path, mode) as hdf5_file:
         # Create the root group for the measurement
         moke_group = hdf5_file.create_group(f"{dataset_name}")
         moke_group.attrs["HT_type"] = "moke"
@@ -273,7 +274,9 @@ def write_moke_to_hdf5(hdf5_path, source_path, dataset_name = None, mode="a"):
             data = scan.create_group("measurement")
             data.attrs["HT_class"] = "HTmeasurement"
             time = [convertFloat(t) for t in time_dict]
-            time_node = data.create_dataset("time", data=time, dtype="float")
+            time_node = data.create_dataset(
+                "time", data=time, dtype="float", **get_storage_options("moke", "loop", np.shape(time))
+            )
             time_node.attrs["units"] = "μs"
 
             # Prepare arrays to generate mean
@@ -287,25 +290,29 @@ def write_moke_to_hdf5(hdf5_path, source_path, dataset_name = None, mode="a"):
                 shot_group = data.create_group(f"shot_{i+1}")
                 mag = [convertFloat(t[i]) for t in mag_dict]
                 mag_node = shot_group.create_dataset(
-                    f"magnetization_{i+1}", data=mag, dtype="float"
+                    f"magnetization_{i+1}", data=mag, dtype="float",
+                    **get_storage_options("moke", "loop", np.shape(mag)),
                 )
                 mag_arrays.append(mag)
 
                 pul = [convertFloat(t[i]) for t in pul_dict]
                 pul_node = shot_group.create_dataset(
-                    f"pulse_{i+1}", data=pul, dtype="float"
+                    f"pulse_{i+1}", data=pul, dtype="float",
+                    **get_storage_options("moke", "loop", np.shape(pul)),
                 )
                 pulse_arrays.append(pul)
 
                 integrated_pulse = moke_integrate_pulse_array(pul)
                 integrated_pulse_node = shot_group.create_dataset(
-                    f"integrated_pulse_{i+1}", data=integrated_pulse, dtype="float"
+                    f"integrated_pulse_{i+1}", data=integrated_pulse, dtype="float",
+                    **get_storage_options("moke", "loop", np.shape(integrated_pulse)),
                 )
                 integrated_pulse_arrays.append(integrated_pulse)
 
                 sum = [convertFloat(t[i]) for t in sum_dict]
                 sum_node = shot_group.create_dataset(
-                    f"reflectivity_{i+1}", data=sum, dtype="float"
+                    f"reflectivity_{i+1}", data=sum, dtype="float",
+                    **get_storage_options("moke", "loop", np.shape(sum)),
                 )
                 sum_arrays.append(sum)
 
@@ -322,16 +329,20 @@ def write_moke_to_hdf5(hdf5_path, source_path, dataset_name = None, mode="a"):
 
             shot_group = data.create_group("shot_mean")
             integrated_pulse_mean_node = shot_group.create_dataset(
-                "integrated_pulse_mean", data=mean_integrated_pulse, dtype="float"
+                "integrated_pulse_mean", data=mean_integrated_pulse, dtype="float",
+                **get_storage_options("moke", "loop", np.shape(mean_integrated_pulse)),
             )
             pulse_mean_node = shot_group.create_dataset(
-                "pulse_mean", data=mean_pulse, dtype="float"
+                "pulse_mean", data=mean_pulse, dtype="float",
+                **get_storage_options("moke", "loop", np.shape(mean_pulse)),
             )
             mag_mean_node = shot_group.create_dataset(
-                "magnetization_mean", data=mean_magnetization, dtype="float"
+                "magnetization_mean", data=mean_magnetization, dtype="float",
+                **get_storage_options("moke", "loop", np.shape(mean_magnetization)),
             )
             sum_mean_node = shot_group.create_dataset(
-                "reflectivity_mean", data=mean_reflectivity, dtype="float"
+                "reflectivity_mean", data=mean_reflectivity, dtype="float",
+                **get_storage_options("moke", "loop", np.shape(mean_reflectivity)),
             )
 
             pulse_mean_node.attrs["units"] = "V"
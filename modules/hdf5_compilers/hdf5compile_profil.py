@@ -1,19 +1,17 @@
 """
 Functions for DEKTAK parsing
 """
+import io
 
 from ..functions.functions_shared import *
 from ..hdf5_compilers.hdf5compile_base import *
 
-PROFIL_WRITER_VERSION = "0.2"
+PROFIL_WRITER_VERSION = "0.3"
 
 
-def read_header_from_dektak(file_path):
+def parse_dektak_header(lines):
     header_dict = {}
 
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-
     for line in lines[4:45]:
         split = line.strip().split(",")
         key, value = split[0], split[-1]
@@ -24,11 +22,30 @@ def read_header_from_dektak(file_path):
     return header_dict
 
 
-def read_data_from_dektak(file_path, header_length=46):
-    asc2d_dataframe = pd.read_csv(file_path, skiprows=header_length)
+def read_dektak(file_path, header_length=46):
+    """
+    Reads a .asc2d file with a single read: the header lines are parsed in Python and the numeric block is handed
+    to the C parser of pandas, without scanning the header again.
+
+    Args:
+        file_path (str or Path): Path to the .asc2d file.
+        header_length (int): Number of lines before the column names of the numeric block.
+    Returns:
+        tuple: header dictionary and dataframe with distance (um) and profile columns.
+    """
+    with open(file_path, "rb") as file:
+        content = file.read()
+
+    offset = 0
+    for _ in range(header_length):
+        offset = content.index(b"\n", offset) + 1
+
+    header_dict = parse_dektak_header(content[:offset].decode("utf-8", errors="replace").splitlines())
+
+    asc2d_dataframe = pd.read_csv(io.BytesIO(memoryview(content)[offset:]), engine="c")
     asc2d_dataframe.rename(columns={" z(raw/unitless)": "profile"}, inplace=True)
     asc2d_dataframe.rename(columns={"y(um)": "distance"}, inplace=True)
-    return asc2d_dataframe
+    return header_dict, asc2d_dataframe
 
 
 def position_from_tuple(scan_number):
@@ -67,18 +84,18 @@ def write_dektak_to_hdf5(hdf5_path, source_path, dataset_name=None, mode="a"):
     if dataset_name is None:
         dataset_name = source_path.stem
 
-    with h5py.File(hdf5_path, mode) as hdf5_file:
+    # Header metadata is staged in memory, then written once for the items shared by all positions
+    with open_hdf5(hdf5_path, mode) as hdf5_file, make_scratch_hdf5() as scratch_file:
         # Create the root group for the measurement
         profil_group = hdf5_file.create_group(f"{dataset_name}")
         profil_group.attrs["HT_type"] = "profil"
         profil_group.attrs["instrument"] = "Bruker DektakXT"
         profil_group.attrs["profil_writer"] = PROFIL_WRITER_VERSION
 
-        for file_name in safe_rglob(source_path, "*.asc2d"):
+        for file_name in catalog_glob(make_file_catalog(source_path), "*.asc2d"):
             file_path = source_path / file_name
 
-            header_dict = read_header_from_dektak(file_path)
-            asc2d_dataframe = read_data_from_dektak(file_path)
+            header_dict, asc2d_dataframe = read_dektak(file_path)
             scan_number = header_dict["TargetName"]
 
             x_pos, y_pos = position_from_tuple(scan_number)
@@ -96,20 +113,23 @@ def write_dektak_to_hdf5(hdf5_path, source_path, dataset_name=None, mode="a"):
             instrument["x_pos"].attrs["units"] = "mm"
             instrument["y_pos"].attrs["units"] = "mm"
 
-            set_instrument_from_dict(header_dict, instrument)
+            set_instrument_from_dict(header_dict, scratch_file.create_group(scan.name.split("/")[-1]))
 
             # Measurement group for data
             data = scan.create_group("measurement")
             data.attrs["NX_class"] = "HTmeasurement"
             for col in asc2d_dataframe.columns:
                 node = data.create_dataset(
-                    col, data=np.array(asc2d_dataframe[col]), dtype="float"
+                    col, data=np.array(asc2d_dataframe[col]), dtype="float",
+                    **get_storage_options("profil", "profile", asc2d_dataframe[col].shape),
                 )
                 if col == "profile":
                     node.attrs["unit"] = "nm"
                 elif col == "distance":
                     node.attrs["unit"] = "μm"
 
+        write_deduplicated_metadata(scratch_file, profil_group)
+
     return None
 
 
@@ -134,31 +154,17 @@ def write_dektak_results_to_hdf5(position_group, results_dict, overwrite=True):
     return None
 
 
-def update_dektak_hdf5(dektak_group):
+def profil_tag_results_type(dektak_group):
     """
-    Function to update an old version of a profilometry group to specs of newer versions.
+    Tags the results groups written before manual fits as fitted (profil writer 0.2).
 
-    @param dektak_group:
-    @return: True if group has been updated, False if group was already up to date
+    @param dektak_group: profilometry dataset group
+    @return: True if a results group has been tagged
     """
-    source_version = dektak_group.attrs["profil_writer"]
-
-    if source_version == PROFIL_WRITER_VERSION:
-        return False
-
-    if "beta" in source_version:
-        source_version = float(source_version.strip(" beta"))
-    else:
-        source_version = float(source_version)
-
-    if source_version < 0.2:
-        # Version 0.2 added manual vs fitted tags to results groups
-        for position, position_group in dektak_group.items():
-            results_group = position_group.get("results")
-            if results_group:
-                if "type" not in results_group.attrs:
-                    results_group.attrs["type"] = "fitted"
-        # end of patch
-
-        # Update the version tag to the current version
-        dektak_group.attrs["profil_writer"] = PROFIL_WRITER_VERSION
+    updated = False
+    for position, position_group in get_position_groups(dektak_group):
+        results_group = position_group.get("results")
+        if results_group and "type" not in results_group.attrs:
+            results_group.attrs["type"] = "fitted"
+            updated = True
+    return updated
@@ -6,8 +6,9 @@ import h5py
 
 from ..functions.functions_shared import *
 from ..hdf5_compilers.hdf5compile_base import *
+from ..functions.functions_xrd import xrd_cluster_patterns, xrd_read_poni, xrd_reintegrate_from_hdf5
 
-SMARTLAB_WRITER_VERSION = '0.1 beta'
+SMARTLAB_WRITER_VERSION = '0.3 beta'
 
 def get_scan_numbers(filename):
     """
@@ -27,8 +28,7 @@ def get_scan_numbers(filename):
     tuple
         A tuple containing the x and y scan numbers.
     """
-    pattern = r'_(\d+)(?:_\d+)?\.' # Regular expression to match with all different filename structures (img and ras/lst)
-    match = re.search(pattern, filename)
+    match = SCAN_NUMBER_PATTERN.search(filename) # Matches all different filename structures (img and ras/lst)
     idx = match.group(1)
 
     return idx
@@ -52,69 +52,131 @@ def group_files_by_position(filename_list, authorized_files=None):
     return grouped_dictionary
 
 
+RAS_PARSE_IGNORE = {
+    "*RAS_DATA_START",
+    "*RAS_HEADER_START",
+    "*RAS_HEADER_END",
+    "*RAS_INT_START",
+    "*RAS_INT_END",
+    "*RAS_TEMPERATURE_START",
+    "*RAS_TEMPERATURE_END",
+    "*RAS_DATA_END",
+}
+
+# Header keywords holding numbers, stored as float. Other values stay strings, so that identifiers such as sample
+# names or "0012" keep their leading zeros
+RAS_NUMERIC_KEYWORDS = re.compile(
+    r"\*(HW_XG_WAVE_LENGTH_(ALPHA1|ALPHA2|ALPHA12|BETA)|HW_XG_(VOLTAGE|CURRENT)|MEAS_COND_AXIS_POSITION-\d+"
+    r"|MEAS_SCAN_(START|STOP|STEP|SPEED)|MEAS_DATA_COUNT)"
+)
+
+
+def convert_ras_value(value, keyword=None):
+    """
+    Types a .ras header value: surrounding quotes are removed and the values of RAS_NUMERIC_KEYWORDS are converted
+    to float.
+
+    Parameters
+    ----------
+    value : str
+        Raw header value, e.g. '"1.540593"'
+    keyword : str
+        Header keyword, e.g. '*HW_XG_WAVE_LENGTH_ALPHA1'
+
+    Returns
+    -------
+    float or str
+        The typed value
+    """
+    value = value.strip().strip('"')
+    if keyword is not None and RAS_NUMERIC_KEYWORDS.fullmatch(keyword):
+        return convertFloat(value)
+    return value
+
+
 def read_data_from_ras(file_path):
     """
-    Reads a .ras file and returns the following dictionaries and a list:
+    Reads a .ras file in a single pass and returns the following dictionaries and an array:
 
-    disp_dict: A dictionary containing the values of the *DISP_ keywords
     file_dict: A dictionary containing the values of the *FILE_ keywords
     hw_dict: A dictionary containing the values of the *HW_ keywords
     meas_dict: A dictionary containing the values of the *MEAS_ keywords
-    data: A list of lists, where each sublist contains the data for a specific angle
+    data: A (n_angles, 2) array, first column is the angle, second the counts
+
+    Header values are typed with convert_ras_value, *DISP_ and internal *MEAS_ keywords are skipped. Every
+    *RAS_INT_START block is parsed with its own number of columns, the blocks are then concatenated.
 
     Returns
     -------
     tuple
-        A tuple containing the disp_dict, file_dict, hw_dict, meas_dict, and data
+        A tuple containing the file_dict, hw_dict, meas_dict, and data
     """
-    with open(file_path, "r", encoding="iso-8859-1") as file:
-        lines = file.readlines()
-
-    parse_ignore = [
-        "*RAS_DATA_START",
-        "*RAS_HEADER_START",
-        "*RAS_HEADER_END",
-        "*RAS_INT_START",
-        "*RAS_INT_END",
-        "*RAS_TEMPERATURE_START",
-        "*RAS_TEMPERATURE_END",
-        "*RAS_DATA_END",
-    ]
-    disp_dict = {}
     file_dict = {}
     hw_dict = {}
     meas_dict = {}
-    data = []
+    data_blocks = [[]]
+
+    with open(file_path, "r", encoding="iso-8859-1") as file:
+        for line in file:
+            if not line.startswith("*"):
+                # Numeric blocks, each parsed at once below
+                if line.strip():
+                    data_blocks[-1].append(line)
+                continue
 
-    # Split the header into different metadata types
-    for line in lines:
-        if line.startswith("*"):
             formatted_line = line.strip().split(" ", 1)
-            if formatted_line[0] not in parse_ignore:
-                # Skip DISP lines, they are useless outside the SmartLab software
-                if formatted_line[0].startswith("*DISP"):
-                    continue
+            keyword = formatted_line[0]
+            if keyword == "*RAS_INT_START":
+                data_blocks.append([])
+            if keyword in RAS_PARSE_IGNORE:
+                continue
+            value = convert_ras_value(formatted_line[1], keyword) if len(formatted_line) > 1 else ""
 
-                elif formatted_line[0].startswith("*FILE"):
-                    key = formatted_line[0].replace("*FILE_", "")
-                    file_dict[key] = formatted_line[1]
+            # DISP lines match no branch, they are useless outside the SmartLab software
+            if keyword.startswith("*FILE"):
+                file_dict[keyword.replace("*FILE_", "")] = value
+            elif keyword.startswith("*HW"):
+                hw_dict[keyword.replace("*HW_", "")] = value
+            elif keyword.startswith("*MEAS") and "INTERNAL" not in keyword:
+                meas_dict[keyword.replace("*MEAS_", "")] = value
 
-                elif formatted_line[0].startswith("*HW"):
-                    key = formatted_line[0].replace("*HW_", "")
-                    hw_dict[key] = formatted_line[1]
+    # Blocks may have different column counts, the angle and counts are the first two columns of each
+    blocks = [np.loadtxt(block_lines, dtype=float, ndmin=2)[:, :2] for block_lines in data_blocks if block_lines]
+    data = np.concatenate(blocks) if blocks else np.empty((0, 2))
 
-                elif formatted_line[0].startswith("*MEAS"):
-                    if "INTERNAL" in formatted_line[0]:
-                        continue
-                    else:
-                        key = formatted_line[0].replace("*MEAS_", "")
-                        meas_dict[key] = formatted_line[1]
+    return file_dict, hw_dict, meas_dict, data
 
-        else:
-            # Read the data inside the file
-            data.append([[elm] for elm in line.strip().split(" ")])
 
-    return file_dict, hw_dict, meas_dict, data
+def smartlab_type_header_values(xrd_group):
+    """
+    Migration patch to the 0.2 beta Smartlab layout: the .ras header values stored as raw strings by the 0.1 beta
+    writer are unquoted, and the values of RAS_NUMERIC_KEYWORDS are stored as float, as read_data_from_ras does.
+
+    Args:
+        xrd_group (h5py.Group): The Smartlab dataset group.
+    Returns:
+        None
+    """
+    keyword_prefixes = {"file": "*FILE_", "hardware": "*HW_", "parameters": "*MEAS_"}
+
+    for position, position_group in get_position_groups(xrd_group):
+        for group_name, prefix in keyword_prefixes.items():
+            header_group = position_group.get(f"instrument/{group_name}")
+            if header_group is None:
+                continue
+            for key in list(header_group.keys()):
+                dataset = header_group[key]
+                if not isinstance(dataset, h5py.Dataset) or dataset.shape != ():
+                    continue
+                value = dataset[()]
+                if not isinstance(value, bytes):
+                    continue
+                attributes = dict(dataset.attrs)
+                del header_group[key]
+                header_group[key] = convert_ras_value(value.decode(), prefix + key)
+                header_group[key].attrs.update(attributes)
+
+    return None
 
 
 def set_instrument_and_result_from_dict(xrd_dict, node):
@@ -187,21 +249,29 @@ def write_smartlab_to_hdf5(hdf5_path, source_path, dataset_name, mode="a"):
     if dataset_name is None:
         dataset_name = source_path.stem
 
-    with h5py.File(hdf5_path, mode) as hdf5_file:
+    # Metadata is staged in memory, then written once for the items shared by all positions
+    with open_hdf5(hdf5_path, mode) as hdf5_file, make_scratch_hdf5() as scratch_file:
         xrd_group = hdf5_file.create_group(dataset_name)
         xrd_group.attrs["HT_type"] = "xrd"
         xrd_group.attrs["instrument"] = "Rigaku Smartlab"
         xrd_group.attrs["smartlab_writer"] = SMARTLAB_WRITER_VERSION
 
-        for ras_name in safe_rglob(source_path, pattern="*.ras"):
+        # Walk the source tree once, images are then paired with their .ras through the scan number
+        catalog = make_file_catalog(source_path)
+
+        for ras_name in catalog_glob(catalog, "*.ras"):
             if "test" in str(ras_name):
                 continue
             ras_path = source_path / ras_name
             file_dict, hw_dict, meas_dict, data = read_data_from_ras(ras_path)
-            x_pos = float(meas_dict["COND_AXIS_POSITION-6"].strip('"'))
-            y_pos = float(meas_dict["COND_AXIS_POSITION-7"].strip('"'))
+            x_pos = float(meas_dict["COND_AXIS_POSITION-6"])
+            y_pos = float(meas_dict["COND_AXIS_POSITION-7"])
 
-            for img_name in safe_rglob(source_path, pattern="*.img"):
+            try:
+                scan_img_list = catalog_scan_files(catalog, get_scan_numbers(ras_name.name), "*.img")
+            except AttributeError:
+                scan_img_list = []
+            for img_name in scan_img_list:
                 if str(ras_path.stem) in str(img_name):
                     img_path = source_path / img_name
                     img_header, img_data = read_image_from_img(img_path)
@@ -219,32 +289,234 @@ def write_smartlab_to_hdf5(hdf5_path, source_path, dataset_name, mode="a"):
             instrument_group["x_pos"].attrs["units"] = "mm"
             instrument_group["y_pos"].attrs["units"] = "mm"
 
-            file_group = instrument_group.create_group("file")
+            metadata_group = scratch_file.create_group(position_group.name.split("/")[-1])
+
+            file_group = metadata_group.create_group("file")
             save_dict_to_hdf5(file_group, file_dict)
 
-            hw_group = instrument_group.create_group("hardware")
+            hw_group = metadata_group.create_group("hardware")
             save_dict_to_hdf5(hw_group, hw_dict)
 
-            meas_group = instrument_group.create_group("parameters")
+            meas_group = metadata_group.create_group("parameters")
             save_dict_to_hdf5(meas_group, meas_dict)
 
-            img_metadata_group = instrument_group.create_group("image")
+            img_metadata_group = metadata_group.create_group("image")
             save_dict_to_hdf5(img_metadata_group, img_header)
 
             # Data group
             measurement_group = position_group.create_group("measurement")
             measurement_group.attrs["NX_class"] = "HTmeasurement"
-            tth = [convertFloat(elm[0][0]) for elm in data]
-            counts = [convertFloat(elm[1][0]) for elm in data]
-            tth_group = measurement_group.create_dataset("angle", (len(tth),), data=tth, dtype="float")
-            counts = measurement_group.create_dataset(
-                "counts", (len(counts),), data=counts, dtype="float"
-            )
+            pattern_options = get_storage_options("xrd", "pattern", data[:, 0].shape)
+            tth_group = measurement_group.create_dataset("angle", data=data[:, 0], dtype="float", **pattern_options)
+            counts = measurement_group.create_dataset("counts", data=data[:, 1], dtype="float", **pattern_options)
 
             tth_group.attrs["units"] = "deg"
             counts.attrs["units"] = "counts"
 
             # Image group
-            measurement_group.create_dataset("2Dimage", img_data.shape, data=img_data)
+            measurement_group.create_dataset(
+                "2Dimage", img_data.shape, data=img_data,
+                **get_storage_options("xrd", "image", img_data.shape, img_data.dtype),
+            )
+
+        write_deduplicated_metadata(scratch_file, xrd_group)
+
+    return None
+
+
+def xrd_peaks_dict_to_hdf5(xrd_group, results_dict):
+    """
+    Writes the results of the quick-look peak analysis (see functions_xrd.xrd_batch_peak_analysis) to the
+    results/peaks group of every position, replacing previous peak results.
+
+    Args:
+        xrd_group (h5py.Group): The XRD dataset group.
+        results_dict (dict): results_dict[position][peak_name] = {"position", "fwhm", "integrated_intensity"}
+    Returns:
+        None
+    """
+    units_dict = {"position": "A-1", "fwhm": "A-1", "integrated_intensity": "counts.A-1"}
+
+    for position, peaks_dict in results_dict.items():
+        position_group = xrd_group.get(position)
+        if position_group is None:
+            continue
+
+        results_group = safe_create_new_subgroup(position_group, "results")
+        if "peaks" in results_group:
+            del results_group["peaks"]
+        peaks_group = results_group.create_group("peaks")
+
+        for peak, peak_dict in peaks_dict.items():
+            peak_group = peaks_group.create_group(peak)
+            for key, value in peak_dict.items():
+                peak_group[key] = value
+                peak_group[key].attrs["units"] = units_dict.get(key, "arb")
+
+    return None
+
+
+def xrd_reintegrated_to_hdf5(xrd_group, position_dataframe, q_array, chi_array, intensity_array, geometry):
+    """
+    Writes the output of the in-house azimuthal integration (see functions_xrd.xrd_reintegrate_from_hdf5) to the
+    measurement/reintegrated group of every position, replacing a previous integration.
+
+    Args:
+        xrd_group (h5py.Group): The XRD dataset group.
+        position_dataframe (pandas.DataFrame): Positions, in the order of intensity_array.
+        q_array (np.array): q bin centers (A-1).
+        chi_array (np.array): chi bin centers (deg).
+        intensity_array (np.array): (n_positions, n_chi, n_q) integrated intensities.
+        geometry (dict): Detector geometry used for the integration.
+    Returns:
+        None
+    """
+    for position, intensity in zip(position_dataframe["position"], intensity_array):
+        measurement_group = xrd_group[position].get("measurement")
+        if "reintegrated" in measurement_group:
+            del measurement_group["reintegrated"]
+
+        reintegrated_group = measurement_group.create_group("reintegrated")
+        for key, value in geometry.items():
+            reintegrated_group.attrs[key] = value
+
+        q_node = reintegrated_group.create_dataset("q", data=q_array, dtype="float")
+        chi_node = reintegrated_group.create_dataset("chi", data=chi_array, dtype="float")
+        intensity_node = reintegrated_group.create_dataset(
+            "intensity", data=intensity, dtype="float", **get_storage_options("xrd", "pattern", intensity.shape)
+        )
+        q_node.attrs["units"] = "A-1"
+        chi_node.attrs["units"] = "deg"
+        intensity_node.attrs["units"] = "counts"
+
+    return None
+
+
+def xrd_reintegrate_dataset(hdf5_path, dataset_name, poni_path, n_q=1000, n_chi=1, mask=None):
+    """
+    Integrates all detector images of an XRD dataset from a pyFAI calibration file and stores the patterns.
+
+    Args:
+        hdf5_path (str or Path): The path to the HDF5 file.
+        dataset_name (str): Name of the XRD dataset.
+        poni_path (str or Path): Path to the .poni calibration file.
+        n_q (int): Number of radial bins.
+        n_chi (int): Number of azimuthal bins.
+        mask (np.array): Boolean array, True for the pixels to exclude.
+    Returns:
+        None
+    """
+    geometry = xrd_read_poni(poni_path)
+
+    # Integrate from a read-only open, other users can keep reading the file meanwhile
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        position_dataframe, q_array, chi_array, intensity_array = xrd_reintegrate_from_hdf5(
+            hdf5_file[dataset_name], geometry, n_q=n_q, n_chi=n_chi, mask=mask
+        )
+
+    with open_hdf5(hdf5_path, "a") as hdf5_file:
+        xrd_reintegrated_to_hdf5(
+            hdf5_file[dataset_name], position_dataframe, q_array, chi_array, intensity_array, geometry
+        )
+
+    return None
+
+
+def xrd_clustering_to_hdf5(xrd_group, position_dataframe, q_array, weights, components, method):
+    """
+    Writes the output of the phase clustering (see functions_xrd.xrd_cluster_patterns): the label (kmeans) or the
+    component weights (nmf) in the results/clustering group of every position, and the component patterns in the
+    analysis/clustering group of the dataset. Previous clustering results are replaced.
+
+    Args:
+        xrd_group (h5py.Group): The XRD dataset group.
+        position_dataframe (pandas.DataFrame): Positions, in the order of weights.
+        q_array (np.array): q grid of the components (A-1).
+        weights (np.array): (n_positions, n_components) weights, one-hot for kmeans.
+        components (np.array): (n_components, n_q) component patterns.
+        method (str): "kmeans" or "nmf".
+    Returns:
+        None
+    """
+    for position, position_weights in zip(position_dataframe["position"], weights):
+        results_group = safe_create_new_subgroup(xrd_group[position], "results")
+        if "clustering" in results_group:
+            del results_group["clustering"]
+        clustering_group = results_group.create_group("clustering")
+
+        if method == "kmeans":
+            clustering_group["label"] = int(np.argmax(position_weights))
+            clustering_group["label"].attrs["units"] = "arb"
+        else:
+            for idx, weight in enumerate(position_weights):
+                clustering_group[f"weight_{idx}"] = weight
+                clustering_group[f"weight_{idx}"].attrs["units"] = "arb"
+
+    analysis_group = safe_create_new_subgroup(xrd_group, "analysis")
+    if "clustering" in analysis_group:
+        del analysis_group["clustering"]
+    clustering_group = analysis_group.create_group("clustering")
+    clustering_group.attrs["method"] = method
+    clustering_group.create_dataset("q", data=q_array, dtype="float")
+    clustering_group.create_dataset("components", data=components, dtype="float")
+    clustering_group["q"].attrs["units"] = "A-1"
+
+    return None
+
+
+def xrd_cluster_dataset(hdf5_path, dataset_name, method="kmeans", n_components=4, chunk_size=256):
+    """
+    Clusters the patterns of an XRD dataset and stores the labels, weights and component patterns.
+
+    Args:
+        hdf5_path (str or Path): The path to the HDF5 file.
+        dataset_name (str): Name of the XRD dataset.
+        method (str): "kmeans" or "nmf".
+        n_components (int): Number of clusters or components.
+        chunk_size (int): Number of patterns kept in memory at once.
+    Returns:
+        None
+    """
+    with open_hdf5(hdf5_path, "a") as hdf5_file:
+        xrd_group = hdf5_file[dataset_name]
+        position_dataframe, q_array, weights, components = xrd_cluster_patterns(
+            xrd_group, method=method, n_components=n_components, chunk_size=chunk_size
+        )
+        xrd_clustering_to_hdf5(xrd_group, position_dataframe, q_array, weights, components, method)
+
+    return None
+
+
+def xrd_xrf_to_hdf5(xrd_group, position_dataframe, elements, intensities, method, energy_offset=None,
+                    energy_gain=None):
+    """
+    Writes the falconx element intensities (see functions_xrd.xrd_xrf_element_maps) to the results/xrf group of
+    every position, replacing previous XRF results.
+
+    Args:
+        xrd_group (h5py.Group): The ESRF dataset group.
+        position_dataframe (pandas.DataFrame): Positions, in the order of intensities.
+        elements (list): Element symbols.
+        intensities (np.array): (n_positions, n_elements) intensities in counts per second.
+        method (str): "roi" or "fit".
+        energy_offset (float): Energy of the first falconx channel used for the maps (keV).
+        energy_gain (float): Energy width of a falconx channel used for the maps (keV).
+    Returns:
+        None
+    """
+    for position, position_intensities in zip(position_dataframe["position"], intensities):
+        results_group = safe_create_new_subgroup(xrd_group[position], "results")
+        if "xrf" in results_group:
+            del results_group["xrf"]
+        xrf_group = results_group.create_group("xrf")
+        xrf_group.attrs["method"] = method
+        if energy_offset is not None:
+            xrf_group.attrs["energy_offset"] = energy_offset
+        if energy_gain is not None:
+            xrf_group.attrs["energy_gain"] = energy_gain
+
+        for element, intensity in zip(elements, position_intensities):
+            xrf_group[element] = intensity
+            xrf_group[element].attrs["units"] = "cps"
 
     return None
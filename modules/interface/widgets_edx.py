@@ -118,6 +118,8 @@ class WidgetsEDX:
             children=[
                 dcc.Store(id="edx_position_store"),
                 dcc.Store(id="edx_parameters_store"),
+                # HDF5 file shown in the tab, loaded when the tab is opened
+                dcc.Store(id="edx_loaded_path_store"),
             ]
         )
 
@@ -42,7 +42,8 @@ class WidgetsHDF5:
                     className='text-9',
                     children=[dcc.Dropdown(className='long-item',
                                            id='hdf5_measurement_type',
-                                           options=['EDX', 'PROFIL', 'MOKE', 'XRD', "ESRF", "XRD results"],
+                                           options=['EDX', 'PROFIL', 'MOKE', 'XRD', "ESRF", "ESRF (linked)",
+                                                    "ESRF materialize", "XRD results"],
                                            value=None)]
                 )
             ],
@@ -66,11 +67,14 @@ class WidgetsHDF5:
                 ),
                 html.Div(
                     className='text-8',
-                    children=[html.Button(id='hdf5_update', children="Update HDF5 structure", n_clicks=0)]
+                    children=[html.Button(id='hdf5_update', children="Update HDF5 structure", n_clicks=0),
+                              html.Button(id='hdf5_repack', children="Repack HDF5", n_clicks=0)]
                 ),
                 html.Div(
                     className='text-9',
-                    children=[html.Button(id='hdf5_export', children="Export to CSV", n_clicks=0)]
+                    children=[html.Button(id='hdf5_export', children="Export to CSV", n_clicks=0),
+                              dcc.Checklist(id='hdf5_session_mode', options=['In-memory editing'], value=[]),
+                              html.Button(id='hdf5_session_flush', children="Save to disk", n_clicks=0)]
                 ),
             ],
         )
@@ -138,6 +142,10 @@ class WidgetsHDF5:
             children=[
                 dcc.Store(id="hdf5_upload_folder_root", data=upload_folder_root),
                 dcc.Store(id="hdf5_upload_folder_path", data=None),
+                dcc.Store(id="hdf5_repack_job", data=None),
+                # File edited in memory by this page, its session is closed when another file is selected
+                dcc.Store(id="hdf5_session_path_store", data=None),
+                dcc.Interval(id="hdf5_repack_interval", interval=1000, disabled=True),
             ]
         )
 
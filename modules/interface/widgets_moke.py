@@ -214,7 +214,9 @@ class WidgetsMOKE:
                 dcc.Store(id="moke_database_path_store", data=None),
                 dcc.Store(id="moke_database_metadata_store", data=None),
                 dcc.Store(id="moke_data_treatment_store", data=None),
-                dcc.Store(id="moke_initial_load_trigger", data="load")
+                dcc.Store(id="moke_initial_load_trigger", data="load"),
+                # HDF5 file shown in the tab, loaded when the tab is opened
+                dcc.Store(id="moke_loaded_path_store", data=None),
             ]
         )
 
@@ -115,7 +115,9 @@ class WidgetsPROFIL:
             dcc.Store(id="profil_database_path_store", data=None),
             dcc.Store(id="profil_file_path_store", data=None),
             dcc.Store(id="profil_parameters_store", data=None),
-            dcc.Store(id="profil_database_metadata_store", data=None)
+            dcc.Store(id="profil_database_metadata_store", data=None),
+            # HDF5 file shown in the tab, loaded when the tab is opened
+            dcc.Store(id="profil_loaded_path_store", data=None),
         ])
 
 
@@ -34,6 +34,39 @@ class WidgetsXRD:
                 html.Br(),
                 dcc.Dropdown(id="xrd_heatmap_select", className="long-item", options=[])
             ]),
+            html.Div(className="subgrid-3", children=[
+                html.Label("Phase clustering"),
+                dcc.Dropdown(id="xrd_cluster_method", className="long-item",
+                             options=[{"label": "K-means", "value": "kmeans"},
+                                      {"label": "NMF", "value": "nmf"}],
+                             value="kmeans", clearable=False),
+                dcc.Input(id="xrd_cluster_components", className="long-item", type="number",
+                          placeholder="number of components", value=4, min=1, step=1),
+                html.Button(id="xrd_cluster_button", children="Cluster", n_clicks=0),
+            ]),
+            html.Div(className="subgrid-5", children=[
+                html.Label("Pattern source"),
+                dcc.RadioItems(
+                    id="xrd_pattern_source",
+                    options=[{"label": "Instrument", "value": "integrated"},
+                             {"label": "In-house", "value": "reintegrated"}],
+                    value="integrated",
+                ),
+            ]),
+            html.Div(className="subgrid-6", children=[
+                html.Label("XRF element maps"),
+                dcc.Input(id="xrd_xrf_elements", className="long-item", type="text",
+                          placeholder="elements, e.g. Fe, Co", value=None),
+                dcc.Dropdown(id="xrd_xrf_method", className="long-item",
+                             options=[{"label": "ROI sum", "value": "roi"},
+                                      {"label": "Basis fit", "value": "fit"}],
+                             value="roi", clearable=False),
+                dcc.Input(id="xrd_xrf_gain", className="long-item", type="number",
+                          placeholder="energy gain (keV/channel)", value=0.01),
+                dcc.Input(id="xrd_xrf_offset", className="long-item", type="number",
+                          placeholder="energy offset (keV)", value=0.0),
+                html.Button(id="xrd_xrf_button", children="XRF maps", n_clicks=0),
+            ]),
             html.Div(className="subgrid-7", children=[
                 html.Label("Colorbar bounds"),
                 dcc.Input(id="xrd_heatmap_max", className="long-item", type="number", placeholder="maximum value",
@@ -79,8 +112,11 @@ class WidgetsXRD:
                             id="xrd_plot_select",
                             options=[
                                 {"label": "Image", "value": "image"},
+                                {"label": "Mean image", "value": "mean_image"},
                                 {"label": "Integrated", "value": "integrated"},
+                                {"label": "Background", "value": "background"},
                                 {"label": "Fitted", "value": "fitted"},
+                                {"label": "Components", "value": "components"},
                             ],
                             value="image"
                         )
@@ -97,6 +133,12 @@ class WidgetsXRD:
                         )
                     ]
                 ),
+                html.Div(className="subgrid-6", children=[
+                    html.Label("Azimuthal integration"),
+                    dcc.Input(id="xrd_poni_path", className="long-item", type="text",
+                              placeholder=".poni calibration file", value=None),
+                    html.Button(id="xrd_reintegrate_button", children="Integrate", n_clicks=0),
+                ]),
                 html.Div(className="subgrid-7", children=[
                     html.Label("Image colorbar bounds"),
                     dcc.Input(id="xrd_image_max", className="long-item", type="number", placeholder="maximum value",
@@ -104,6 +146,14 @@ class WidgetsXRD:
                     dcc.Input(id="xrd_image_min", className="long-item", type="number", placeholder="minimum value",
                               value=None)
                 ]),
+                html.Div(className="subgrid-9", children=[
+                    html.Label("Peak fitting"),
+                    dcc.Input(id="xrd_peaks_centers", className="long-item", type="text",
+                              placeholder="q positions (A-1), empty for auto", value=None),
+                    dcc.Input(id="xrd_peaks_width", className="long-item", type="number",
+                              placeholder="window width (A-1)", value=0.1),
+                    html.Button(id="xrd_peaks_button", children="Fit peaks", n_clicks=0),
+                ]),
             ],
         )
 
@@ -124,6 +174,8 @@ class WidgetsXRD:
                 dcc.Store(id="xrd_database_path_store", data=None),
                 dcc.Store(id="xrd_heatmap_replot_tag", data=False),
                 dcc.Store(id="xrd_database_metadata_store", data=None),
+                # HDF5 file shown in the tab, loaded when the tab is opened
+                dcc.Store(id="xrd_loaded_path_store", data=None),
             ]
         )
 
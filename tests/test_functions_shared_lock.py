@@ -0,0 +1,97 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from modules.functions import functions_shared
+from modules.functions.functions_shared import HDF5BusyError, hdf5_file_lock, open_hdf5
+
+TIMEOUT_S = 0.2
+
+
+def hold_lock(hdf5_path, exclusive, hold_s):
+    # Takes the lock in another thread and returns once it is held
+    locked = threading.Event()
+
+    def target():
+        with hdf5_file_lock(hdf5_path, exclusive=exclusive):
+            locked.set()
+            time.sleep(hold_s)
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    assert locked.wait(5)
+    return thread
+
+
+def hold_open_for_writing(hdf5_path, opened, release):
+    with open_hdf5(hdf5_path, "a"):
+        opened.set()
+        release.wait(10)
+
+
+@pytest.fixture
+def hdf5_path(tmp_path):
+    hdf5_path = tmp_path / "sample.hdf5"
+    with open_hdf5(hdf5_path, "w") as hdf5_file:
+        hdf5_file.create_group("xrd")
+    return hdf5_path
+
+
+@pytest.mark.skipif(functions_shared.fcntl is None, reason="msvcrt locks are always exclusive")
+def test_readers_share_the_lock(hdf5_path):
+    thread = hold_lock(hdf5_path, exclusive=False, hold_s=1)
+    start = time.monotonic()
+    with hdf5_file_lock(hdf5_path, timeout_s=TIMEOUT_S):
+        assert time.monotonic() - start < TIMEOUT_S
+    thread.join()
+
+
+def test_writer_excludes_readers(hdf5_path):
+    thread = hold_lock(hdf5_path, exclusive=True, hold_s=1)
+    start = time.monotonic()
+    with pytest.raises(HDF5BusyError):
+        with hdf5_file_lock(hdf5_path, timeout_s=TIMEOUT_S):
+            pass
+    assert time.monotonic() - start >= TIMEOUT_S
+    thread.join()
+
+
+def test_writer_waits_for_readers(hdf5_path):
+    thread = hold_lock(hdf5_path, exclusive=False, hold_s=0.3)
+    start = time.monotonic()
+    with hdf5_file_lock(hdf5_path, exclusive=True, timeout_s=5):
+        assert time.monotonic() - start > 0.1
+    thread.join()
+
+
+def test_nested_opens_in_the_same_thread(hdf5_path, monkeypatch):
+    monkeypatch.setattr(functions_shared, "HDF5_LOCK_TIMEOUT_S", TIMEOUT_S)
+    with open_hdf5(hdf5_path, "a") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as nested_file:
+            assert "xrd" in nested_file
+        hdf5_file.create_group("edx")
+
+    # The lock is released once the outer context exits
+    thread = hold_lock(hdf5_path, exclusive=True, hold_s=0)
+    thread.join()
+
+
+def test_open_hdf5_busy_while_another_process_writes(hdf5_path, monkeypatch):
+    monkeypatch.setattr(functions_shared, "HDF5_LOCK_TIMEOUT_S", TIMEOUT_S)
+    context = multiprocessing.get_context("spawn")
+    opened, release = context.Event(), context.Event()
+    process = context.Process(target=hold_open_for_writing, args=(str(hdf5_path), opened, release))
+    process.start()
+    try:
+        assert opened.wait(30)
+        with pytest.raises(HDF5BusyError):
+            with open_hdf5(hdf5_path, "r"):
+                pass
+    finally:
+        release.set()
+        process.join(30)
+
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        assert "xrd" in hdf5_file
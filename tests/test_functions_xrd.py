@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from modules.functions.functions_xrd import xrd_make_pixel_q_chi
+
+# Tilted detector, every rotation non-zero so that swapped rotations or signs show up
+GEOMETRY = {
+    "distance": 0.15,
+    "poni1": 0.02,
+    "poni2": 0.03,
+    "rot1": 0.12,
+    "rot2": -0.08,
+    "rot3": 0.05,
+    "pixel1": 75e-6,
+    "pixel2": 75e-6,
+    "wavelength": 0.7e-10,
+}
+IMAGE_SHAPE = (400, 600)
+
+# (row, column): q (A-1) and chi (deg) computed with pyFAI AzimuthalIntegrator.center_array
+PYFAI_REFERENCE = {
+    (0, 0): (0.8205922463462253, -149.67935108881642),
+    (399, 599): (2.357308357449759, 30.59984199477619),
+    (200, 300): (0.7577152868893726, 30.801826951322887),
+    (50, 550): (1.7579240947465766, -11.382409597255101),
+    (350, 20): (1.243759180107824, 116.32298002665472),
+}
+
+
+def test_pixel_q_chi_matches_pyfai_reference():
+    q_array, chi_array = xrd_make_pixel_q_chi(IMAGE_SHAPE, GEOMETRY)
+    for (row, column), (q_reference, chi_reference) in PYFAI_REFERENCE.items():
+        assert q_array[row, column] == pytest.approx(q_reference, abs=1e-5)
+        assert chi_array[row, column] == pytest.approx(chi_reference, abs=1e-3)
+
+
+def test_pixel_q_chi_matches_pyfai():
+    azimuthal_integrator = pytest.importorskip("pyFAI.integrator.azimuthal")
+    integrator = azimuthal_integrator.AzimuthalIntegrator(
+        dist=GEOMETRY["distance"], poni1=GEOMETRY["poni1"], poni2=GEOMETRY["poni2"],
+        rot1=GEOMETRY["rot1"], rot2=GEOMETRY["rot2"], rot3=GEOMETRY["rot3"],
+        pixel1=GEOMETRY["pixel1"], pixel2=GEOMETRY["pixel2"], wavelength=GEOMETRY["wavelength"],
+    )
+
+    q_array, chi_array = xrd_make_pixel_q_chi(IMAGE_SHAPE, GEOMETRY)
+    q_pyfai = integrator.center_array(IMAGE_SHAPE, unit="q_A^-1")
+    chi_pyfai = np.degrees(integrator.center_array(IMAGE_SHAPE, unit="chi_rad"))
+
+    np.testing.assert_allclose(q_array, q_pyfai, atol=1e-6)
+    # chi wraps at +-180 deg
+    chi_difference = (chi_array - chi_pyfai + 180) % 360 - 180
+    assert np.max(np.abs(chi_difference)) < 1e-4
@@ -0,0 +1,85 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+
+from modules.functions.functions_xrd import xrd_als_background, xrd_smoothness_band, xrd_whittaker_background
+
+LAM = 1e4
+P = 0.01
+N_ITER = 10
+
+
+def make_patterns(n_patterns=4, n_q=300, seed=0):
+    rng = np.random.default_rng(seed)
+    q_array = np.linspace(1, 5, n_q)
+    patterns = []
+    for _ in range(n_patterns):
+        background = rng.uniform(50, 200) * np.exp(-q_array / rng.uniform(1, 3)) + rng.uniform(0, 20)
+        peaks = sum(
+            rng.uniform(50, 500) * np.exp(-0.5 * ((q_array - center) / 0.02) ** 2)
+            for center in rng.uniform(1.5, 4.5, 5)
+        )
+        patterns.append(background + peaks + rng.normal(0, 1, n_q))
+    return np.array(patterns)
+
+
+def second_difference_penalty(n_q, lam):
+    difference = sparse.diags([1.0, -2.0, 1.0], [0, 1, 2], shape=(n_q - 2, n_q))
+    return lam * (difference.T @ difference)
+
+
+def als_reference(pattern, lam, p, n_iter):
+    # Eilers & Boelens, one sparse solve per pattern and iteration
+    n_q = len(pattern)
+    penalty = second_difference_penalty(n_q, lam)
+    weights = np.ones(n_q)
+    for _ in range(n_iter):
+        background = spsolve(sparse.csc_matrix(sparse.diags(weights) + penalty), weights * pattern)
+        weights = np.where(pattern > background, p, 1 - p)
+    return background
+
+
+def test_smoothness_band_matches_sparse_penalty():
+    for n_q in [5, 6, 50]:
+        band = xrd_smoothness_band(n_q, LAM)
+        penalty = second_difference_penalty(n_q, LAM).toarray()
+
+        np.testing.assert_allclose(band[2], np.diag(penalty))
+        np.testing.assert_allclose(band[1, 1:], np.diag(penalty, 1))
+        np.testing.assert_allclose(band[0, 2:], np.diag(penalty, 2))
+        # Chained patterns only stay independent if the band does not reach into the previous block
+        assert band[1, 0] == 0
+        assert np.all(band[0, :2] == 0)
+
+
+def test_als_background_matches_per_pattern_reference():
+    patterns = make_patterns()
+    background = xrd_als_background(patterns, lam=LAM, p=P, n_iter=N_ITER)
+
+    for pattern, pattern_background in zip(patterns, background):
+        np.testing.assert_allclose(pattern_background, als_reference(pattern, LAM, P, N_ITER), rtol=1e-6, atol=1e-6)
+
+
+def test_als_background_patterns_are_independent():
+    patterns = make_patterns()
+    background = xrd_als_background(patterns, lam=LAM, p=P, n_iter=N_ITER)
+
+    modified = patterns.copy()
+    modified[1] = make_patterns(n_patterns=1, seed=1)[0] * 10
+    modified_background = xrd_als_background(modified, lam=LAM, p=P, n_iter=N_ITER)
+
+    np.testing.assert_allclose(np.delete(modified_background, 1, axis=0), np.delete(background, 1, axis=0),
+                               rtol=1e-9, atol=1e-9)
+    assert not np.allclose(modified_background[1], background[1])
+
+
+def test_whittaker_background_matches_per_pattern_reference():
+    patterns = make_patterns()
+    background = xrd_whittaker_background(patterns, lam=LAM, n_iter=N_ITER)
+
+    smoother = sparse.csc_matrix(sparse.identity(patterns.shape[1]) + second_difference_penalty(patterns.shape[1], LAM))
+    for pattern, pattern_background in zip(patterns, background):
+        reference = pattern
+        for _ in range(N_ITER):
+            reference = np.minimum(reference, spsolve(smoother, reference))
+        np.testing.assert_allclose(pattern_background, reference, rtol=1e-6, atol=1e-6)
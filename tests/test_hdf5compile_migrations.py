@@ -0,0 +1,87 @@
+import h5py
+import pytest
+
+from modules.hdf5_compilers import hdf5compile_migrations
+from modules.hdf5_compilers.hdf5compile_migrations import (get_pending_migrations, migrate_dataset,
+                                                           parse_writer_version)
+
+
+@pytest.fixture
+def hdf5_file():
+    with h5py.File("migrations.h5", "w", driver="core", backing_store=False) as hdf5_file:
+        yield hdf5_file
+
+
+def make_dataset(hdf5_file, ht_type, **writers):
+    dataset_group = hdf5_file.create_group(f"{ht_type}_{len(hdf5_file)}")
+    dataset_group.attrs["HT_type"] = ht_type
+    for writer, version in writers.items():
+        dataset_group.attrs[writer] = version
+    return dataset_group
+
+
+def pending_versions(dataset_group):
+    return [(writer, target_version) for writer, target_version, _, _ in get_pending_migrations(dataset_group)]
+
+
+def test_parse_writer_version_order():
+    versions = ["0.10", "0.3", "0.9", "0.1 beta", "0.3 beta", "1.0 beta", "0.2"]
+    assert sorted(versions, key=parse_writer_version) == ["0.1 beta", "0.2", "0.3 beta", "0.3", "0.9", "0.10",
+                                                         "1.0 beta"]
+    assert parse_writer_version(b"0.2 beta") == parse_writer_version("0.2 beta")
+
+
+def test_pending_migrations_of_old_smartlab_dataset(hdf5_file):
+    dataset_group = make_dataset(hdf5_file, "xrd", smartlab_writer="0.1 beta", xrd_results_writer="0.2")
+    assert pending_versions(dataset_group) == [("smartlab_writer", "0.2 beta"), ("smartlab_writer", "0.3 beta")]
+
+
+def test_pending_migrations_skip_applied_patches(hdf5_file):
+    dataset_group = make_dataset(hdf5_file, "profil", profil_writer="0.2")
+    assert pending_versions(dataset_group) == [("profil_writer", "0.3")]
+
+    dataset_group.attrs["profil_writer"] = "0.3"
+    assert pending_versions(dataset_group) == []
+
+
+def test_default_version_of_datasets_without_writer_tag(hdf5_file):
+    # XRD datasets written before xrd_results_writer existed hold 0.1 results
+    xrd_group = make_dataset(hdf5_file, "xrd", esrf_writer="0.1 beta")
+    assert pending_versions(xrd_group) == [("xrd_results_writer", "0.2")]
+
+    # Writers without a default version, or of another HT_type, do not apply
+    edx_group = make_dataset(hdf5_file, "edx", edx_writer="0.2 beta")
+    assert pending_versions(edx_group) == []
+
+
+def test_interrupted_migration_resumes(hdf5_file, monkeypatch):
+    applied_patches = []
+
+    def first_patch(dataset_group):
+        applied_patches.append("0.2")
+
+    def failing_patch(dataset_group):
+        if not applied_patches.count("0.3 attempt"):
+            applied_patches.append("0.3 attempt")
+            raise OSError("interrupted")
+        applied_patches.append("0.3")
+
+    monkeypatch.setattr(hdf5compile_migrations, "MIGRATIONS", {
+        "test_writer": {
+            "version": "0.4",
+            "default": "0.1",
+            "HT_type": "test",
+            "patches": [("0.2", "First patch", first_patch), ("0.3", "Second patch", failing_patch)],
+        },
+    })
+    dataset_group = make_dataset(hdf5_file, "test")
+
+    with pytest.raises(OSError):
+        migrate_dataset(dataset_group)
+    assert dataset_group.attrs["test_writer"] == "0.2"
+
+    assert migrate_dataset(dataset_group) == ["test_writer 0.3: Second patch",
+                                              "test_writer 0.4: Update the version tag"]
+    assert dataset_group.attrs["test_writer"] == "0.4"
+    assert applied_patches == ["0.2", "0.3 attempt", "0.3"]
+    assert migrate_dataset(dataset_group) == []
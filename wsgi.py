@@ -0,0 +1,26 @@
+"""
+WSGI entry point serving DaHU with several worker processes, so that the callbacks of several users browsing wafers
+run in parallel. With gunicorn (pip install gunicorn, Linux and macOS):
+    gunicorn --preload --workers 4 --threads 2 --timeout 600 --bind 0.0.0.0:8050 wsgi:server
+--preload imports the app once before starting the workers, the upload folder is cleaned once. Ingesting large
+datasets can take minutes, hence the long --timeout.
+
+The workers share the derived data cache (results tables, pattern matrices, backgrounds) in the DAHU_CACHE_DIR
+folder, defaulting to dahu_cache_<user> in the temporary directory, and lock the sample files they use (see
+functions_shared.hdf5_file_lock). The cache entries are pickles, the server refuses to start if the folder is not
+owned by its user with mode 0700. In-memory editing is disabled, a working copy would be private to one worker.
+"""
+import getpass
+import os
+import tempfile
+
+os.environ.setdefault("DAHU_CACHE_DIR", os.path.join(tempfile.gettempdir(), f"dahu_cache_{getpass.getuser()}"))
+
+from modules.functions import functions_shared
+
+functions_shared.HDF5_SESSIONS_ENABLED = False
+functions_shared.check_shared_cache_folder()
+
+from app import app
+
+server = app.server